@@ -1,10 +1,16 @@
-
 import os
+import re
+import json
+import socket
 import subprocess
+import threading
+import math
 import random
 import time
 import logging
 import requests
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
 
 logger = logging.getLogger(__name__)
@@ -107,11 +113,21 @@ class GenesetAgent(object):
     """
     GENE_SET_TOKEN = 'GENE_SET'
 
+    OLLAMA_METRIC_FIELDS = ['prompt_eval_count', 'prompt_eval_duration',
+                            'eval_count', 'eval_duration',
+                            'load_duration', 'total_duration']
+    """
+    Fields copied from final Ollama response into call metrics.
+    Durations are in nanoseconds as reported by Ollama
+    """
+
     def __init__(self, attribute_name_prefix=None):
         """
         Constructor
         """
         self._attribute_name_prefix = attribute_name_prefix
+        self._call_metrics = []
+        self._call_metrics_lock = threading.Lock()
 
     def annotate_gene_set(self, gene_names=None):
         """
@@ -133,6 +149,253 @@ class GenesetAgent(object):
         """
         return self._attribute_name_prefix
 
+    def close(self):
+        """
+        Releases any resources, such as processes, held by
+        this agent. Default implementation does nothing
+
+        """
+        pass
+
+    def get_endpoint_pool(self):
+        """
+        Gets pool of REST endpoints used by this agent
+
+        :return: ``None`` for agents that do not use REST endpoints
+        :rtype: :py:class:`OllamaEndpointPool`
+        """
+        return None
+
+    def get_time_to_first_tokens(self):
+        """
+        Gets time to first token, in seconds, for each streamed
+        response received by this agent
+
+        :return: empty list for agents that do not stream responses
+        :rtype: list
+        """
+        return []
+
+    def get_max_concurrency(self):
+        """
+        Gets maximum number of gene sets that can be passed to
+        :py:meth:`annotate_gene_set` from different threads at once
+
+        :return: ``1`` by default
+        :rtype: int
+        """
+        return 1
+
+    def get_concurrency_limiter(self):
+        """
+        Gets limiter controlling requests in flight
+
+        :return: ``None`` by default
+        :rtype: :py:class:`AdaptiveConcurrencyLimiter`
+        """
+        return None
+
+    def get_request_coalescer(self):
+        """
+        Gets coalescer sharing identical requests between agents
+
+        :return: ``None`` by default
+        :rtype: :py:class:`OllamaRequestCoalescer`
+        """
+        return None
+
+    def get_model(self):
+        """
+        Gets name of model used by this agent
+
+        :return: ``None`` by default
+        :rtype: str
+        """
+        return None
+
+    def get_batch_size(self):
+        """
+        Gets maximum number of gene sets that can be passed to
+        :py:meth:`annotate_gene_sets` in one call
+
+        :return: ``1`` by default
+        :rtype: int
+        """
+        return 1
+
+    def warm_up(self):
+        """
+        Loads model before gene sets are sent so the first
+        gene set does not pay model load time. Default
+        implementation does nothing
+        """
+        pass
+
+    def get_warm_up_metrics(self):
+        """
+        Gets metrics of warm up requests sent by :py:meth:`warm_up`.
+        Each entry is a dict with ``url``, ``wall_time`` (seconds),
+        ``load_duration`` (nanoseconds as reported by Ollama or ``None``),
+        ``success`` and ``error``
+
+        :return: empty list for agents that do not warm up
+        :rtype: list
+        """
+        return []
+
+    @staticmethod
+    def _send_warm_up(generate_url, model, keep_alive=None, auth=None,
+                      timeout=None):
+        """
+        Asks Ollama at **generate_url** to load **model** by sending
+        a generate request without a prompt
+
+        :param generate_url: URL ending with api/generate
+        :type generate_url: str
+        :param model: Name of model
+        :type model: str
+        :param keep_alive: If set, passed as ``keep_alive``
+        :type keep_alive: str or int
+        :param auth: Basic auth credentials
+        :type auth: tuple
+        :param timeout: Time in seconds to wait for model to load
+        :type timeout: int or float
+        :return: metrics of warm up request, see :py:meth:`get_warm_up_metrics`
+        :rtype: dict
+        """
+        query = {'model': model, 'stream': False}
+        if keep_alive is not None:
+            query['keep_alive'] = keep_alive
+        start_time = time.time()
+        entry = {'url': generate_url, 'model': model, 'wall_time': None,
+                 'load_duration': None, 'success': False, 'error': None}
+        try:
+            response = requests.post(generate_url, json=query, auth=auth,
+                                     timeout=timeout)
+            entry['wall_time'] = time.time() - start_time
+            if response.status_code != 200:
+                entry['error'] = 'status code: ' + str(response.status_code)
+            else:
+                entry['load_duration'] = response.json().get('load_duration')
+                entry['success'] = True
+        except (requests.exceptions.RequestException, ValueError) as e:
+            entry['wall_time'] = time.time() - start_time
+            entry['error'] = str(e)
+        if entry['success']:
+            logger.info('Warmed up ' + str(model) + ' on ' + str(generate_url) +
+                        ' in ' + str(entry['wall_time']) + ' seconds')
+        else:
+            logger.warning('Unable to warm up ' + str(model) + ' on ' +
+                           str(generate_url) + ': ' + str(entry['error']))
+        return entry
+
+    def is_batchable(self, gene_names=None):
+        """
+        Tells caller if **gene_names** can be packed together with
+        other gene sets in a call to :py:meth:`annotate_gene_sets`
+
+        :param gene_names: gene symbols
+        :type gene_names: list
+        :return: ``False`` by default
+        :rtype: bool
+        """
+        return False
+
+    def annotate_gene_sets(self, gene_sets=None):
+        """
+        Annotates several gene sets. Default implementation calls
+        :py:meth:`annotate_gene_set` on each gene set
+
+        :param gene_sets: list of gene symbol lists
+        :type gene_sets: list
+        :return: one tuple, as returned by :py:meth:`annotate_gene_set`,
+                 per gene set in same order as **gene_sets**
+        :rtype: list
+        """
+        return [self.annotate_gene_set(gene_names=gene_names) for gene_names in gene_sets]
+
+    def get_call_metrics(self):
+        """
+        Gets metrics recorded for each call to
+        :py:meth:`annotate_gene_set`. Each entry is a dict with
+        ``attribute_name_prefix``, ``model``, ``wall_time`` (seconds),
+        ``retries``, ``status_code``, ``success``, ``error``,
+        ``parse_failures`` and the
+        :py:const:`OLLAMA_METRIC_FIELDS` returned by Ollama, which are
+        ``None`` if not reported
+
+        :return: empty list for agents that do not record metrics
+        :rtype: list
+        """
+        with self._call_metrics_lock:
+            return list(self._call_metrics)
+
+    def _record_call_metrics(self, wall_time, call_info=None, error=None,
+                             parse_failures=0):
+        """
+        Records metrics of one call to :py:meth:`annotate_gene_set`
+
+        :param wall_time: Time in seconds the call took
+        :type wall_time: float
+        :param call_info: Filled in while the call ran, can hold
+                          ``retries``, ``status_code``, ``response``,
+                          the final JSON document returned by Ollama,
+                          number of ``hedges`` sent and ``hedge_wins`` and
+                          ``coalesced`` if result of an identical request
+                          was reused
+        :type call_info: dict
+        :param error: Error message if call failed
+        :type error: str
+        :param parse_failures: Number of gene sets in the call whose
+                               process name and confidence could not
+                               be parsed from the output
+        :type parse_failures: int
+        """
+        if call_info is None:
+            call_info = {}
+        response = call_info.get('response')
+        if not isinstance(response, dict):
+            response = {}
+        entry = {'attribute_name_prefix': self.get_attribute_name_prefix(),
+                 'model': self.get_model(),
+                 'wall_time': wall_time,
+                 'retries': call_info.get('retries', 0),
+                 'status_code': call_info.get('status_code'),
+                 'success': error is None,
+                 'error': error,
+                 'parse_failures': parse_failures,
+                 'hedges': call_info.get('hedges', 0),
+                 'hedge_wins': call_info.get('hedge_wins', 0),
+                 'coalesced': call_info.get('coalesced', False)}
+        for field in GenesetAgent.OLLAMA_METRIC_FIELDS:
+            entry[field] = response.get(field)
+        with self._call_metrics_lock:
+            self._call_metrics.append(entry)
+
+    @staticmethod
+    def _parse_llm_output(out):
+        """
+        Extracts process name and confidence score from
+        output of LLM by looking for lines starting
+        with ``Process: `` and ``Confidence Score: ``
+
+        :param out: output from LLM
+        :type out: str
+        :return: (process name or ``None``, confidence or ``None``)
+        :rtype: tuple
+        """
+        process_name = None
+        confidence = None
+        if out is not None:
+            for line in out.split('\n'):
+                if line.startswith('Process: '):
+                    process_name = line[line.index(':')+2:]
+                if line.startswith('Confidence Score: '):
+                    confidence = line[line.index(':')+2:]
+        else:
+            logger.info('LLM output is None')
+        return process_name, confidence
+
 
 class FakeGeneSetAgent(GenesetAgent):
     """
@@ -159,6 +422,136 @@ class FakeGeneSetAgent(GenesetAgent):
                str(random.randint(0, 1000))
 
 
+class OllamaServeProcess(object):
+    """
+    Manages a long lived ``ollama serve`` process bound to a
+    local port so many prompts can be sent to an already
+    running server instead of paying process startup and model
+    attach costs on every invocation of ``ollama run``
+    """
+
+    def __init__(self, ollama_binary='/usr/local/bin/ollama',
+                 host='127.0.0.1', port=None, num_parallel=1,
+                 startup_timeout=60):
+        """
+        Constructor
+
+        :param ollama_binary: Path to ollama command line binary
+        :type ollama_binary: str
+        :param host: Host/ip to bind server to
+        :type host: str
+        :param port: Port to bind server to, if ``None`` a free port is used
+        :type port: int
+        :param num_parallel: Number of prompts the server should process
+                             in parallel, passed to server via
+                             ``OLLAMA_NUM_PARALLEL`` environment variable
+        :type num_parallel: int
+        :param startup_timeout: Time in seconds to wait for server to start
+        :type startup_timeout: int or float
+        """
+        self._ollama_binary = ollama_binary
+        self._host = host
+        self._port = port
+        self._num_parallel = num_parallel
+        self._startup_timeout = startup_timeout
+        self._process = None
+
+    @staticmethod
+    def _get_free_port(host):
+        """
+        Asks operating system for a free port on **host**
+
+        :param host: Host/ip to check
+        :type host: str
+        :return: free port
+        :rtype: int
+        """
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind((host, 0))
+            return sock.getsockname()[1]
+
+    def get_base_url(self):
+        """
+        Gets base url of server
+
+        :return: url of form ``http://<host>:<port>``
+        :rtype: str
+        """
+        return 'http://' + str(self._host) + ':' + str(self._port)
+
+    def get_generate_url(self):
+        """
+        Gets url of ``api/generate`` endpoint on server
+
+        :return:
+        :rtype: str
+        """
+        return self.get_base_url() + '/api/generate'
+
+    def is_running(self):
+        """
+        Checks if server process is running
+
+        :return: ``True`` if process was started and has not exited
+        :rtype: bool
+        """
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        """
+        Starts ``ollama serve`` and waits until it responds to
+        requests. If server is already running this method does nothing
+
+        :raises CellmapshierarchyevalError: If server exits or does not
+                                            respond within **startup_timeout**
+        """
+        if self.is_running():
+            return
+        if self._port is None:
+            self._port = OllamaServeProcess._get_free_port(self._host)
+        env = os.environ.copy()
+        env['OLLAMA_HOST'] = str(self._host) + ':' + str(self._port)
+        env['OLLAMA_NUM_PARALLEL'] = str(self._num_parallel)
+        logger.info('Starting ollama serve on ' + self.get_base_url() +
+                    ' with ' + str(self._num_parallel) + ' parallel slots')
+        self._process = subprocess.Popen([self._ollama_binary, 'serve'],
+                                         env=env,
+                                         stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL)
+        deadline = time.time() + self._startup_timeout
+        while time.time() < deadline:
+            if self._process.poll() is not None:
+                raise CellmapshierarchyevalError('ollama serve exited with code: ' +
+                                                 str(self._process.returncode))
+            try:
+                response = requests.get(self.get_base_url() + '/api/version',
+                                        timeout=5)
+                if response.status_code == 200:
+                    return
+            except requests.exceptions.RequestException as e:
+                logger.debug('Waiting for ollama serve: ' + str(e))
+            time.sleep(0.5)
+        self.stop()
+        raise CellmapshierarchyevalError('ollama serve did not start within ' +
+                                         str(self._startup_timeout) + ' seconds')
+
+    def stop(self):
+        """
+        Stops server process if running
+        """
+        if self._process is None:
+            return
+        if self._process.poll() is None:
+            logger.info('Stopping ollama serve on ' + self.get_base_url())
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        self._process = None
+
+
 class OllamaCommandLineGeneSetAgent(GenesetAgent):
     """
     Runs
@@ -168,7 +561,8 @@ class OllamaCommandLineGeneSetAgent(GenesetAgent):
 
     def __init__(self, prompt=None, model='llama2:latest',
                  ollama_binary='/usr/local/bin/ollama',
-                 attribute_name_prefix=None):
+                 attribute_name_prefix=None,
+                 num_workers=None, timeout=360, keep_alive=None):
         """
         Constructor
 
@@ -177,6 +571,22 @@ class OllamaCommandLineGeneSetAgent(GenesetAgent):
                        should be inserted. If ``None`` default
                        internal prompt is used
         :type prompt: str
+        :param num_workers: If set, instead of invoking ``ollama run`` for
+                            every gene set, an ``ollama serve`` process for
+                            this agent is started on first use with this many
+                            parallel slots and prompts are sent to it. Gene
+                            sets are dispatched from up to this many threads
+                            so this many prompts can be in flight at once.
+                            Process is stopped by :py:meth:`close`
+        :type num_workers: int
+        :param timeout: Time in seconds to wait for a single prompt
+                        to complete
+        :type timeout: int or float
+        :param keep_alive: Only used if **num_workers** is set. If set,
+                           passed as ``keep_alive`` with every request so
+                           ``ollama serve`` keeps model loaded this long,
+                           for example ``30m`` or ``-1`` for forever
+        :type keep_alive: str or int
         """
 
         super().__init__(attribute_name_prefix=attribute_name_prefix)
@@ -187,6 +597,15 @@ class OllamaCommandLineGeneSetAgent(GenesetAgent):
             self._prompt = prompt
         self._model = model
         self._ollama_binary = ollama_binary
+        self._num_workers = num_workers
+        self._timeout = timeout
+        self._keep_alive = keep_alive
+        self._warm_up_metrics = []
+        self._serve_process = None
+        self._serve_lock = threading.Lock()
+        self._worker_slots = None
+        if num_workers is not None:
+            self._worker_slots = threading.BoundedSemaphore(num_workers)
         if self._attribute_name_prefix is None:
             self._attribute_name_prefix = 'ollama_' + str(self._model) + '::'
 
@@ -249,6 +668,121 @@ class OllamaCommandLineGeneSetAgent(GenesetAgent):
             out = out.rstrip()
         return p.returncode, out, err
 
+    def _get_serve_process(self):
+        """
+        Gets ``ollama serve`` process, starting it if needed
+
+        :return:
+        :rtype: :py:class:`OllamaServeProcess`
+        """
+        with self._serve_lock:
+            if self._serve_process is None:
+                self._serve_process = OllamaServeProcess(ollama_binary=self._ollama_binary,
+                                                         num_parallel=self._num_workers)
+            self._serve_process.start()
+            return self._serve_process
+
+    def get_model(self):
+        """
+        Gets name of model used by this agent
+
+        :return:
+        :rtype: str
+        """
+        return self._model
+
+    def _run_on_server(self, prompt, call_info=None):
+        """
+        Sends **prompt** to ``ollama serve`` process started by this
+        agent, waiting for a free worker slot first. Return value
+        mirrors :py:meth:`_run_cmd` so callers can treat both the same
+
+        :param prompt: Prompt to run
+        :type prompt: str
+        :param call_info: If set, ``status_code`` and ``response``, the
+                          JSON document returned by Ollama, are stored
+                          in this dict
+        :type call_info: dict
+        :raises CellmapshierarchyevalError: If prompt does not complete
+                                            within **timeout** set in
+                                            constructor
+        :return: (return code, standard out, standard error) where return
+                 code is ``0`` on success
+        :rtype: tuple
+        """
+        serve_process = self._get_serve_process()
+        query = {'model': self._model,
+                 'prompt': prompt,
+                 'stream': False}
+        if self._keep_alive is not None:
+            query['keep_alive'] = self._keep_alive
+        with self._worker_slots:
+            try:
+                response = requests.post(serve_process.get_generate_url(),
+                                         json=query, timeout=self._timeout)
+            except requests.exceptions.Timeout as e:
+                raise CellmapshierarchyevalError('Process timed out: ' + str(e))
+            except requests.exceptions.RequestException as e:
+                return 1, None, str(e)
+        if call_info is not None:
+            call_info['status_code'] = response.status_code
+        if response.status_code != 200:
+            return response.status_code, None, response.text
+        try:
+            result = response.json()
+        except ValueError as e:
+            return 1, None, 'Unable to parse response: ' + str(e)
+        if call_info is not None:
+            call_info['response'] = result
+        out = result.get('response')
+        if out is not None:
+            out = out.rstrip()
+        return 0, out, ''
+
+    def warm_up(self):
+        """
+        If **num_workers** was set in constructor, starts ``ollama serve``
+        process and loads model. Otherwise does nothing since every
+        ``ollama run`` invocation loads the model itself
+        """
+        if self._num_workers is None:
+            logger.debug('Skipping warm up, ollama run loads model on each call')
+            return
+        serve_process = self._get_serve_process()
+        self._warm_up_metrics.append(self._send_warm_up(serve_process.get_generate_url(),
+                                                        self._model,
+                                                        keep_alive=self._keep_alive,
+                                                        timeout=self._timeout))
+
+    def get_warm_up_metrics(self):
+        """
+        Gets metrics of warm up requests sent by :py:meth:`warm_up`
+
+        :return:
+        :rtype: list
+        """
+        return list(self._warm_up_metrics)
+
+    def get_max_concurrency(self):
+        """
+        Gets maximum number of gene sets that can be annotated at once
+
+        :return: **num_workers** passed to constructor or ``1`` if unset
+        :rtype: int
+        """
+        if self._num_workers is None:
+            return 1
+        return self._num_workers
+
+    def close(self):
+        """
+        Stops ``ollama serve`` process if one was started by this agent
+        """
+        with self._serve_lock:
+            if self._serve_process is not None:
+                self._serve_process.stop()
+                self._serve_process = None
+
     def _update_prompt_with_gene_set(self, gene_names=None):
         """
         Updates prompt inserting gene names
@@ -273,29 +807,568 @@ class OllamaCommandLineGeneSetAgent(GenesetAgent):
         """
         updated_prompt = self._update_prompt_with_gene_set(gene_names=gene_names)
 
-        e_code, out, err = self._run_cmd([self._ollama_binary, 'run',
-                                          self._model,
-                                          updated_prompt])
+        call_info = {}
+        start_time = time.time()
+        try:
+            if self._num_workers is not None:
+                e_code, out, err = self._run_on_server(updated_prompt,
+                                                       call_info=call_info)
+            else:
+                e_code, out, err = self._run_cmd([self._ollama_binary, 'run',
+                                                  self._model,
+                                                  updated_prompt],
+                                                 timeout=self._timeout)
+        except CellmapshierarchyevalError as ce:
+            self._record_call_metrics(time.time() - start_time,
+                                      call_info=call_info, error=str(ce))
+            raise
         if e_code != 0:
+            self._record_call_metrics(time.time() - start_time,
+                                      call_info=call_info,
+                                      error='exit code ' + str(e_code))
             raise CellmapshierarchyevalError('Received non zero exit code + ' +
                                              str(e_code) +
                                              ' calling ' +
                                              str(self._ollama_binary) +
                                              '\nstdout: ' + str(out) +
                                              'stderr\n' + str(err))
+        process_name, confidence = self._parse_llm_output(out)
+        parse_failures = 0
+        if process_name is None or confidence is None:
+            logger.warning('Unable to parse process name and confidence from LLM output')
+            parse_failures = 1
+        self._record_call_metrics(time.time() - start_time, call_info=call_info,
+                                  parse_failures=parse_failures)
+        return process_name, confidence, out
 
-        process_name = None
-        confidence = None
-        if out is not None:
-            for line in out.split('\n'):
-                if line.startswith('Process: '):
-                    process_name = line[line.index(':')+2:]
-                if line.startswith('Confidence Score: '):
-                    confidence = line[line.index(':')+2:]
-        else:
-            logger.info('LLM output is None')
 
-        return process_name, confidence, out
+class OllamaEndpointPool(object):
+    """
+    Spreads requests across one or more Ollama REST endpoints
+    picking the healthy endpoint with the fewest outstanding
+    requests. Endpoints that fail are taken out of rotation with
+    exponential backoff and only put back once a health probe
+    against ``api/version`` succeeds.
+
+    Instances are thread safe and are meant to be shared by all
+    agents talking to the same set of endpoints.
+    """
+
+    GENERATE_SUFFIX = '/api/generate'
+
+    MIN_BACKOFF = 0.1
+
+    def __init__(self, rest_urls=None, base_backoff=10, max_backoff=300,
+                 probe_timeout=5, max_unavailable_wait=600):
+        """
+        Constructor
+
+        :param rest_urls: URLs for service, each should end with api/generate
+        :type rest_urls: list or str
+        :param base_backoff: Time in seconds an endpoint is taken out of
+                             rotation after first failure. Doubled on each
+                             consecutive failure. Never less than
+                             :py:const:`MIN_BACKOFF`
+        :type base_backoff: int or float
+        :param max_backoff: Maximum time in seconds an endpoint is taken
+                            out of rotation
+        :type max_backoff: int or float
+        :param probe_timeout: Time in seconds to wait for health probe
+        :type probe_timeout: int or float
+        :param max_unavailable_wait: Maximum time in seconds
+                                     :py:meth:`acquire` will wait for an
+                                     endpoint to become healthy
+        :type max_unavailable_wait: int or float
+        """
+        if rest_urls is None:
+            rest_urls = []
+        if isinstance(rest_urls, str):
+            rest_urls = [rest_urls]
+        self._base_backoff = base_backoff
+        self._max_backoff = max_backoff
+        self._probe_timeout = probe_timeout
+        self._max_unavailable_wait = max_unavailable_wait
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        for url in rest_urls:
+            self._endpoints[url] = {'url': url,
+                                    'outstanding': 0,
+                                    'requests': 0,
+                                    'failures': 0,
+                                    'consecutive_failures': 0,
+                                    'retry_at': None,
+                                    'probing': False,
+                                    'latencies': []}
+
+    def get_rest_urls(self):
+        """
+        Gets URLs of endpoints in this pool
+
+        :return:
+        :rtype: list
+        """
+        return list(self._endpoints.keys())
+
+    @staticmethod
+    def _get_probe_url(rest_url):
+        """
+        Gets health probe url for **rest_url**
+
+        :param rest_url: URL ending with api/generate
+        :type rest_url: str
+        :return: URL of ``api/version`` endpoint on same server
+        :rtype: str
+        """
+        base_url = rest_url.rstrip('/')
+        if base_url.endswith(OllamaEndpointPool.GENERATE_SUFFIX):
+            base_url = base_url[:-len(OllamaEndpointPool.GENERATE_SUFFIX)]
+        return base_url + '/api/version'
+
+    def _probe(self, rest_url):
+        """
+        Checks if endpoint is responding
+
+        :param rest_url:
+        :type rest_url: str
+        :return: ``True`` if probe returned status code 200
+        :rtype: bool
+        """
+        try:
+            response = requests.get(OllamaEndpointPool._get_probe_url(rest_url),
+                                    timeout=self._probe_timeout)
+            return response.status_code == 200
+        except requests.exceptions.RequestException as e:
+            logger.debug('Health probe of ' + str(rest_url) + ' failed: ' + str(e))
+            return False
+
+    def _mark_failure(self, endpoint):
+        """
+        Takes **endpoint** out of rotation using exponential backoff.
+        Caller must hold lock
+
+        :param endpoint:
+        :type endpoint: dict
+        """
+        endpoint['consecutive_failures'] += 1
+        backoff = min(self._max_backoff,
+                      self._base_backoff * 2 ** (endpoint['consecutive_failures'] - 1))
+        backoff = max(OllamaEndpointPool.MIN_BACKOFF, backoff)
+        endpoint['retry_at'] = time.time() + backoff
+        logger.warning('Taking ' + str(endpoint['url']) + ' out of rotation for ' +
+                       str(backoff) + ' seconds')
+
+    def acquire(self, exclude=None):
+        """
+        Gets the healthy endpoint with fewest outstanding requests,
+        breaking ties by fewest total requests, and increments its
+        outstanding count. Caller must invoke :py:meth:`release`
+        with the returned URL when done.
+
+        If no endpoint is healthy this method waits for the backoff
+        of the next endpoint to expire and probes it. If the probe
+        succeeds the endpoint is used, otherwise an error is raised
+        so callers can count the wait as a failed attempt.
+
+        :param exclude: URLs to skip if any other endpoint is healthy
+        :type exclude: list
+        :raises CellmapshierarchyevalError: If there are no endpoints, the
+                                            health probe failed, or no
+                                            endpoint became healthy within
+                                            **max_unavailable_wait**
+        :return: URL of endpoint
+        :rtype: str
+        """
+        if len(self._endpoints) == 0:
+            raise CellmapshierarchyevalError('No ollama endpoints configured')
+        if exclude is None:
+            exclude = []
+        deadline = time.time() + self._max_unavailable_wait
+        while True:
+            with self._lock:
+                healthy = [e for e in self._endpoints.values() if e['retry_at'] is None]
+                preferred = [e for e in healthy if e['url'] not in exclude]
+                if len(preferred) > 0:
+                    healthy = preferred
+                if len(healthy) > 0:
+                    endpoint = min(healthy, key=lambda e: (e['outstanding'], e['requests']))
+                    endpoint['outstanding'] += 1
+                    endpoint['requests'] += 1
+                    return endpoint['url']
+                waiting = [e for e in self._endpoints.values() if e['probing'] is False]
+                candidate = None
+                if len(waiting) > 0:
+                    candidate = min(waiting, key=lambda e: e['retry_at'])
+                    wait_time = candidate['retry_at'] - time.time()
+                    if wait_time <= 0:
+                        candidate['probing'] = True
+                else:
+                    # another caller is probing, check back shortly
+                    wait_time = OllamaEndpointPool.MIN_BACKOFF
+            if time.time() + max(wait_time, 0) > deadline:
+                raise CellmapshierarchyevalError('No healthy ollama endpoints after waiting ' +
+                                                 str(self._max_unavailable_wait) + ' seconds')
+            if wait_time > 0:
+                time.sleep(wait_time)
+                continue
+
+            probe_ok = self._probe(candidate['url'])
+            with self._lock:
+                candidate['probing'] = False
+                if probe_ok:
+                    logger.info('Health probe succeeded, putting ' +
+                                str(candidate['url']) + ' back in rotation')
+                    candidate['retry_at'] = None
+                    continue
+                if candidate['retry_at'] is not None:
+                    self._mark_failure(candidate)
+            raise CellmapshierarchyevalError('Health probe of ' + str(candidate['url']) +
+                                             ' failed')
+
+    def release(self, rest_url, latency=None, success=True):
+        """
+        Releases endpoint obtained via :py:meth:`acquire`
+
+        :param rest_url: URL returned by :py:meth:`acquire`
+        :type rest_url: str
+        :param latency: Time in seconds request took, only recorded
+                        if not ``None``
+        :type latency: float
+        :param success: If ``False`` endpoint is taken out of rotation
+        :type success: bool
+        """
+        with self._lock:
+            endpoint = self._endpoints[rest_url]
+            endpoint['outstanding'] -= 1
+            if latency is not None:
+                endpoint['latencies'].append(latency)
+            if success is True:
+                endpoint['consecutive_failures'] = 0
+                return
+            endpoint['failures'] += 1
+            if endpoint['retry_at'] is None:
+                self._mark_failure(endpoint)
+
+    def get_statistics(self):
+        """
+        Gets request counts and latencies for each endpoint
+
+        :return: list of dicts, one per endpoint, with keys ``url``,
+                 ``requests``, ``failures``, ``healthy``, ``mean_latency``,
+                 ``median_latency``, ``max_latency``. Latencies are in
+                 seconds and ``None`` if no request succeeded
+        :rtype: list
+        """
+        res = []
+        with self._lock:
+            for endpoint in self._endpoints.values():
+                latencies = sorted(endpoint['latencies'])
+                stats = {'url': endpoint['url'],
+                         'requests': endpoint['requests'],
+                         'failures': endpoint['failures'],
+                         'healthy': endpoint['retry_at'] is None,
+                         'mean_latency': None,
+                         'median_latency': None,
+                         'max_latency': None}
+                if len(latencies) > 0:
+                    stats['mean_latency'] = sum(latencies) / len(latencies)
+                    stats['median_latency'] = latencies[len(latencies) // 2]
+                    stats['max_latency'] = latencies[-1]
+                res.append(stats)
+        return res
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """
+    Limits number of requests in flight to a service, adjusting
+    the limit as requests complete. While latency stays within
+    **latency_tolerance** times the lowest latency seen, the limit
+    grows by roughly one per round of requests (additive increase).
+    When a request fails with a server error or times out the limit
+    is multiplied by **backoff_ratio** (multiplicative decrease).
+    Only one decrease happens per round of in flight requests so a
+    burst of failures does not collapse the limit to the minimum.
+
+    Setting **min_limit** equal to **max_limit** gives a fixed limit.
+
+    Instances are thread safe and can be shared by several agents
+    """
+
+    def __init__(self, initial_limit=1, min_limit=1, max_limit=8,
+                 latency_tolerance=2.0, backoff_ratio=0.5):
+        """
+        Constructor
+
+        :param initial_limit: Starting number of requests allowed in flight
+        :type initial_limit: int
+        :param min_limit: Lowest the limit can go
+        :type min_limit: int
+        :param max_limit: Highest the limit can go
+        :type max_limit: int
+        :param latency_tolerance: Latency, as a multiple of lowest latency
+                                  seen, below which the limit is increased
+        :type latency_tolerance: float
+        :param backoff_ratio: Multiplier applied to limit on server error
+                              or timeout
+        :type backoff_ratio: float
+        """
+        if min_limit < 1 or max_limit < min_limit:
+            raise CellmapshierarchyevalError('Invalid concurrency limits: min ' +
+                                             str(min_limit) + ' max ' + str(max_limit))
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._latency_tolerance = latency_tolerance
+        self._backoff_ratio = backoff_ratio
+        self._in_flight = 0
+        self._min_latency = None
+        self._last_decrease = 0
+        self._start_time = time.time()
+        self._history = [{'time': 0.0, 'limit': int(self._limit)}]
+        self._condition = threading.Condition()
+
+    def get_limit(self):
+        """
+        Gets current number of requests allowed in flight
+
+        :return:
+        :rtype: int
+        """
+        with self._condition:
+            return int(self._limit)
+
+    def get_max_limit(self):
+        """
+        Gets highest number of requests that can be in flight
+
+        :return:
+        :rtype: int
+        """
+        return self._max_limit
+
+    def get_history(self):
+        """
+        Gets changes to the limit over time
+
+        :return: list of dicts with keys ``time``, seconds since
+                 this object was created, and ``limit``
+        :rtype: list
+        """
+        with self._condition:
+            return list(self._history)
+
+    def _set_limit(self, new_limit):
+        """
+        Updates limit, logging and recording it if the number of
+        requests allowed in flight changed. Caller must hold lock
+
+        :param new_limit:
+        :type new_limit: float
+        """
+        old_limit = int(self._limit)
+        self._limit = new_limit
+        if int(new_limit) != old_limit:
+            logger.info('LLM concurrency changed from ' + str(old_limit) +
+                        ' to ' + str(int(new_limit)))
+            self._history.append({'time': time.time() - self._start_time,
+                                  'limit': int(new_limit)})
+            self._condition.notify_all()
+
+    def acquire(self):
+        """
+        Waits until fewer than the limit requests are in flight and
+        counts the caller as in flight
+
+        :return: token to pass to :py:meth:`release`
+        :rtype: float
+        """
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+            return time.time()
+
+    def try_acquire(self):
+        """
+        Like :py:meth:`acquire`, but returns right away if
+        limit is reached
+
+        :return: token to pass to :py:meth:`release` or ``None`` if
+                 limit is reached
+        :rtype: float
+        """
+        with self._condition:
+            if self._in_flight >= int(self._limit):
+                return None
+            self._in_flight += 1
+            return time.time()
+
+    def release(self, token, overloaded=False, record_latency=True):
+        """
+        Marks request started via :py:meth:`acquire` as done
+        and adjusts limit
+
+        :param token: Value returned by :py:meth:`acquire`
+        :type token: float
+        :param overloaded: ``True`` if request failed with a server
+                           error or timed out
+        :type overloaded: bool
+        :param record_latency: If ``False`` limit is not adjusted, used
+                               when no request was actually sent
+        :type record_latency: bool
+        """
+        now = time.time()
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+            if record_latency is False:
+                return
+            if overloaded is True:
+                # requests sent before the last decrease saw the old limit
+                if token >= self._last_decrease:
+                    self._last_decrease = now
+                    self._set_limit(max(float(self._min_limit),
+                                        self._limit * self._backoff_ratio))
+                return
+            latency = now - token
+            if self._min_latency is None or latency < self._min_latency:
+                self._min_latency = latency
+            if latency <= self._min_latency * self._latency_tolerance:
+                self._set_limit(min(float(self._max_limit),
+                                    self._limit + 1.0 / self._limit))
+
+
+class OllamaRequestCoalescer(object):
+    """
+    Shares requests with identical query payloads, such as the same
+    model and prompt listed twice in ``--ollama_prompts``, across
+    agents. A request made while an identical one is in flight waits
+    for and reuses its result and successful results are kept, up to
+    **max_entries**, so repeated requests are answered without
+    contacting the service.
+
+    Instances are thread safe and are meant to be shared by all
+    agents in a run.
+    """
+
+    def __init__(self, max_entries=10000):
+        """
+        Constructor
+
+        :param max_entries: Most successful results to keep. Least
+                            recently used results are dropped first
+        :type max_entries: int
+        """
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._results = OrderedDict()
+        self._requests = 0
+        self._sent = 0
+        self._coalesced = 0
+        self._cached = 0
+
+    @staticmethod
+    def get_key(query):
+        """
+        Gets key identifying **query**
+
+        :param query: JSON payload sent to service
+        :type query: dict
+        :return:
+        :rtype: str
+        """
+        return json.dumps(query, sort_keys=True)
+
+    def get_statistics(self):
+        """
+        Gets number of ``requests`` seen, requests ``sent`` to the
+        service, requests that waited on an identical request in flight
+        (``coalesced``) and requests answered from kept results (``cached``)
+
+        :return:
+        :rtype: dict
+        """
+        with self._lock:
+            return {'requests': self._requests,
+                    'sent': self._sent,
+                    'coalesced': self._coalesced,
+                    'cached': self._cached}
+
+    @staticmethod
+    def _copy_call_info(source, call_info):
+        """
+        Copies ``status_code`` of request that was sent into
+        **call_info** of a request that reused its result. Token
+        counts and durations are not copied so they are only
+        counted once
+
+        :param source:
+        :type source: dict
+        :param call_info:
+        :type call_info: dict
+        """
+        if call_info is None:
+            return
+        call_info['retries'] = 0
+        call_info['status_code'] = source.get('status_code')
+        call_info['coalesced'] = True
+
+    def run(self, query, send, call_info=None):
+        """
+        Gets result of **query**, calling **send** only if no identical
+        query is in flight and no result is kept for it
+
+        :param query: JSON payload sent to service
+        :type query: dict
+        :param send: Function that takes a ``call_info`` dict and sends
+                     **query**, returning (response from LLM as str, error
+                     message as str or None)
+        :type send: callable
+        :param call_info: Passed to **send** or, if result of another
+                          request is reused, ``coalesced`` is set to ``True``
+        :type call_info: dict
+        :return: (response from LLM as str, error message as str or None)
+        :rtype: tuple
+        """
+        key = OllamaRequestCoalescer.get_key(query)
+        with self._lock:
+            self._requests += 1
+            if key in self._results:
+                self._results.move_to_end(key)
+                self._cached += 1
+                out, source = self._results[key]
+                OllamaRequestCoalescer._copy_call_info(source, call_info)
+                return out, None
+            entry = self._in_flight.get(key)
+            if entry is None:
+                entry = {'event': threading.Event(),
+                         'result': (None, 'Identical request failed'),
+                         'call_info': {}}
+                self._in_flight[key] = entry
+                self._sent += 1
+                leader = True
+            else:
+                self._coalesced += 1
+                leader = False
+        if leader is False:
+            entry['event'].wait()
+            OllamaRequestCoalescer._copy_call_info(entry['call_info'], call_info)
+            return entry['result']
+
+        if call_info is None:
+            call_info = {}
+        try:
+            entry['result'] = send(call_info)
+        finally:
+            with self._lock:
+                entry['call_info'] = dict(call_info)
+                del self._in_flight[key]
+                if entry['result'][1] is None:
+                    self._results[key] = (entry['result'][0], entry['call_info'])
+                    while len(self._results) > self._max_entries:
+                        self._results.popitem(last=False)
+            entry['event'].set()
+        return entry['result']
 
 
 class OllamaRestServiceGenesetAgent(GenesetAgent):
@@ -303,11 +1376,50 @@ class OllamaRestServiceGenesetAgent(GenesetAgent):
     Calls LLM via REST service. Derived from ServerModel_LLM in
     https://github.com/idekerlab/agent_evaluation llm.py
     """
+
+    HEDGE_LATENCY_WINDOW = 1000
+    """
+    Number of most recent request latencies used to pick
+    the hedging delay
+    """
+
+    BATCH_PROMPT_HEADER = ('The task below is repeated for {NUM_SETS} gene sets '
+                           'listed in numbered sections at the end. Answer each '
+                           'section separately. Start the answer for each section '
+                           'with a line containing only "Section <number>" and '
+                           'keep the requested format for each answer.\n\n')
+    """
+    Put in front of prompt passed into constructor when several
+    gene sets are packed into one prompt
+    """
+
+    STRUCTURED_OUTPUT_SCHEMA = {'type': 'object',
+                                'properties': {'process': {'type': 'string'},
+                                               'confidence': {'type': 'number'},
+                                               'analysis': {'type': 'string'}},
+                                'required': ['process', 'confidence', 'analysis']}
+    """
+    JSON schema passed as ``format`` to Ollama in structured output mode
+    """
+
+    STRUCTURED_OUTPUT_INSTRUCTIONS = ('\n\nRespond only with a JSON object with keys '
+                                      '"process" set to the process name, "confidence" '
+                                      'set to the confidence score as a number between 0 '
+                                      'and 1 and "analysis" set to the analysis text.')
+    """
+    Appended to prompt passed into constructor in structured output mode
+    """
     def __init__(self, prompt=None, model='llama2:latest',
                  username=None, password=None,
                  rest_url=None, temperature=0, max_tokens=1000, seed=42,
                  attribute_name_prefix=None,
-                 max_retries=5, timeout=120, retry_wait=10):
+                 max_retries=5, timeout=120, retry_wait=10,
+                 stream=False, stream_extra_tokens=None,
+                 endpoint_pool=None, concurrency_limiter=None,
+                 batch_size=None, batch_max_genes=None,
+                 structured_output=False, max_parse_retries=2,
+                 keep_alive=None, hedge_percentile=None,
+                 hedge_min_samples=20, request_coalescer=None):
         """
         Constructor
 
@@ -319,8 +1431,11 @@ class OllamaRestServiceGenesetAgent(GenesetAgent):
         :type username: str
         :param password: Password to send via Basic Auth to service
         :type password: str
-        :param rest_url: URL for service, should end with api/generate
-        :type rest_url: str
+        :param rest_url: URL for service, should end with api/generate.
+                         Can also be a list of URLs in which case requests
+                         are spread across them. Ignored if
+                         **endpoint_pool** is set
+        :type rest_url: str or list
         :param temperature:
         :param max_tokens:
         :param seed:
@@ -329,9 +1444,66 @@ class OllamaRestServiceGenesetAgent(GenesetAgent):
         :type max_retries: int
         :param timeout: Time in seconds to wait for response from service
         :type timeout: int or float
-        :param retry_wait: Time in seconds to wait between retries for failed
-                           query
+        :param retry_wait: Time in seconds a failing endpoint is taken out
+                           of rotation, doubled on each consecutive failure.
+                           Only used if **endpoint_pool** is not set
         :type retry_wait: int or float
+        :param stream: If ``True`` ask service to stream response and read
+                       tokens as they arrive
+        :type stream: bool
+        :param stream_extra_tokens: Only used if **stream** is ``True``. If set,
+                                    close the stream once ``Process:`` and
+                                    ``Confidence Score:`` lines have been
+                                    parsed and this many additional tokens
+                                    have been received. If ``None`` the
+                                    full response is read
+        :type stream_extra_tokens: int
+        :param endpoint_pool: Pool of endpoints, possibly shared with
+                              other agents, to send requests to. If
+                              ``None`` a pool is created from **rest_url**
+        :type endpoint_pool: :py:class:`OllamaEndpointPool`
+        :param concurrency_limiter: Limits requests in flight, possibly
+                                    shared with other agents. If ``None``
+                                    gene sets are annotated one at a time
+        :type concurrency_limiter: :py:class:`AdaptiveConcurrencyLimiter`
+        :param batch_size: If set and larger than ``1``, up to this many
+                           gene sets are packed into one prompt with
+                           numbered sections by :py:meth:`annotate_gene_sets`
+        :type batch_size: int
+        :param batch_max_genes: Only used if **batch_size** is set. Only gene
+                                sets with at most this many genes are packed
+                                together. If ``None`` any gene set can be
+        :type batch_max_genes: int
+        :param structured_output: If ``True`` ask service for JSON matching
+                                  :py:const:`STRUCTURED_OUTPUT_SCHEMA` and
+                                  validate it instead of scanning text for
+                                  ``Process:`` and ``Confidence Score:``
+                                  lines. Disables batching
+        :type structured_output: bool
+        :param max_parse_retries: Only used if **structured_output** is
+                                  ``True``. Number of times a gene set whose
+                                  response fails validation is sent again,
+                                  with a different seed, before giving up
+        :type max_parse_retries: int
+        :param keep_alive: If set, passed as ``keep_alive`` with every
+                           request so service keeps model loaded this
+                           long, for example ``30m`` or ``-1`` for forever
+        :type keep_alive: str or int
+        :param hedge_percentile: If set, a request still running after
+                                 this percentile, between 0 and 100, of
+                                 latencies observed by this agent gets a
+                                 duplicate sent to another endpoint, if a
+                                 concurrency slot is free. Whichever finishes
+                                 first is used and the other is cancelled
+        :type hedge_percentile: float
+        :param hedge_min_samples: Only used if **hedge_percentile** is set.
+                                  Number of successful requests that must be
+                                  observed before requests are hedged
+        :type hedge_min_samples: int
+        :param request_coalescer: If set, identical queries, possibly from
+                                  other agents sharing the coalescer, share
+                                  one request and its result
+        :type request_coalescer: :py:class:`OllamaRequestCoalescer`
         """
         super().__init__(attribute_name_prefix=attribute_name_prefix)
         if prompt is None:
@@ -349,9 +1521,38 @@ class OllamaRestServiceGenesetAgent(GenesetAgent):
         self._max_retries = max_retries
         self._timeout = timeout
         self._retry_wait = retry_wait
+        self._stream = stream
+        self._stream_extra_tokens = stream_extra_tokens
+        self._time_to_first_tokens = []
+        if endpoint_pool is None:
+            endpoint_pool = OllamaEndpointPool(rest_urls=rest_url,
+                                               base_backoff=retry_wait)
+        self._endpoint_pool = endpoint_pool
+        self._concurrency_limiter = concurrency_limiter
+        self._batch_size = batch_size
+        self._batch_max_genes = batch_max_genes
+        self._structured_output = structured_output
+        self._max_parse_retries = max_parse_retries
+        self._keep_alive = keep_alive
+        self._warm_up_metrics = []
+        self._hedge_percentile = hedge_percentile
+        self._hedge_min_samples = hedge_min_samples
+        self._latencies = deque(maxlen=OllamaRestServiceGenesetAgent.HEDGE_LATENCY_WINDOW)
+        self._latencies_lock = threading.Lock()
+        self._hedge_executor = None
+        self._request_coalescer = request_coalescer
         if self._attribute_name_prefix is None:
             self._attribute_name_prefix = 'ollama_' + str(self._model) + '::'
 
+    def close(self):
+        """
+        Stops threads used to send hedged requests. Requests that
+        lost a race are left to finish in the background
+        """
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+            self._hedge_executor = None
+
     def get_prompt(self):
         """
         Gets prompt used by this agent
@@ -370,26 +1571,255 @@ class OllamaRestServiceGenesetAgent(GenesetAgent):
 
         return self._prompt.format(GENE_SET=','.join(gene_names))
 
-    def _get_query(self, gene_names=None):
+    def _get_query(self, gene_names=None, prompt=None, num_predict=None,
+                   seed_offset=0):
         """
-        Gets query for rest service
+        Gets query for rest service. If **structured_output** was set
+        in constructor, the JSON schema is passed as ``format`` and
+        :py:const:`STRUCTURED_OUTPUT_INSTRUCTIONS` are appended to prompt
+
+        :param gene_names: Genes to insert into prompt
+        :type gene_names: list
+        :param prompt: If set, used as is instead of inserting
+                       **gene_names** into prompt
+        :type prompt: str
+        :param num_predict: Maximum tokens to generate, if ``None``
+                            **max_tokens** passed into constructor is used
+        :type num_predict: int
+        :param seed_offset: Added to **seed** passed into constructor so
+                            retries do not get the same response
+        :type seed_offset: int
         :return:
         :rtype: dict
         """
-        updated_prompt = self._update_prompt_with_gene_set(gene_names=gene_names)
+        if prompt is None:
+            prompt = self._update_prompt_with_gene_set(gene_names=gene_names)
+            if self._structured_output is True:
+                prompt += OllamaRestServiceGenesetAgent.STRUCTURED_OUTPUT_INSTRUCTIONS
+        if num_predict is None:
+            num_predict = self._max_tokens
 
         query = {
             "model": self._model,
-            "prompt": updated_prompt,
-            "stream": False,
+            "prompt": prompt,
+            "stream": self._stream,
             "options": {
-                "seed": self._seed,
+                "seed": self._seed + seed_offset,
                 "temperature": self._temperature,
-                "num_predict": self._max_tokens
+                "num_predict": num_predict
             }
         }
+        if self._structured_output is True:
+            query['format'] = OllamaRestServiceGenesetAgent.STRUCTURED_OUTPUT_SCHEMA
+        if self._keep_alive is not None:
+            query['keep_alive'] = self._keep_alive
         return query
 
+    def warm_up(self):
+        """
+        Loads model on every endpoint in endpoint pool, at the same
+        time, so first gene sets do not pay model load time. Failures
+        are logged and recorded, but not raised
+        """
+        rest_urls = self._endpoint_pool.get_rest_urls()
+        auth_creds = self._get_auth_creds()
+        with ThreadPoolExecutor(max_workers=max(1, len(rest_urls))) as executor:
+            entries = list(executor.map(lambda url: self._send_warm_up(url, self._model,
+                                                                       keep_alive=self._keep_alive,
+                                                                       auth=auth_creds,
+                                                                       timeout=self._timeout),
+                                        rest_urls))
+        self._warm_up_metrics.extend(entries)
+
+    def get_warm_up_metrics(self):
+        """
+        Gets metrics of warm up requests sent by :py:meth:`warm_up`
+
+        :return:
+        :rtype: list
+        """
+        return list(self._warm_up_metrics)
+
+    @staticmethod
+    def _parse_structured_output(out):
+        """
+        Validates JSON output of LLM against
+        :py:const:`STRUCTURED_OUTPUT_SCHEMA`
+
+        :param out: output from LLM
+        :type out: str
+        :return: (process name, confidence as str) or ``(None, None)``
+                 if output is not valid
+        :rtype: tuple
+        """
+        if out is None:
+            return None, None
+        try:
+            result = json.loads(out)
+        except ValueError as e:
+            logger.debug('LLM output is not valid JSON: ' + str(e))
+            return None, None
+        if not isinstance(result, dict):
+            return None, None
+        process_name = result.get('process')
+        confidence = result.get('confidence')
+        if not isinstance(process_name, str) or process_name.strip() == '':
+            return None, None
+        if isinstance(confidence, bool) or not isinstance(confidence, (int, float)):
+            return None, None
+        if confidence < 0 or confidence > 1:
+            return None, None
+        return process_name.strip(), str(confidence)
+
+    def _parse_output(self, out):
+        """
+        Extracts process name and confidence from output of LLM
+        using :py:meth:`_parse_structured_output` if **structured_output**
+        was set in constructor, otherwise
+        :py:meth:`~GenesetAgent._parse_llm_output`
+
+        :param out: output from LLM
+        :type out: str
+        :return: (process name or ``None``, confidence or ``None``)
+        :rtype: tuple
+        """
+        if self._structured_output is True:
+            return self._parse_structured_output(out)
+        return self._parse_llm_output(out)
+
+    def _get_batch_prompt(self, gene_sets=None):
+        """
+        Gets prompt asking LLM to analyze every gene set in
+        **gene_sets**. Prompt passed into constructor is kept as
+        is, apart from the gene set, and the numbered gene sets
+        come last so requests share as long a prefix as possible
+
+        :param gene_sets: list of gene symbol lists
+        :type gene_sets: list
+        :return:
+        :rtype: str
+        """
+        prompt = OllamaRestServiceGenesetAgent.BATCH_PROMPT_HEADER.format(NUM_SETS=len(gene_sets))
+        prompt += self._prompt.format(GENE_SET='<genes of the section>')
+        prompt += '\n\n'
+        for index, gene_names in enumerate(gene_sets):
+            prompt += 'Section ' + str(index + 1) + ': ' + ','.join(gene_names) + '\n'
+        return prompt
+
+    @staticmethod
+    def _split_batch_output(out, num_sets):
+        """
+        Splits output of batched prompt into text for each
+        section. Sections start with a line beginning with
+        ``Section <number>``, optionally preceded by markdown
+        characters
+
+        :param out: output from LLM
+        :type out: str
+        :param num_sets: number of gene sets in prompt
+        :type num_sets: int
+        :return: {section number starting at 1: text of section}
+        :rtype: dict
+        """
+        sections = {}
+        if out is None:
+            return sections
+        matches = list(re.finditer(r'^[\s#*]*Section\s+(\d+)\b[^\n]*$', out,
+                                   flags=re.MULTILINE | re.IGNORECASE))
+        for index, match in enumerate(matches):
+            end = len(out)
+            if index + 1 < len(matches):
+                end = matches[index + 1].start()
+            num = int(match.group(1))
+            if 1 <= num <= num_sets and num not in sections:
+                sections[num] = out[match.end():end].strip()
+        return sections
+
+    def get_batch_size(self):
+        """
+        Gets maximum number of gene sets packed into one prompt
+
+        :return: **batch_size** passed into constructor or ``1`` if unset
+        :rtype: int
+        """
+        if self._batch_size is None:
+            return 1
+        return self._batch_size
+
+    def is_batchable(self, gene_names=None):
+        """
+        Tells caller if **gene_names** can be packed with other
+        gene sets into one prompt
+
+        :param gene_names: gene symbols
+        :type gene_names: list
+        :return: ``True`` if batching is enabled, structured output is
+                 not and gene set has at most **batch_max_genes** genes
+        :rtype: bool
+        """
+        if self.get_batch_size() <= 1 or self._structured_output is True:
+            return False
+        if self._batch_max_genes is None:
+            return True
+        return len(gene_names) <= self._batch_max_genes
+
+    def annotate_gene_sets(self, gene_sets=None):
+        """
+        Packs **gene_sets** into one prompt with numbered sections
+        and parses a ``Process:`` and ``Confidence Score:`` pair from
+        each section of the response. Gene sets whose section is
+        missing or cannot be parsed, or all of them if the batched
+        query fails, are annotated with :py:meth:`annotate_gene_set`
+
+        :param gene_sets: list of gene symbol lists
+        :type gene_sets: list
+        :raises CellmapshierarchyevalError: If LLM failed to run for a
+                                            gene set annotated on its own
+        :return: one (process name, confidence, output) tuple per gene set
+                 in same order as **gene_sets**
+        :rtype: list
+        """
+        if len(gene_sets) <= 1:
+            return super().annotate_gene_sets(gene_sets=gene_sets)
+        query = self._get_query(prompt=self._get_batch_prompt(gene_sets=gene_sets),
+                                num_predict=self._max_tokens * len(gene_sets))
+        call_info = {}
+        start_time = time.time()
+        # stream must not stop after first section's score
+        out, err_mesage = self._query_service(query=query, call_info=call_info,
+                                              early_termination=False)
+        wall_time = time.time() - start_time
+        sections = {}
+        if err_mesage is not None:
+            logger.warning('Batched query of ' + str(len(gene_sets)) +
+                           ' gene sets failed, annotating each on its own: ' +
+                           str(err_mesage))
+        else:
+            sections = self._split_batch_output(out, len(gene_sets))
+
+        parsed = []
+        for index in range(len(gene_sets)):
+            section = sections.get(index + 1)
+            process_name, confidence = self._parse_llm_output(section)
+            parsed.append((process_name, confidence, section))
+        parse_failures = 0
+        if err_mesage is None:
+            parse_failures = sum(1 for p in parsed if p[0] is None or p[1] is None)
+        self._record_call_metrics(wall_time, call_info=call_info, error=err_mesage,
+                                  parse_failures=parse_failures)
+
+        results = []
+        for index, gene_names in enumerate(gene_sets):
+            process_name, confidence, section = parsed[index]
+            if process_name is None or confidence is None:
+                if err_mesage is None:
+                    logger.info('Unable to parse section ' + str(index + 1) +
+                                ' of batched response, annotating gene set on its own')
+                results.append(self.annotate_gene_set(gene_names=gene_names))
+                continue
+            results.append((process_name, confidence, section))
+        return results
+
     def _get_auth_creds(self):
         """
         If user and password are set in constructor
@@ -402,82 +1832,547 @@ class OllamaRestServiceGenesetAgent(GenesetAgent):
             return self._username, self._password
         return None
 
-    def _query_service(self, query=None):
+    def get_endpoint_pool(self):
+        """
+        Gets pool of endpoints this agent sends requests to
+
+        :return:
+        :rtype: :py:class:`OllamaEndpointPool`
+        """
+        return self._endpoint_pool
+
+    def get_concurrency_limiter(self):
+        """
+        Gets limiter controlling requests in flight
+
+        :return: limiter or ``None`` if not set
+        :rtype: :py:class:`AdaptiveConcurrencyLimiter`
+        """
+        return self._concurrency_limiter
+
+    def get_request_coalescer(self):
+        """
+        Gets coalescer sharing identical requests between agents
+
+        :return: coalescer or ``None`` if not set
+        :rtype: :py:class:`OllamaRequestCoalescer`
+        """
+        return self._request_coalescer
+
+    def get_model(self):
         """
-        Query the service
+        Gets name of model used by this agent
 
+        :return:
+        :rtype: str
+        """
+        return self._model
+
+    def get_max_concurrency(self):
+        """
+        Gets maximum number of gene sets that can be annotated at once
+
+        :return: max limit of concurrency limiter or ``1`` if not set
+        :rtype: int
+        """
+        if self._concurrency_limiter is None:
+            return 1
+        return self._concurrency_limiter.get_max_limit()
+
+    def get_time_to_first_tokens(self):
+        """
+        Gets time to first token, in seconds, for each streamed
+        response received by this agent
+
+        :return: time to first token for each streamed query
+        :rtype: list
+        """
+        with self._latencies_lock:
+            return list(self._time_to_first_tokens)
+
+    def _read_streamed_response(self, response, start_time, call_info=None,
+                                cancel_event=None, early_termination=True):
+        """
+        Reads streamed response from service, one JSON chunk
+        per line, concatenating the ``response`` field of each
+        chunk. If **stream_extra_tokens** was set in constructor the
+        stream is closed early once the ``Process:`` and
+        ``Confidence Score:`` lines have been fully received and that
+        many additional tokens have arrived.
+
+        :param response: Response from :py:func:`requests.post` invoked
+                         with ``stream=True``
+        :type response: :py:class:`requests.Response`
+        :param start_time: Time query was sent as returned by
+                           :py:func:`time.time`
+        :type start_time: float
+        :param call_info: If set, final chunk, which holds token counts
+                          and durations, is stored under ``response``
+                          and seconds until the first token arrived under
+                          ``time_to_first_token``
+        :type call_info: dict
+        :param cancel_event: If set, stream is closed as soon as this
+                             event is set
+        :type cancel_event: :py:class:`threading.Event`
+        :param early_termination: If ``False`` stream is read to the end
+                                  even if **stream_extra_tokens** was set,
+                                  needed for batched prompts which hold
+                                  several ``Process:`` lines
+        :type early_termination: bool
+        :raises CellmapshierarchyevalError: If service sends a chunk with
+                                            an ``error`` field
+        :return: (text received, True if stream was closed early)
+        :rtype: tuple
+        """
+        chunks = []
+        time_to_first_token = None
+        extra_tokens = None
+        try:
+            for line in response.iter_lines():
+                if cancel_event is not None and cancel_event.is_set():
+                    logger.debug('Closing cancelled stream')
+                    return ''.join(chunks), True
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get('error') is not None:
+                    raise CellmapshierarchyevalError('Service reported error while streaming: ' +
+                                                     str(chunk.get('error')))
+                token = chunk.get('response', '')
+                if token and time_to_first_token is None:
+                    time_to_first_token = time.time() - start_time
+                    if call_info is not None:
+                        call_info['time_to_first_token'] = time_to_first_token
+                    logger.debug('Time to first token: ' +
+                                 str(time_to_first_token) + ' seconds')
+                chunks.append(token)
+                if chunk.get('done', False) is True:
+                    if call_info is not None:
+                        call_info['response'] = chunk
+                    return ''.join(chunks), False
+
+                if self._stream_extra_tokens is None or early_termination is False:
+                    continue
+                if extra_tokens is None:
+                    # only examine complete lines to avoid
+                    # parsing a partially received score
+                    text = ''.join(chunks)
+                    process_name, confidence = self._parse_llm_output(text[:text.rfind('\n') + 1])
+                    if process_name is not None and confidence is not None:
+                        extra_tokens = 0
+                else:
+                    extra_tokens += 1
+                if extra_tokens is not None and extra_tokens >= self._stream_extra_tokens:
+                    logger.debug('Closing stream early after receiving ' +
+                                 str(extra_tokens) + ' extra tokens')
+                    return ''.join(chunks), True
+        finally:
+            response.close()
+        return ''.join(chunks), False
+
+    def _query_endpoint(self, rest_url, query, auth_creds, start_time,
+                        call_info=None, cancel_event=None, early_termination=True):
+        """
+        Sends **query** to **rest_url** once
+
+        :param rest_url: URL of endpoint
+        :type rest_url: str
         :param query:
         :type query: dict
+        :param auth_creds: Credentials from :py:meth:`_get_auth_creds`
+        :type auth_creds: tuple
+        :param start_time: Time query is sent as returned by
+                           :py:func:`time.time`
+        :type start_time: float
+        :param call_info: If set, ``status_code`` and ``response``, the
+                          final JSON document returned by Ollama, are
+                          stored in this dict
+        :type call_info: dict
+        :param cancel_event: If set, a streamed response is closed as
+                             soon as this event is set
+        :type cancel_event: :py:class:`threading.Event`
+        :param early_termination: see :py:meth:`_read_streamed_response`
+        :type early_termination: bool
+        :return: (response from LLM as str, error message as str or None,
+                  ``True`` if query should be retried, ``True`` if failure
+                  indicates service is overloaded ie server error or timeout)
+        :rtype: tuple
+        """
+        try:
+            response = requests.post(rest_url, json=query,
+                                     timeout=self._timeout,
+                                     auth=auth_creds,
+                                     stream=self._stream)
+
+            if call_info is not None:
+                call_info['status_code'] = response.status_code
+            # Check if the request was successful
+            if response.status_code == 200:
+                # return the response
+                if self._stream is True:
+                    out, _ = self._read_streamed_response(response, start_time,
+                                                          call_info=call_info,
+                                                          cancel_event=cancel_event,
+                                                          early_termination=early_termination)
+                else:
+                    result = response.json()
+                    if call_info is not None:
+                        call_info['response'] = result
+                    out = result['response']
+                return out, None, False, False
+            elif response.status_code in [500, 502, 503, 504]:
+                logger.info(response.text)
+                logger.error('Encountering server issue ' + str(response.status_code) +
+                             ' from ' + str(rest_url) + '. Retrying')
+                return None, str(response.status_code), True, True
+            logger.info(response.text)
+            error_message = 'The request failed with status code: ' + str(response.status_code)
+            logger.error(error_message)
+            return None, error_message, False, False
+        except CellmapshierarchyevalError as ce:
+            logger.error(str(ce) + ' from ' + str(rest_url) + '. Retrying')
+            return None, str(ce), True, False
+        except requests.exceptions.RequestException as e:
+            logger.error('The request to ' + str(rest_url) +
+                         ' failed with an exception: ' + str(e) + ' Retrying')
+            return None, str(e), True, isinstance(e, requests.exceptions.Timeout)
+        except Exception as e:
+            logger.error('An unexpected error occurred: ' + str(e))
+            return None, str(e), False, False
+
+    def _get_hedge_delay(self):
+        """
+        Gets time in seconds after which a request is hedged
+
+        :return: **hedge_percentile** of observed latencies or ``None``
+                 if hedging is off or too few latencies were observed
+        :rtype: float
+        """
+        if self._hedge_percentile is None:
+            return None
+        with self._latencies_lock:
+            if len(self._latencies) < max(1, self._hedge_min_samples):
+                return None
+            latencies = sorted(self._latencies)
+        index = int(math.ceil(self._hedge_percentile / 100.0 * len(latencies))) - 1
+        return latencies[min(len(latencies) - 1, max(0, index))]
+
+    def _get_hedge_executor(self):
+        """
+        Gets executor that runs requests that may be hedged, creating
+        it on first use
+
+        :return:
+        :rtype: :py:class:`concurrent.futures.ThreadPoolExecutor`
+        """
+        with self._latencies_lock:
+            if self._hedge_executor is None:
+                # room for a hedge alongside every request in flight
+                self._hedge_executor = ThreadPoolExecutor(max_workers=2 * max(1, self.get_max_concurrency()))
+            return self._hedge_executor
+
+    def _run_attempt(self, rest_url, token, query, auth_creds, attempt_info,
+                     cancel_event=None, early_termination=True):
+        """
+        Sends **query** to **rest_url**, which must have been acquired
+        from the endpoint pool, and releases the endpoint and
+        concurrency limiter **token** when done. Latency of
+        successful requests is recorded for hedging. A request
+        cancelled via **cancel_event** does not count against
+        the endpoint or limiter
+
+        :param rest_url: URL from :py:meth:`OllamaEndpointPool.acquire`
+        :type rest_url: str
+        :param token: Token from concurrency limiter or ``None``
+        :type token: float
+        :param query:
+        :type query: dict
+        :param auth_creds: Credentials from :py:meth:`_get_auth_creds`
+        :type auth_creds: tuple
+        :param attempt_info: ``status_code`` and ``response`` are stored
+                             in this dict
+        :type attempt_info: dict
+        :param cancel_event: Set when another request for the same
+                             query already finished
+        :type cancel_event: :py:class:`threading.Event`
+        :param early_termination: see :py:meth:`_read_streamed_response`
+        :type early_termination: bool
+        :return: (response from LLM as str, error message as str or None,
+                  ``True`` if query should be retried)
+        :rtype: tuple
+        """
+        start_time = time.time()
+        out, error_message, retry, overloaded = self._query_endpoint(rest_url, query,
+                                                                     auth_creds, start_time,
+                                                                     call_info=attempt_info,
+                                                                     cancel_event=cancel_event,
+                                                                     early_termination=early_termination)
+        latency = time.time() - start_time
+        if cancel_event is not None and cancel_event.is_set():
+            if token is not None:
+                self._concurrency_limiter.release(token, record_latency=False)
+            self._endpoint_pool.release(rest_url)
+            return out, error_message, retry
+        if token is not None:
+            self._concurrency_limiter.release(token, overloaded=overloaded)
+        if error_message is None:
+            self._endpoint_pool.release(rest_url, latency=latency)
+            with self._latencies_lock:
+                self._latencies.append(latency)
+        elif retry is False:
+            self._endpoint_pool.release(rest_url)
+        else:
+            self._endpoint_pool.release(rest_url, success=False)
+        return out, error_message, retry
+
+    def _run_hedged_attempt(self, rest_url, token, query, auth_creds,
+                            call_info, hedge_delay, failed_urls,
+                            early_termination=True):
+        """
+        Runs :py:meth:`_run_attempt` and, if it has not finished
+        after **hedge_delay** seconds and a concurrency slot is free,
+        sends a duplicate to another endpoint. The first successful
+        response is used and the other request is cancelled. If both
+        fail, the error of the one that finished last is returned
+
+        :param rest_url: URL from :py:meth:`OllamaEndpointPool.acquire`
+        :type rest_url: str
+        :param token: Token from concurrency limiter or ``None``
+        :type token: float
+        :param query:
+        :type query: dict
+        :param auth_creds: Credentials from :py:meth:`_get_auth_creds`
+        :type auth_creds: tuple
+        :param call_info: ``status_code`` and ``response`` of request
+                          that was used are stored in this dict and
+                          ``hedges`` and ``hedge_wins`` are incremented
+        :type call_info: dict
+        :param hedge_delay: Time in seconds to wait before hedging
+        :type hedge_delay: float
+        :param failed_urls: URLs that failed for this query. URLs of
+                            requests that fail and should be retried
+                            are appended
+        :type failed_urls: list
+        :param early_termination: see :py:meth:`_read_streamed_response`
+        :type early_termination: bool
+        :return: (response from LLM as str, error message as str or None,
+                  ``True`` if query should be retried)
+        :rtype: tuple
+        """
+        executor = self._get_hedge_executor()
+        attempts = {}
+
+        def submit(url, attempt_token, is_hedge):
+            attempt_info = {}
+            cancel_event = threading.Event()
+            future = executor.submit(self._run_attempt, url, attempt_token, query,
+                                     auth_creds, attempt_info, cancel_event,
+                                     early_termination)
+            attempts[future] = (url, attempt_info, cancel_event, is_hedge)
+
+        submit(rest_url, token, False)
+        done, pending = wait(list(attempts.keys()), timeout=hedge_delay)
+        if len(pending) > 0:
+            self._send_hedge(rest_url, failed_urls, submit, call_info)
+            pending = set(attempts.keys()) - done
+        result = None
+        while True:
+            for future in done:
+                url, attempt_info, _, is_hedge = attempts[future]
+                result = future.result()
+                call_info['status_code'] = attempt_info.get('status_code')
+                call_info['response'] = attempt_info.get('response')
+                call_info['time_to_first_token'] = attempt_info.get('time_to_first_token')
+                if result[1] is None:
+                    for _, _, cancel_event, _ in attempts.values():
+                        cancel_event.set()
+                    if is_hedge:
+                        call_info['hedge_wins'] = call_info.get('hedge_wins', 0) + 1
+                        logger.debug('Hedged request to ' + str(url) + ' finished first')
+                    return result
+                if result[2] is True:
+                    failed_urls.append(url)
+            if len(pending) == 0:
+                return result
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    def _send_hedge(self, rest_url, failed_urls, submit, call_info):
+        """
+        Sends duplicate of a slow request if a concurrency slot
+        is free and an endpoint can be acquired
+
+        :param rest_url: URL slow request was sent to
+        :type rest_url: str
+        :param failed_urls: URLs that failed for this query
+        :type failed_urls: list
+        :param submit: function that sends request given URL,
+                       limiter token and ``True`` for hedge
+        :type submit: callable
+        :param call_info: ``hedges`` is incremented if duplicate is sent
+        :type call_info: dict
+        """
+        hedge_token = None
+        if self._concurrency_limiter is not None:
+            hedge_token = self._concurrency_limiter.try_acquire()
+            if hedge_token is None:
+                logger.debug('No free slot to hedge request to ' + str(rest_url))
+                return
+        try:
+            hedge_url = self._endpoint_pool.acquire(exclude=[rest_url] + failed_urls)
+        except CellmapshierarchyevalError as ce:
+            if hedge_token is not None:
+                self._concurrency_limiter.release(hedge_token, record_latency=False)
+            logger.debug('Unable to hedge request: ' + str(ce))
+            return
+        logger.debug('Request to ' + str(rest_url) + ' is slow, hedging to ' + str(hedge_url))
+        call_info['hedges'] = call_info.get('hedges', 0) + 1
+        submit(hedge_url, hedge_token, True)
+
+    def _query_service(self, query=None, call_info=None, early_termination=True):
+        """
+        Query the service via :py:meth:`_send_query` or, if
+        **request_coalescer** was set in constructor, reuse result of
+        an identical query
+
+        :param query:
+        :type query: dict
+        :param call_info: see :py:meth:`_send_query`. ``coalesced`` is set
+                          to ``True`` if result of another query was reused
+        :type call_info: dict
+        :param early_termination: see :py:meth:`_read_streamed_response`
+        :type early_termination: bool
+        :return: (response from LLM as str, error message as str or None)
+        :rtype: tuple
+        """
+        if self._request_coalescer is None:
+            return self._send_query(query=query, call_info=call_info,
+                                    early_termination=early_termination)
+        return self._request_coalescer.run(query,
+                                           lambda info: self._send_query(query=query,
+                                                                         call_info=info,
+                                                                         early_termination=early_termination),
+                                           call_info=call_info)
+
+    def _send_query(self, query=None, call_info=None, early_termination=True):
+        """
+        Query the service, picking an endpoint from the endpoint
+        pool for each attempt. Attempts that fail with a server
+        error or exception are retried, up to **max_retries**,
+        on an endpoint that has not failed for this query or, if
+        none are healthy, after the failed endpoint's backoff expires
+        and its health probe succeeds. A failed health probe also
+        counts as an attempt.
+
+        If a concurrency limiter was set in constructor, each attempt
+        waits for a free slot and reports its latency and whether
+        the service looked overloaded back to the limiter.
+
+        If **hedge_percentile** was set in constructor, attempts are
+        hedged as described in :py:meth:`_run_hedged_attempt`
+
+        :param query:
+        :type query: dict
+        :param call_info: If set, number of ``retries`` along with
+                          ``status_code`` and ``response`` of the last
+                          attempt are stored in this dict, as well as
+                          number of ``hedges`` sent and ``hedge_wins``.
+                          For streamed responses ``time_to_first_token``
+                          of the attempt that was used is also stored
+                          and added to :py:meth:`get_time_to_first_tokens`
+        :type call_info: dict
+        :param early_termination: see :py:meth:`_read_streamed_response`
+        :type early_termination: bool
         :return: (response from LLM as str, error message as str or None)
         :rtype: tuple
         """
         retries = 0
-        backoff_time = self._retry_wait
+        last_error = None
+        failed_urls = []
         auth_creds = self._get_auth_creds()
+        if call_info is None:
+            call_info = {}
         while retries < self._max_retries:
+            call_info['retries'] = retries
+            call_info.pop('time_to_first_token', None)
+            token = None
+            if self._concurrency_limiter is not None:
+                token = self._concurrency_limiter.acquire()
             try:
-                response = requests.post(self._rest_url, json=query,
-                                         timeout=self._timeout,
-                                         auth=auth_creds)
-
-                # Check if the request was successful
-                if response.status_code == 200:
-                    # return the response
-                    return response.json()['response'], None
-                elif response.status_code in [500, 502, 503, 504]:
-                    logger.info(response.text)
-                    logger.error('Encountering server issue ' + str(response.status_code) +
-                                 '. Retrying in ' + str(backoff_time) + ' seconds')
-                    time.sleep(self._retry_wait)
-                    retries += 1
-                    backoff_time *= 2
-                else:
-                    logger.info(response.text)
-                    error_message = 'The request failed with status code: ' + str(response.status_code)
-                    logger.error(error_message)
-                    return None, error_message
-            except requests.exceptions.RequestException as e:
-                logger.error(response.text)
-                logger.error('status code: ' + str(response.status_code))
-                logger.error('The request failed with an exception: ' + str(e) +
-                             ' Retrying in ' + str(backoff_time) + ' seconds')
-                time.sleep(backoff_time)
+                rest_url = self._endpoint_pool.acquire(exclude=failed_urls)
+            except CellmapshierarchyevalError as ce:
+                if token is not None:
+                    self._concurrency_limiter.release(token, record_latency=False)
+                # no healthy endpoint, counts as a failed attempt
+                logger.error(str(ce))
+                last_error = str(ce)
                 retries += 1
-                backoff_time *= 2  # Double the backoff time for the next retry
-            except Exception as e:
-                logger.error('An unexpected error occurred: ' + str(e))
-                return None, str(e)
-            return None, "Error: Max retries exceeded, last response error was: " + str(response.status_code)
+                continue
+            hedge_delay = self._get_hedge_delay()
+            if hedge_delay is None:
+                out, error_message, retry = self._run_attempt(rest_url, token, query,
+                                                              auth_creds, call_info,
+                                                              early_termination=early_termination)
+                if error_message is not None and retry is True:
+                    failed_urls.append(rest_url)
+            else:
+                out, error_message, retry = self._run_hedged_attempt(rest_url, token, query,
+                                                                     auth_creds, call_info,
+                                                                     hedge_delay, failed_urls,
+                                                                     early_termination=early_termination)
+            if error_message is None:
+                # only the attempt whose response is used counts, not
+                # failed, cancelled or losing hedged attempts
+                if call_info.get('time_to_first_token') is not None:
+                    with self._latencies_lock:
+                        self._time_to_first_tokens.append(call_info['time_to_first_token'])
+                return out, None
+            if retry is False:
+                return None, error_message
+            last_error = error_message
+            retries += 1
+        return None, "Error: Max retries exceeded, last response error was: " + str(last_error)
 
     def annotate_gene_set(self, gene_names=None):
         """
         Using prompt passed in via constructor, this call
         invokes the LLM specified by **model** set in constructor
 
+        If **structured_output** was set in constructor, a response
+        that fails validation is sent again, with a different seed,
+        up to **max_parse_retries** times. Every response that could
+        not be parsed is counted in the call metrics
+
         :param gene_names: Genes to analyze
         :type gene_names: list
         :raises CellmapshierarchyevalError: If LLM failed to run
         :return: ('process name (score)', full output from LLM)
         :rtype: tuple
         """
-        query = self._get_query(gene_names=gene_names)
-
-        out, err_mesage = self._query_service(query=query)
-
-        if err_mesage is not None:
-            raise CellmapshierarchyevalError('Error running LLM: ' + str(err_mesage))
-
-        process_name = None
-        confidence = None
-        if out is not None:
-            for line in out.split('\n'):
-                if line.startswith('Process: '):
-                    process_name = line[line.index(':')+2:]
-                if line.startswith('Confidence Score: '):
-                    confidence = line[line.index(':')+2:]
-        else:
-            logger.info('LLM output is None')
-
+        attempts = 1
+        if self._structured_output is True:
+            attempts += self._max_parse_retries
+        process_name, confidence, out = None, None, None
+        for attempt in range(attempts):
+            query = self._get_query(gene_names=gene_names, seed_offset=attempt)
+
+            call_info = {}
+            start_time = time.time()
+            out, err_mesage = self._query_service(query=query, call_info=call_info)
+            wall_time = time.time() - start_time
+
+            if err_mesage is not None:
+                self._record_call_metrics(wall_time, call_info=call_info,
+                                          error=err_mesage)
+                raise CellmapshierarchyevalError('Error running LLM: ' + str(err_mesage))
+
+            process_name, confidence = self._parse_output(out)
+            if process_name is not None and confidence is not None:
+                self._record_call_metrics(wall_time, call_info=call_info)
+                return process_name, confidence, out
+            self._record_call_metrics(wall_time, call_info=call_info,
+                                      parse_failures=1)
+            logger.warning('Unable to parse process name and confidence from LLM '
+                           'output, attempt ' + str(attempt + 1) + ' of ' + str(attempts))
         return process_name, confidence, out
 
 
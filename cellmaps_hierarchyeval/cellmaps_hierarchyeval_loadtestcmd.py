@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+import json
+import argparse
+import sys
+import logging
+import logging.config
+from cellmaps_utils import logutils
+from cellmaps_utils import constants
+import cellmaps_hierarchyeval
+from cellmaps_hierarchyeval.runner import GeneSetAgentAnnotator
+from cellmaps_hierarchyeval.mockollama import MockOllamaServer
+from cellmaps_hierarchyeval.mockollama import AnnotationLoadTest
+from cellmaps_hierarchyeval.mockollama import create_synthetic_hierarchy
+from cellmaps_hierarchyeval.cellmaps_hierarchyevalcmd import get_ollama_geneset_agents
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_arguments(desc, args):
+    """
+    Parses command line arguments
+
+    :param desc: description to display on command line
+    :type desc: str
+    :param args: command line arguments usually :py:func:`sys.argv[1:]`
+    :type args: list
+    :return: arguments parsed by :py:mod:`argparse`
+    :rtype: :py:class:`argparse.Namespace`
+    """
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=constants.ArgParseFormatter)
+    parser.add_argument('--ollama',
+                        help='Comma delimited list of Ollama REST urls ending '
+                             'with api/generate to load test. If unset, a '
+                             'local mock Ollama server configured with the '
+                             '--mock_* flags is started and used')
+    parser.add_argument('--ollama_prompts', nargs='+', default=['mockmodel'],
+                        help='Models, and optionally prompts, in same format '
+                             'as cellmaps_hierarchyevalcmd.py')
+    parser.add_argument('--ollama_stream', action='store_true',
+                        help='If set, responses are streamed')
+    parser.add_argument('--ollama_concurrency', type=int,
+                        help='Number of requests to keep in flight')
+    parser.add_argument('--ollama_max_concurrency', type=int,
+                        help='If set, requests in flight adapt between 1 and '
+                             'this value')
+    parser.add_argument('--ollama_batch_size', type=int,
+                        help='If set, pack up to this many small assemblies '
+                             'into one prompt')
+    parser.add_argument('--ollama_structured_output', action='store_true',
+                        help='If set, request JSON output')
+    parser.add_argument('--ollama_order', choices=GeneSetAgentAnnotator.ORDERS,
+                        default=GeneSetAgentAnnotator.SIZE_ORDER,
+                        help='Order assemblies are sent to LLMs')
+    parser.add_argument('--ollama_warm_up', action='store_true',
+                        help='If set, load models before assemblies are sent')
+    parser.add_argument('--num_levels', type=int, default=3,
+                        help='Number of levels below root of synthetic '
+                             'hierarchy')
+    parser.add_argument('--branching', type=int, default=3,
+                        help='Number of children of each node of synthetic '
+                             'hierarchy')
+    parser.add_argument('--min_genes', type=int, default=4,
+                        help='Fewest genes in a leaf of synthetic hierarchy')
+    parser.add_argument('--max_genes', type=int, default=12,
+                        help='Most genes in a leaf of synthetic hierarchy')
+    parser.add_argument('--seed', type=int,
+                        help='Seed for synthetic hierarchy and mock server')
+    parser.add_argument('--mock_latency', type=float, default=0.2,
+                        help='Mean time in seconds mock server waits before '
+                             'first token')
+    parser.add_argument('--mock_latency_distribution',
+                        choices=MockOllamaServer.LATENCY_DISTRIBUTIONS,
+                        default=MockOllamaServer.LOGNORMAL,
+                        help='Distribution mock server latency is drawn from')
+    parser.add_argument('--mock_latency_sigma', type=float, default=0.5,
+                        help='Sigma for lognormal latency distribution')
+    parser.add_argument('--mock_token_latency', type=float, default=0.0,
+                        help='Time in seconds between tokens sent by mock '
+                             'server')
+    parser.add_argument('--mock_load_time', type=float, default=0.0,
+                        help='Time in seconds paid by first request to each '
+                             'model on mock server')
+    parser.add_argument('--mock_error_rate', type=float, default=0.0,
+                        help='Fraction of requests mock server fails')
+    parser.add_argument('--mock_error_status_code', type=int, default=503,
+                        help='HTTP status code of failed requests')
+    parser.add_argument('--report',
+                        help='If set, report is written to this file as JSON '
+                             'instead of standard out')
+    parser.add_argument('--logconf', default=None,
+                        help='Path to python logging configuration file in '
+                             'this format: https://docs.python.org/3/library/'
+                             'logging.config.html#logging-config-fileformat '
+                             'Setting this overrides -v parameter which uses '
+                             ' default logger. (default None)')
+    parser.add_argument('--verbose', '-v', action='count', default=1,
+                        help='Increases verbosity of logger to standard '
+                             'error for log messages in this module. Messages are '
+                             'output at these python logging levels '
+                             '-v = WARNING, -vv = INFO, '
+                             '-vvv = DEBUG, -vvvv = NOTSET (default ERROR '
+                             'logging)')
+    parser.add_argument('--version', action='version',
+                        version=('%(prog)s ' +
+                                 cellmaps_hierarchyeval.__version__))
+
+    return parser.parse_args(args)
+
+
+def run_load_test(theargs):
+    """
+    Runs load test described by **theargs**, starting and stopping
+    a mock Ollama server if ``--ollama`` was not set
+
+    :param theargs: arguments from :py:func:`_parse_arguments`
+    :type theargs: :py:class:`argparse.Namespace`
+    :return: report from
+             :py:meth:`~cellmaps_hierarchyeval.mockollama.AnnotationLoadTest.run`
+             with ``server`` statistics added when mock server was used
+    :rtype: dict
+    """
+    server = None
+    ollama = theargs.ollama
+    if ollama is None:
+        server = MockOllamaServer(latency=theargs.mock_latency,
+                                  latency_distribution=theargs.mock_latency_distribution,
+                                  latency_sigma=theargs.mock_latency_sigma,
+                                  token_latency=theargs.mock_token_latency,
+                                  load_time=theargs.mock_load_time,
+                                  error_rate=theargs.mock_error_rate,
+                                  error_status_code=theargs.mock_error_status_code,
+                                  seed=theargs.seed)
+        server.start()
+        ollama = server.get_generate_url()
+    try:
+        agents = get_ollama_geneset_agents(ollama=ollama,
+                                           ollama_prompts=theargs.ollama_prompts,
+                                           stream=theargs.ollama_stream,
+                                           concurrency=theargs.ollama_concurrency,
+                                           max_concurrency=theargs.ollama_max_concurrency,
+                                           batch_size=theargs.ollama_batch_size,
+                                           structured_output=theargs.ollama_structured_output)
+        hierarchy = create_synthetic_hierarchy(num_levels=theargs.num_levels,
+                                               branching=theargs.branching,
+                                               min_genes=theargs.min_genes,
+                                               max_genes=theargs.max_genes,
+                                               seed=theargs.seed)
+        annotator = GeneSetAgentAnnotator(order=theargs.ollama_order,
+                                          warm_up=theargs.ollama_warm_up)
+        report = AnnotationLoadTest(geneset_agents=agents, hierarchy=hierarchy,
+                                    geneset_annotator=annotator).run()
+        if server is not None:
+            report['server'] = server.get_statistics()
+        return report
+    finally:
+        if server is not None:
+            server.stop()
+
+
+def main(args):
+    """
+    Main entry point for program
+
+    :param args: arguments passed to command line usually :py:func:`sys.argv[1:]`
+    :type args: list
+
+    :return: ``0`` on success or ``2`` if an exception is raised
+    :rtype: int
+    """
+    desc = """
+    Version {version}
+
+    Load tests LLM annotation of hierarchies. Builds a synthetic
+    hierarchy, annotates it with the models set via --ollama_prompts
+    and reports requests per second along with p50/p95/p99 latency.
+
+    If --ollama is not set, a local mock Ollama server is started
+    whose latency, error rate and model load time are set via the
+    --mock_* flags so throughput and retry behavior can be measured
+    without a GPU.
+
+    """.format(version=cellmaps_hierarchyeval.__version__)
+
+    theargs = _parse_arguments(desc, args[1:])
+    theargs.program = args[0]
+    theargs.version = cellmaps_hierarchyeval.__version__
+
+    try:
+        logutils.setup_cmd_logging(theargs)
+        report = run_load_test(theargs)
+        if theargs.report is not None:
+            with open(theargs.report, 'w') as f:
+                json.dump(report, f, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        return 0
+    except Exception as e:
+        logger.exception('Caught exception: ' + str(e))
+        return 2
+    finally:
+        logging.shutdown()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
@@ -9,8 +9,15 @@ from cellmaps_utils import logutils
 from cellmaps_utils import constants
 import cellmaps_hierarchyeval
 from cellmaps_hierarchyeval.runner import CellmapshierarchyevalRunner
+from cellmaps_hierarchyeval.runner import GeneSetAgentAnnotator
+from cellmaps_hierarchyeval.runner import UnenrichedNodeSelectionPolicy
+from cellmaps_hierarchyeval.runner import MinimumSizeNodeSelectionPolicy
+from cellmaps_hierarchyeval.runner import TopSizeNodeSelectionPolicy
 from cellmaps_hierarchyeval.analysis import OllamaCommandLineGeneSetAgent
 from cellmaps_hierarchyeval.analysis import OllamaRestServiceGenesetAgent
+from cellmaps_hierarchyeval.analysis import OllamaEndpointPool
+from cellmaps_hierarchyeval.analysis import AdaptiveConcurrencyLimiter
+from cellmaps_hierarchyeval.analysis import OllamaRequestCoalescer
 from cellmaps_hierarchyeval.analysis import FakeGeneSetAgent
 
 logger = logging.getLogger(__name__)
@@ -60,6 +67,11 @@ def _parse_arguments(desc, args):
                              'url and all prompts will be passed to service. For'
                              'REST url the suffix api/generate must be appended. '
                              'Example: http://foo/api/generate '
+                             'Multiple REST urls can be set as a comma '
+                             'delimited list in which case requests are '
+                             'sent to the url with the fewest outstanding '
+                             'requests and failing urls are taken out of '
+                             'rotation until a health check succeeds. '
                              'NOTE: ollama integration with this tool is '
                              'EXPERIMENTAL and interface may be '
                              'changed or removed in the future ')
@@ -69,6 +81,114 @@ def _parse_arguments(desc, args):
     parser.add_argument('--ollama_password',
                         help='Password to pass via basic autho to ollama REST '
                              'service')
+    parser.add_argument('--ollama_workers', type=int,
+                        help='Only used if --ollama is path to ollama binary. '
+                             'If set, for each model an ollama serve process is '
+                             'started with this many parallel slots and up to '
+                             'this many assemblies are sent to it at once '
+                             'instead of invoking ollama run for every '
+                             'assembly. The process is stopped once all '
+                             'assemblies for that model are done')
+    parser.add_argument('--ollama_concurrency', type=int,
+                        help='Only used if --ollama is a REST url. Number of '
+                             'requests to keep in flight across all REST urls. '
+                             'If --ollama_max_concurrency is also set, this is '
+                             'the starting value. If unset, one request is sent '
+                             'at a time unless --ollama_max_concurrency is set')
+    parser.add_argument('--ollama_max_concurrency', type=int,
+                        help='Only used if --ollama is a REST url. If set, the '
+                             'number of requests in flight is adjusted between '
+                             '1 and this value, growing while latency stays flat '
+                             'and halving on server errors (5xx) or timeouts')
+    parser.add_argument('--ollama_stream', action='store_true',
+                        help='If set, and --ollama is a REST url, responses '
+                             'from the service are streamed and read as '
+                             'tokens arrive')
+    parser.add_argument('--ollama_stream_extra_tokens', type=int,
+                        help='Only used with --ollama_stream. If set, stream '
+                             'is closed once Process: and Confidence Score: '
+                             'lines are received plus this many additional '
+                             'tokens. Raw output stored in hierarchy will be '
+                             'truncated. If unset, full response is read')
+    parser.add_argument('--ollama_structured_output', action='store_true',
+                        help='Only used if --ollama is a REST url. If set, '
+                             'Ollama is asked for JSON output matching a schema '
+                             'with process, confidence and analysis fields '
+                             'which is validated instead of scanning text for '
+                             'Process: and Confidence Score: lines. Disables '
+                             '--ollama_batch_size')
+    parser.add_argument('--ollama_parse_retries', type=int, default=2,
+                        help='Only used with --ollama_structured_output. '
+                             'Number of times an assembly whose response fails '
+                             'validation is sent again before giving up')
+    parser.add_argument('--ollama_hedge_percentile', type=float,
+                        help='Only used if --ollama is a REST url. If set, '
+                             'a request still running after this percentile, '
+                             'between 0 and 100, of observed latencies is '
+                             'duplicated to another url, if a concurrency '
+                             'slot is free. The first response is used and '
+                             'the other request is cancelled')
+    parser.add_argument('--ollama_hedge_min_samples', type=int, default=20,
+                        help='Only used with --ollama_hedge_percentile. '
+                             'Number of requests that must complete before '
+                             'requests are hedged')
+    parser.add_argument('--ollama_coalesce', action='store_true',
+                        help='Only used if --ollama is a REST url. If set, '
+                             'identical requests, such as the same model and '
+                             'prompt listed twice in --ollama_prompts, share '
+                             'one request to Ollama and its result')
+    parser.add_argument('--ollama_keep_alive',
+                        help='If set, sent with every request to Ollama so '
+                             'models stay loaded this long after each '
+                             'request. Either a duration such as 30m or a '
+                             'number of seconds, where -1 keeps models '
+                             'loaded until Ollama exits. Used by REST agents '
+                             'and by --ollama_workers')
+    parser.add_argument('--ollama_warm_up', action='store_true',
+                        help='If set, each model in --ollama_prompts is '
+                             'loaded, on every REST url or ollama serve '
+                             'process, before any assembly is sent so the '
+                             'first assemblies do not pay the model load '
+                             'time')
+    parser.add_argument('--ollama_batch_size', type=int,
+                        help='Only used if --ollama is a REST url. If set, up '
+                             'to this many small assemblies are packed into one '
+                             'prompt with numbered sections. Assemblies whose '
+                             'section cannot be parsed are sent again on their '
+                             'own')
+    parser.add_argument('--ollama_batch_max_genes', type=int, default=10,
+                        help='Only used with --ollama_batch_size. Only '
+                             'assemblies with at most this many genes are '
+                             'packed together')
+    parser.add_argument('--ollama_order', choices=GeneSetAgentAnnotator.ORDERS,
+                        default=GeneSetAgentAnnotator.SIZE_ORDER,
+                        help='Order assemblies are sent to LLMs. size sends '
+                             'largest assemblies, which take longest, first. '
+                             'depth sends assemblies closest to root of '
+                             'hierarchy first, largest first within a level. '
+                             'hierarchy keeps order of nodes in hierarchy')
+    parser.add_argument('--ollama_max_requests', type=int,
+                        help='If set, at most this many assemblies, summed '
+                             'across all models, are sent to LLMs. Remaining '
+                             'assemblies are left unannotated')
+    parser.add_argument('--ollama_time_budget', type=float,
+                        help='If set, no new assemblies are sent to LLMs once '
+                             'this many seconds have passed since annotation '
+                             'started. Remaining assemblies are left '
+                             'unannotated')
+    parser.add_argument('--ollama_only_unenriched', action='store_true',
+                        help='If set, only assemblies without an accepted '
+                             'CORUM, GO_CC or HPA enrichment term are sent to '
+                             'LLMs. Other assemblies get empty LLM attributes')
+    parser.add_argument('--ollama_min_genes', type=int,
+                        help='If set, only assemblies with at least this many '
+                             'genes are sent to LLMs. Other assemblies get '
+                             'empty LLM attributes')
+    parser.add_argument('--ollama_top_n', type=int,
+                        help='If set, only this many assemblies with the most '
+                             'genes, after applying --ollama_only_unenriched '
+                             'and --ollama_min_genes, are sent to LLMs. Other '
+                             'assemblies get empty LLM attributes')
     parser.add_argument('--ollama_prompts', nargs='+',
                         help='Comma delimited value of format <MODEL NAME> or '
                              '<MODEL NAME>,<PROMPT> '
@@ -103,6 +223,29 @@ def _parse_arguments(desc, args):
     parser.add_argument('--skip_logging', action='store_true',
                         help='If set, output.log, error.log '
                              'files will not be created')
+    parser.add_argument('--perturbseq',
+                        help='Path to Perturb-seq table, comma delimited, or '
+                             'tab delimited if name ends with .tsv or .txt, '
+                             'with genes as rows. If set, similarity of gene '
+                             'pairs in each system is compared to pairs in '
+                             'different communities under root with a '
+                             'rank-sum test and results are added as '
+                             'PerturbSeq_* node attributes. Requires '
+                             'hierarchy in CX2 format')
+    parser.add_argument('--perturbseq_workers', type=int,
+                        help='If greater than 1, number of processes used '
+                             'for --perturbseq evaluation')
+    parser.add_argument('--perturbseq_rank', type=int,
+                        help='If set, approximate Perturb-seq similarity from '
+                             'profiles projected to this many dimensions via '
+                             'randomized SVD, for fast exploratory runs. '
+                             'Approximation error on a sample of gene pairs '
+                             'is written to the log')
+    parser.add_argument('--resume', action='store_true',
+                        help='If set and output directory exists, continue '
+                             'a previous run, only sending gene sets to LLMs '
+                             'that are not already in '
+                             'llm_annotation_checkpoint.jsonl')
     parser.add_argument('--logconf', default=None,
                         help='Path to python logging configuration file in '
                              'this format: https://docs.python.org/3/library/'
@@ -124,27 +267,89 @@ def _parse_arguments(desc, args):
 
 
 def get_ollama_geneset_agents(ollama=PATH_TO_OLLAMA, ollama_prompts=None,
-                              username=None, password=None):
+                              username=None, password=None,
+                              stream=False, stream_extra_tokens=None,
+                              num_workers=None, concurrency=None,
+                              max_concurrency=None, batch_size=None,
+                              batch_max_genes=None, structured_output=False,
+                              max_parse_retries=2, keep_alive=None,
+                              hedge_percentile=None, hedge_min_samples=20,
+                              coalesce=False):
     """
     Parses **ollama_prompts** from argparse and creates geneset agents
 
-    :param ollama: Path to ollama binary or REST service
+    :param ollama: Path to ollama binary or REST service. For REST
+                   service, multiple comma delimited urls can be set
     :type ollama: str
     :param ollama_prompts:
     :type ollama_prompts: list
+    :param stream: If ``True`` REST service agents stream responses
+    :type stream: bool
+    :param stream_extra_tokens: Number of tokens to read past the
+                                ``Confidence Score:`` line before closing
+                                stream. ``None`` means read full response
+    :type stream_extra_tokens: int
+    :param num_workers: If set, each command line agent starts its own
+                        ``ollama serve`` process with this many parallel
+                        slots instead of running ``ollama run`` per gene set
+    :type num_workers: int
+    :param concurrency: Number of requests REST agents keep in flight or
+                        starting number if **max_concurrency** is set
+    :type concurrency: int
+    :param max_concurrency: If set, REST agents adjust requests in flight
+                            between 1 and this value based on latency and
+                            server errors
+    :type max_concurrency: int
+    :param batch_size: If set, REST agents pack up to this many small
+                       gene sets into one prompt
+    :type batch_size: int
+    :param batch_max_genes: Only gene sets with at most this many genes
+                            are packed together
+    :type batch_max_genes: int
+    :param structured_output: If ``True`` REST agents ask for and
+                              validate JSON output
+    :type structured_output: bool
+    :param max_parse_retries: Number of times REST agents resend a gene
+                              set whose structured output fails validation
+    :type max_parse_retries: int
+    :param keep_alive: If set, sent with every request so models stay
+                       loaded this long. See :py:func:`get_keep_alive`
+    :type keep_alive: str
+    :param hedge_percentile: If set, REST agents duplicate requests still
+                             running after this percentile of observed
+                             latencies to another url
+    :type hedge_percentile: float
+    :param hedge_min_samples: Number of requests that must complete
+                              before REST agents hedge
+    :type hedge_min_samples: int
+    :param coalesce: If ``True`` REST agents share one
+                     :py:class:`~cellmaps_hierarchyeval.analysis.OllamaRequestCoalescer`
+                     so identical requests are only sent once
+    :type coalesce: bool
     :return:
     """
     if ollama_prompts is None:
         return None
+    keep_alive = get_keep_alive(keep_alive)
 
     res = []
     use_rest_service = False
+    endpoint_pool = None
+    concurrency_limiter = None
+    request_coalescer = None
     if ollama.startswith('http'):
         logger.info('For all agents, using ollama REST service: ' +
                     str(ollama))
-        if not ollama.endswith('api/generate'):
-            logger.warning(str(ollama) +
-                           ' does not end with api/generate and may not work.')
+        rest_urls = [url.strip() for url in ollama.split(',') if len(url.strip()) > 0]
+        for rest_url in rest_urls:
+            if not rest_url.endswith('api/generate'):
+                logger.warning(str(rest_url) +
+                               ' does not end with api/generate and may not work.')
+        endpoint_pool = OllamaEndpointPool(rest_urls=rest_urls)
+        concurrency_limiter = get_concurrency_limiter(concurrency=concurrency,
+                                                      max_concurrency=max_concurrency)
+        if coalesce is True:
+            request_coalescer = OllamaRequestCoalescer()
         use_rest_service = True
 
     for o_prompt in ollama_prompts:
@@ -156,16 +361,105 @@ def get_ollama_geneset_agents(ollama=PATH_TO_OLLAMA, ollama_prompts=None,
 
         logger.debug('Creating ollama geneset agent for model: ' + str(model))
         if use_rest_service is True:
-            agent = OllamaRestServiceGenesetAgent(rest_url=ollama, username=username,
+            agent = OllamaRestServiceGenesetAgent(endpoint_pool=endpoint_pool,
+                                                  concurrency_limiter=concurrency_limiter,
+                                                  batch_size=batch_size,
+                                                  batch_max_genes=batch_max_genes,
+                                                  structured_output=structured_output,
+                                                  max_parse_retries=max_parse_retries,
+                                                  keep_alive=keep_alive,
+                                                  hedge_percentile=hedge_percentile,
+                                                  hedge_min_samples=hedge_min_samples,
+                                                  request_coalescer=request_coalescer,
+                                                  username=username,
                                                   password=password,
-                                                  model=model, prompt=prompt)
+                                                  model=model, prompt=prompt,
+                                                  stream=stream,
+                                                  stream_extra_tokens=stream_extra_tokens)
         else:
             agent = OllamaCommandLineGeneSetAgent(ollama_binary=ollama,
-                                                  model=model, prompt=prompt)
+                                                  model=model, prompt=prompt,
+                                                  num_workers=num_workers,
+                                                  keep_alive=keep_alive)
         res.append(agent)
     return res
 
 
+def get_keep_alive(keep_alive=None):
+    """
+    Converts **keep_alive** from command line into value Ollama
+    accepts. Ollama only parses strings with a unit, such as ``30m``,
+    so plain numbers of seconds are converted to :py:class:`int`
+
+    :param keep_alive: Duration such as ``30m`` or number of seconds
+    :type keep_alive: str
+    :return: ``None`` if **keep_alive** is ``None``, otherwise number of
+             seconds or duration string
+    :rtype: int or str
+    """
+    if keep_alive is None:
+        return None
+    try:
+        return int(keep_alive)
+    except ValueError:
+        return keep_alive
+
+
+def get_node_selection_policies(only_unenriched=False, min_genes=None,
+                                top_n=None):
+    """
+    Creates policies that pick which assemblies are sent to LLMs
+
+    :param only_unenriched: If ``True`` only pick assemblies without an
+                            accepted enrichment term
+    :type only_unenriched: bool
+    :param min_genes: If set, only pick assemblies with at least this
+                      many genes
+    :type min_genes: int
+    :param top_n: If set, only pick this many assemblies with the most
+                  genes, applied last
+    :type top_n: int
+    :return: policies or ``None`` if all assemblies should be sent
+    :rtype: list
+    """
+    policies = []
+    if only_unenriched is True:
+        policies.append(UnenrichedNodeSelectionPolicy())
+    if min_genes is not None:
+        policies.append(MinimumSizeNodeSelectionPolicy(min_size=min_genes))
+    if top_n is not None:
+        policies.append(TopSizeNodeSelectionPolicy(top_n=top_n))
+    if len(policies) == 0:
+        return None
+    return policies
+
+
+def get_concurrency_limiter(concurrency=None, max_concurrency=None):
+    """
+    Creates limiter for requests in flight to REST service
+
+    :param concurrency: Fixed number of requests in flight or starting
+                        number if **max_concurrency** is set
+    :type concurrency: int
+    :param max_concurrency: If set, number of requests in flight is
+                            adjusted between 1 and this value
+    :type max_concurrency: int
+    :return: limiter or ``None`` if both parameters are ``None``
+    :rtype: :py:class:`~cellmaps_hierarchyeval.analysis.AdaptiveConcurrencyLimiter`
+    """
+    if concurrency is None and max_concurrency is None:
+        return None
+    if max_concurrency is None:
+        return AdaptiveConcurrencyLimiter(initial_limit=concurrency,
+                                          min_limit=concurrency,
+                                          max_limit=concurrency)
+    if concurrency is None:
+        concurrency = 1
+    return AdaptiveConcurrencyLimiter(initial_limit=concurrency,
+                                      min_limit=1,
+                                      max_limit=max_concurrency)
+
+
 def get_model_prompt_from_string(o_prompt):
     """
     Given argument from --ollama_prompts flag extract
@@ -238,8 +532,29 @@ def main(args):
         ollama_prompts = get_ollama_geneset_agents(ollama=theargs.ollama,
                                                    ollama_prompts=theargs.ollama_prompts,
                                                    username=theargs.ollama_user,
-                                                   password=theargs.ollama_password)
-
+                                                   password=theargs.ollama_password,
+                                                   stream=theargs.ollama_stream,
+                                                   stream_extra_tokens=theargs.ollama_stream_extra_tokens,
+                                                   num_workers=theargs.ollama_workers,
+                                                   concurrency=theargs.ollama_concurrency,
+                                                   max_concurrency=theargs.ollama_max_concurrency,
+                                                   batch_size=theargs.ollama_batch_size,
+                                                   batch_max_genes=theargs.ollama_batch_max_genes,
+                                                   structured_output=theargs.ollama_structured_output,
+                                                   max_parse_retries=theargs.ollama_parse_retries,
+                                                   keep_alive=theargs.ollama_keep_alive,
+                                                   hedge_percentile=theargs.ollama_hedge_percentile,
+                                                   hedge_min_samples=theargs.ollama_hedge_min_samples,
+                                                   coalesce=theargs.ollama_coalesce)
+
+        selection_policies = get_node_selection_policies(only_unenriched=theargs.ollama_only_unenriched,
+                                                         min_genes=theargs.ollama_min_genes,
+                                                         top_n=theargs.ollama_top_n)
+        geneset_annotator = GeneSetAgentAnnotator(order=theargs.ollama_order,
+                                                  max_requests=theargs.ollama_max_requests,
+                                                  time_budget=theargs.ollama_time_budget,
+                                                  selection_policies=selection_policies,
+                                                  warm_up=theargs.ollama_warm_up)
         return CellmapshierarchyevalRunner(outdir=theargs.outdir,
                                            max_fdr=theargs.max_fdr,
                                            min_jaccard_index=theargs.min_jaccard_index,
@@ -256,7 +571,12 @@ def main(args):
                                            skip_term_enrichment=theargs.skip_term_enrichment,
                                            skip_logging=theargs.skip_logging,
                                            input_data_dict=theargs.__dict__,
-                                           provenance=json_prov).run()
+                                           provenance=json_prov,
+                                           geneset_annotator=geneset_annotator,
+                                           resume=theargs.resume,
+                                           perturbseq=theargs.perturbseq,
+                                           perturbseq_workers=theargs.perturbseq_workers,
+                                           perturbseq_rank=theargs.perturbseq_rank).run()
     except Exception as e:
         logger.exception('Caught exception: ' + str(e))
         return 2
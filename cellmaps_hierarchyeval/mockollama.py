@@ -0,0 +1,539 @@
+import re
+import json
+import math
+import random
+import threading
+import time
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ndex2.cx2 import CX2Network
+from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
+from cellmaps_hierarchyeval.runner import CX2NetworkHelper
+from cellmaps_hierarchyeval.runner import GeneSetAgentAnnotator
+from cellmaps_hierarchyeval.runner import CellmapshierarchyevalRunner
+
+logger = logging.getLogger(__name__)
+
+
+class _MockOllamaRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests for :py:class:`MockOllamaServer`, which is
+    available as ``self.server.mock``
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug('Mock Ollama: ' + (format % args))
+
+    def _send_json(self, status_code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/api/version':
+            self._send_json(200, {'version': MockOllamaServer.VERSION})
+            return
+        self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            query = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            self._send_json(400, {'error': 'invalid JSON'})
+            return
+        if self.path.rstrip('/') != '/api/generate':
+            self._send_json(404, {'error': 'not found'})
+            return
+        self.server.mock._handle_generate(self, query)
+
+
+class MockOllamaServer(object):
+    """
+    Local stand in for Ollama REST service that implements
+    ``api/generate``, with and without streaming, and
+    ``api/version`` so annotation throughput, retries and
+    failover can be measured without a GPU.
+
+    Each response is a canned ``Process:`` and ``Confidence Score:``
+    output, delayed by a latency drawn from a configurable
+    distribution. A fraction of requests can be failed with
+    a server error. Batched prompts get one answer per section and
+    requests with a ``format`` schema get a JSON answer.
+
+    Example:
+
+    .. code-block:: python
+
+        server = MockOllamaServer(latency=0.5, error_rate=0.05)
+        server.start()
+        try:
+            agent = OllamaRestServiceGenesetAgent(rest_url=server.get_generate_url())
+        finally:
+            server.stop()
+    """
+
+    VERSION = '0.0.0-mock'
+
+    CONSTANT = 'constant'
+    UNIFORM = 'uniform'
+    EXPONENTIAL = 'exponential'
+    LOGNORMAL = 'lognormal'
+
+    LATENCY_DISTRIBUTIONS = [CONSTANT, UNIFORM, EXPONENTIAL, LOGNORMAL]
+    """
+    Supported latency distributions. ``uniform`` draws between 0 and
+    twice the mean, ``lognormal`` uses **latency_sigma** as sigma of
+    the underlying normal distribution
+    """
+
+    DEFAULT_OUTPUT = ('Process: Mock process {INDEX}\n'
+                      'Confidence Score: {CONFIDENCE}\n'
+                      'Mock analysis of gene set {INDEX}.\n')
+    """
+    Output used when no canned outputs are passed in. ``{INDEX}`` is
+    replaced with request number and ``{CONFIDENCE}`` with a random
+    score between 0.50 and 0.99
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 latency_distribution=CONSTANT, latency_sigma=0.5,
+                 token_latency=0.0, load_time=0.0, error_rate=0.0,
+                 error_status_code=503, outputs=None, seed=None):
+        """
+        Constructor
+
+        :param host: Address to listen on
+        :type host: str
+        :param port: Port to listen on. ``0`` picks a free port
+        :type port: int
+        :param latency: Mean time in seconds before first token of a
+                        response is sent
+        :type latency: float
+        :param latency_distribution: One of :py:const:`LATENCY_DISTRIBUTIONS`
+        :type latency_distribution: str
+        :param latency_sigma: Sigma for ``lognormal`` distribution
+        :type latency_sigma: float
+        :param token_latency: Time in seconds between tokens of a response
+        :type token_latency: float
+        :param load_time: Time in seconds paid by first request for each
+                          model, reported as ``load_duration``
+        :type load_time: float
+        :param error_rate: Fraction of ``api/generate`` requests, between
+                           0 and 1, that fail with **error_status_code**
+        :type error_rate: float
+        :param error_status_code: HTTP status code of failed requests
+        :type error_status_code: int
+        :param outputs: Canned outputs, one picked at random for each
+                        answer. Same placeholders as :py:const:`DEFAULT_OUTPUT`
+                        are replaced
+        :type outputs: list
+        :param seed: Seed for random number generator
+        :type seed: int
+        :raises CellmapshierarchyevalError: If **latency_distribution** is
+                                            not supported or **error_rate**
+                                            is not between 0 and 1
+        """
+        if latency_distribution not in MockOllamaServer.LATENCY_DISTRIBUTIONS:
+            raise CellmapshierarchyevalError('Invalid latency distribution: ' +
+                                             str(latency_distribution) +
+                                             ' must be one of ' +
+                                             str(MockOllamaServer.LATENCY_DISTRIBUTIONS))
+        if error_rate < 0 or error_rate > 1:
+            raise CellmapshierarchyevalError('error_rate must be between 0 and 1: ' +
+                                             str(error_rate))
+        self._host = host
+        self._port = port
+        self._latency = latency
+        self._latency_distribution = latency_distribution
+        self._latency_sigma = latency_sigma
+        self._token_latency = token_latency
+        self._load_time = load_time
+        self._error_rate = error_rate
+        self._error_status_code = error_status_code
+        self._outputs = outputs
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._loaded_models = set()
+        self._httpd = None
+        self._thread = None
+        self._requests = 0
+        self._errors = 0
+        self._in_flight = 0
+        self._max_in_flight = 0
+
+    def start(self):
+        """
+        Starts server in a background thread
+
+        :return: this server
+        :rtype: :py:class:`MockOllamaServer`
+        """
+        if self._httpd is not None:
+            return self
+        self._httpd = ThreadingHTTPServer((self._host, self._port),
+                                          _MockOllamaRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.mock = self
+        # short poll interval so stop() returns quickly
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        kwargs={'poll_interval': 0.05},
+                                        daemon=True)
+        self._thread.start()
+        logger.info('Started mock Ollama server at ' + self.get_generate_url())
+        return self
+
+    def stop(self):
+        """
+        Stops server
+        """
+        if self._httpd is None:
+            return
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+        self._httpd = None
+        self._thread = None
+
+    def get_base_url(self):
+        """
+        Gets base URL of running server
+
+        :return: URL such as ``http://127.0.0.1:12345``
+        :rtype: str
+        """
+        if self._httpd is None:
+            raise CellmapshierarchyevalError('Mock Ollama server is not running')
+        host, port = self._httpd.server_address[:2]
+        return 'http://' + str(host) + ':' + str(port)
+
+    def get_generate_url(self):
+        """
+        Gets URL of ``api/generate`` endpoint of running server
+
+        :return:
+        :rtype: str
+        """
+        return self.get_base_url() + '/api/generate'
+
+    def get_statistics(self):
+        """
+        Gets counts of ``api/generate`` requests received
+
+        :return: ``requests``, ``errors`` and ``max_in_flight``
+        :rtype: dict
+        """
+        with self._lock:
+            return {'requests': self._requests,
+                    'errors': self._errors,
+                    'max_in_flight': self._max_in_flight}
+
+    def _get_latency(self):
+        """
+        Draws latency, in seconds, from distribution passed
+        into constructor
+
+        :return:
+        :rtype: float
+        """
+        if self._latency <= 0:
+            return 0.0
+        with self._lock:
+            if self._latency_distribution == MockOllamaServer.UNIFORM:
+                return self._random.uniform(0, 2 * self._latency)
+            if self._latency_distribution == MockOllamaServer.EXPONENTIAL:
+                return self._random.expovariate(1.0 / self._latency)
+            if self._latency_distribution == MockOllamaServer.LOGNORMAL:
+                # pick mu so mean of distribution is latency
+                mu = math.log(self._latency) - (self._latency_sigma ** 2) / 2
+                return self._random.lognormvariate(mu, self._latency_sigma)
+        return self._latency
+
+    def _get_output(self, index):
+        """
+        Gets canned output with placeholders replaced
+
+        :param index: request number
+        :type index: int
+        :return:
+        :rtype: str
+        """
+        with self._lock:
+            if self._outputs is not None and len(self._outputs) > 0:
+                output = self._random.choice(self._outputs)
+            else:
+                output = MockOllamaServer.DEFAULT_OUTPUT
+            confidence = '{:.2f}'.format(self._random.uniform(0.5, 0.99))
+        return output.replace('{INDEX}', str(index)).replace('{CONFIDENCE}', confidence)
+
+    @staticmethod
+    def _to_structured_output(output):
+        """
+        Converts canned output into JSON object matching
+        schema used for structured output
+
+        :param output:
+        :type output: str
+        :return:
+        :rtype: str
+        """
+        process = re.search(r'Process:\s*(.*)', output)
+        confidence = re.search(r'Confidence Score:\s*([0-9.]+)', output)
+        return json.dumps({'process': process.group(1).strip() if process else '',
+                           'confidence': float(confidence.group(1)) if confidence else 0.0,
+                           'analysis': output})
+
+    def _get_response_text(self, query, index):
+        """
+        Builds text of answer to **query**
+
+        :param query: JSON payload sent to ``api/generate``
+        :type query: dict
+        :param index: request number
+        :type index: int
+        :return:
+        :rtype: str
+        """
+        prompt = query.get('prompt') or ''
+        sections = re.findall(r'^Section (\d+):', prompt, flags=re.MULTILINE)
+        if len(sections) > 0:
+            return ''.join('Section ' + s + '\n' + self._get_output(index) + '\n'
+                           for s in sections)
+        output = self._get_output(index)
+        if query.get('format') is not None:
+            return MockOllamaServer._to_structured_output(output)
+        return output
+
+    def _handle_generate(self, handler, query):
+        """
+        Answers ``api/generate`` request
+
+        :param handler: handler of request
+        :type handler: :py:class:`_MockOllamaRequestHandler`
+        :param query: JSON payload of request
+        :type query: dict
+        """
+        with self._lock:
+            self._requests += 1
+            index = self._requests
+            self._in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+            fail = self._error_rate > 0 and self._random.random() < self._error_rate
+            model = query.get('model')
+            cold_start = model not in self._loaded_models
+            self._loaded_models.add(model)
+        try:
+            if fail:
+                with self._lock:
+                    self._errors += 1
+                time.sleep(self._get_latency())
+                handler._send_json(self._error_status_code, {'error': 'mock error'})
+                return
+            start_time = time.time()
+            load_duration = 0
+            if cold_start and self._load_time > 0:
+                time.sleep(self._load_time)
+                load_duration = int(self._load_time * 1e9)
+            final_chunk = {'model': model, 'response': '', 'done': True,
+                           'load_duration': load_duration}
+            if not query.get('prompt'):
+                # ollama only loads model when prompt is empty
+                final_chunk['total_duration'] = int((time.time() - start_time) * 1e9)
+                handler._send_json(200, final_chunk)
+                return
+            time.sleep(self._get_latency())
+            tokens = re.findall(r'\S+\s*|\s+', self._get_response_text(query, index))
+            num_predict = query.get('options', {}).get('num_predict')
+            if num_predict is not None and num_predict >= 0:
+                tokens = tokens[:num_predict]
+            final_chunk['prompt_eval_count'] = len(query['prompt'].split())
+            final_chunk['eval_count'] = len(tokens)
+            if query.get('stream', True) is False:
+                time.sleep(self._token_latency * len(tokens))
+                final_chunk['response'] = ''.join(tokens)
+                final_chunk['eval_duration'] = int(self._token_latency * len(tokens) * 1e9)
+                final_chunk['total_duration'] = int((time.time() - start_time) * 1e9)
+                handler._send_json(200, final_chunk)
+                return
+            self._stream_tokens(handler, model, tokens, final_chunk, start_time)
+        except (BrokenPipeError, ConnectionResetError):
+            # client closed stream early
+            logger.debug('Client closed connection to mock Ollama server')
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _stream_tokens(self, handler, model, tokens, final_chunk, start_time):
+        """
+        Sends **tokens** as newline delimited JSON chunks using
+        chunked transfer encoding, followed by **final_chunk**
+
+        :param handler: handler of request
+        :type handler: :py:class:`_MockOllamaRequestHandler`
+        :param model: name of model
+        :type model: str
+        :param tokens: text of each chunk
+        :type tokens: list
+        :param final_chunk: last chunk, ``done`` set to ``True``
+        :type final_chunk: dict
+        :param start_time: time request was received
+        :type start_time: float
+        """
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/x-ndjson')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.end_headers()
+
+        def write_chunk(data):
+            line = json.dumps(data).encode('utf-8') + b'\n'
+            handler.wfile.write(('%x\r\n' % len(line)).encode('ascii') + line + b'\r\n')
+            handler.wfile.flush()
+
+        eval_start = time.time()
+        for token in tokens:
+            write_chunk({'model': model, 'response': token, 'done': False})
+            if self._token_latency > 0:
+                time.sleep(self._token_latency)
+        final_chunk['eval_duration'] = int((time.time() - eval_start) * 1e9)
+        final_chunk['total_duration'] = int((time.time() - start_time) * 1e9)
+        write_chunk(final_chunk)
+        handler.wfile.write(b'0\r\n\r\n')
+        handler.wfile.flush()
+
+
+def create_synthetic_hierarchy(num_levels=3, branching=3, min_genes=4,
+                               max_genes=12, seed=None):
+    """
+    Creates hierarchy with a single root where every node, apart
+    from leaves, has **branching** children. Leaves get between
+    **min_genes** and **max_genes** unique genes and every other node
+    gets all genes of its children, like a HiDeF hierarchy
+
+    :param num_levels: Number of levels below root
+    :type num_levels: int
+    :param branching: Number of children of each node
+    :type branching: int
+    :param min_genes: Fewest genes in a leaf
+    :type min_genes: int
+    :param max_genes: Most genes in a leaf
+    :type max_genes: int
+    :param seed: Seed for random number generator
+    :type seed: int
+    :return: hierarchy with ``CD_MemberList`` and ``CD_MemberList_Size``
+             set on every node
+    :rtype: :py:class:`~ndex2.cx2.CX2Network`
+    """
+    rand = random.Random(seed)
+    hierarchy = CX2Network()
+    gene_counter = [0]
+
+    def add_node(level):
+        node_id = hierarchy.add_node(attributes={'name': 'C' + str(len(hierarchy.get_nodes()))})
+        if level == num_levels:
+            genes = []
+            for _ in range(rand.randint(min_genes, max_genes)):
+                gene_counter[0] += 1
+                genes.append('GENE' + str(gene_counter[0]))
+        else:
+            genes = []
+            for _ in range(branching):
+                child_id, child_genes = add_node(level + 1)
+                hierarchy.add_edge(source=node_id, target=child_id)
+                genes.extend(child_genes)
+        hierarchy.set_node_attribute(node_id, 'CD_MemberList', ' '.join(genes))
+        hierarchy.set_node_attribute(node_id, 'CD_MemberList_Size', len(genes))
+        return node_id, genes
+
+    add_node(0)
+    return hierarchy
+
+
+class AnnotationLoadTest(object):
+    """
+    Drives :py:class:`~cellmaps_hierarchyeval.runner.GeneSetAgentAnnotator`
+    with a set of geneset agents against a hierarchy, usually one
+    from :py:func:`create_synthetic_hierarchy`, and reports
+    requests per second and latency percentiles
+    """
+
+    def __init__(self, geneset_agents=None, hierarchy=None,
+                 geneset_annotator=None):
+        """
+        Constructor
+
+        :param geneset_agents: agents to annotate hierarchy with
+        :type geneset_agents: list
+        :param hierarchy: hierarchy to annotate. If ``None``
+                          :py:func:`create_synthetic_hierarchy` is called
+                          with default values
+        :type hierarchy: :py:class:`~ndex2.cx2.CX2Network`
+        :param geneset_annotator: annotator to use. If ``None`` a
+                                  :py:class:`~cellmaps_hierarchyeval.runner.GeneSetAgentAnnotator`
+                                  with default values is used
+        :type geneset_annotator: :py:class:`~cellmaps_hierarchyeval.runner.GeneSetAgentAnnotator`
+        """
+        self._geneset_agents = geneset_agents
+        self._hierarchy = hierarchy
+        self._geneset_annotator = geneset_annotator
+
+    def get_hierarchy(self):
+        """
+        Gets hierarchy annotated by :py:meth:`run`
+
+        :return:
+        :rtype: :py:class:`~ndex2.cx2.CX2Network`
+        """
+        return self._hierarchy
+
+    def run(self):
+        """
+        Annotates hierarchy with all agents and closes them
+
+        :return: ``nodes`` in hierarchy, number of ``annotated`` (agent, node)
+                 pairs, total ``wall_time`` in seconds, ``requests`` made
+                 by all agents, ``requests_per_second`` and per agent call
+                 summary in ``calls``. See
+                 :py:meth:`~cellmaps_hierarchyeval.runner.CellmapshierarchyevalRunner._get_llm_call_summary`
+        :rtype: dict
+        """
+        if self._geneset_agents is None or len(self._geneset_agents) == 0:
+            raise CellmapshierarchyevalError('No geneset agents to load test')
+        if self._hierarchy is None:
+            self._hierarchy = create_synthetic_hierarchy()
+        annotator = self._geneset_annotator
+        if annotator is None:
+            annotator = GeneSetAgentAnnotator()
+        annotator.set_hierarchy_helper(CX2NetworkHelper(None))
+        start_time = time.time()
+        annotator.annotate_hierarchy_with_agents(geneset_agents=self._geneset_agents,
+                                                 hierarchy=self._hierarchy,
+                                                 close_agents=True)
+        wall_time = time.time() - start_time
+
+        annotated = 0
+        for agent in self._geneset_agents:
+            attr_name = agent.get_attribute_name_prefix() + '_process'
+            for node in self._hierarchy.get_nodes().values():
+                if node.get('v', {}).get(attr_name):
+                    annotated += 1
+        calls = []
+        num_requests = 0
+        for agent in self._geneset_agents:
+            call_metrics = agent.get_call_metrics()
+            num_requests += sum(1 + c.get('retries', 0) for c in call_metrics)
+            call_summary = CellmapshierarchyevalRunner._get_llm_call_summary(call_metrics)
+            if call_summary is None:
+                continue
+            call_summary['attribute_name_prefix'] = agent.get_attribute_name_prefix()
+            calls.append(call_summary)
+        return {'nodes': len(self._hierarchy.get_nodes()),
+                'annotated': annotated,
+                'wall_time': wall_time,
+                'requests': num_requests,
+                'requests_per_second': num_requests / wall_time if wall_time > 0 else None,
+                'calls': calls}
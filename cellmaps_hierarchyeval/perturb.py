@@ -1,22 +1,139 @@
+import os
 import logging
-import math
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from multiprocessing import util
+import numpy as np
 import pandas as pd
 from scipy import stats
+from scipy import sparse
 import cellmaps_utils.music_utils as music_utils
 from ndex2 import constants
 from scipy.stats import ranksums
 
 from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
+from cellmaps_hierarchyeval.perturbstore import PerturbSeqStore
 
 logger = logging.getLogger(__name__)
 
 
+class RootCommunityMembership(object):
+    """
+    Compact stand in for the dense gene by gene table returned by
+    :py:meth:`PerturbSeqAnalysis.get_root_gene_pair_similarities`. Stores
+    which communities directly connected to root each gene belongs to
+    as a sparse gene by community matrix, so memory grows with the
+    number of genes instead of its square. Two genes are related, a
+    score of 0 in the dense table, if they share a community.
+    """
+
+    def __init__(self, genes, membership):
+        """
+        Constructor
+
+        :param genes: Genes in root
+        :type genes: list
+        :param membership: genes by communities matrix with nonzero
+                           entries where gene is in community
+        :type membership: :py:class:`scipy.sparse.csr_matrix`
+        """
+        self._genes = pd.Index(genes)
+        self._membership = sparse.csr_matrix(membership, dtype=np.int32)
+
+    def get_genes(self):
+        """
+        Gets genes in order rows of membership matrix are stored
+
+        :return:
+        :rtype: :py:class:`pandas.Index`
+        """
+        return self._genes
+
+    def get_membership(self):
+        """
+        Gets genes by communities membership matrix
+
+        :return:
+        :rtype: :py:class:`scipy.sparse.csr_matrix`
+        """
+        return self._membership
+
+    def __len__(self):
+        return len(self._genes)
+
+    def subset(self, genes):
+        """
+        Gets membership restricted to **genes**, in the order given
+
+        :param genes: Genes to keep, all must be in :py:meth:`get_genes`
+        :type genes: list
+        :raises CellmapshierarchyevalError: If a gene is not in this membership
+        :return:
+        :rtype: :py:class:`RootCommunityMembership`
+        """
+        indices = self._genes.get_indexer(genes)
+        if (indices < 0).any():
+            raise CellmapshierarchyevalError('Genes not in root: ' +
+                                             str(list(np.asarray(genes)[indices < 0])[:10]))
+        return RootCommunityMembership(genes, self._membership[indices])
+
+    def get_related_block(self, row_start, row_end):
+        """
+        Gets whether genes in rows **row_start** to **row_end** share a
+        community with every gene
+
+        :param row_start: First row
+        :type row_start: int
+        :param row_end: Row after last row
+        :type row_end: int
+        :return: (row_end - row_start) by number of genes boolean array
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        shared = self._membership[row_start:row_end] @ self._membership.T
+        return shared.toarray() > 0
+
+    def to_pair_similarities(self):
+        """
+        Builds dense table in the format returned by
+        :py:meth:`PerturbSeqAnalysis.get_root_gene_pair_similarities`.
+        Only meant for small hierarchies
+
+        :return:
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        related = self.get_related_block(0, len(self._genes))
+        return pd.DataFrame(np.where(related, 0, 1), index=self._genes,
+                            columns=self._genes)
+
+
 class PerturbSeqAnalysis(object):
     """
     Contains utilities to compare Perturbation data
     against hierarchy passed in via constructor
     """
 
+    RANK_SUM_COLUMNS = ['num_pairs', 'statistic', 'p_value']
+    """
+    Columns of table returned by :py:meth:`compare_clusters_root_similarities`
+    """
+
+    PERMUTATION_COLUMNS = ['num_genes', 'mean_similarity', 'p_value']
+    """
+    Columns of table returned by :py:meth:`permutation_test_hierarchy_systems`
+    """
+
+    PERMUTATIONS_PER_TASK = 250
+    """
+    Number of random gene sets of one size drawn per task by
+    :py:meth:`permutation_test_hierarchy_systems`
+    """
+
+    PERMUTATION_BATCH_ELEMENTS = 2 ** 22
+    """
+    Upper bound on number of array elements in one batch of random gene
+    sets drawn by :py:meth:`permutation_test_hierarchy_systems`
+    """
+
     def __init__(self, hierarchy, hierarchy_parent=None):
         """
         Constructor
@@ -41,8 +158,10 @@ class PerturbSeqAnalysis(object):
 
         :param hier_system_node_id: node id system to analyze
         :type hier_system_node_id: int
-        :param perturbseq_df:
-        :type perturbseq_df: :py:class:`pandas.DataFrame`
+        :param perturbseq_df: If a :py:class:`~cellmaps_hierarchyeval.perturbstore.PerturbSeqStore`
+                              only rows of system genes and most variable columns are read
+        :type perturbseq_df: :py:class:`pandas.DataFrame` or
+                             :py:class:`~cellmaps_hierarchyeval.perturbstore.PerturbSeqStore`
         :param num_perturb_seq:
         :type num_perturb_seq: int
         :return: heat map table
@@ -50,6 +169,10 @@ class PerturbSeqAnalysis(object):
         """
         node_values = self._hierarchy.get_node(hier_system_node_id)
         assembly_genes = node_values[constants.ASPECT_VALUES]['CD_MemberList'].split(' ')
+        if isinstance(perturbseq_df, PerturbSeqStore):
+            data = perturbseq_df.get_data(genes=assembly_genes,
+                                          columns=perturbseq_df.get_top_variance_columns(num_perturb_seq))
+            return data.apply(stats.zscore, axis=1)
         cluster_genes_in_perturb = [x for x in assembly_genes if x in perturbseq_df.index.values]
 
         # from notebook but changed to match these variables
@@ -59,18 +182,113 @@ class PerturbSeqAnalysis(object):
         data = data.apply(stats.zscore, axis=1)
         return data
 
-    def get_root_gene_pair_similarities(self):
+    def get_heatmaps(self, perturbseq_df, node_ids=None, num_perturb_seq=25):
         """
-        Calculates similarity scores between gene pairs in the root node of a hierarchy. Genes in the same community
-        linked to the root node are marked with a similarity of 0, indicating they are directly related,
-        while all other pairs are set to 1, suggesting no direct relation.
+        Same as :py:meth:`get_heatmap_for_given_hierarchy_system` for every
+        node in **node_ids**, but most variable columns and row of each gene in
+        **perturbseq_df** are found once for all nodes
 
-        :return: A DataFrame with genes as both rows and columns, populated with similarity scores.
-        :rtype: :py:class:`pandas.DataFrame`
+        :param perturbseq_df: If a :py:class:`~cellmaps_hierarchyeval.perturbstore.PerturbSeqStore`
+                              only rows of genes in **node_ids** and most variable columns are read
+        :type perturbseq_df: :py:class:`pandas.DataFrame` or
+                             :py:class:`~cellmaps_hierarchyeval.perturbstore.PerturbSeqStore`
+        :param node_ids: Ids of nodes to create heat maps for. If ``None``
+                         every node in hierarchy is used
+        :type node_ids: list
+        :param num_perturb_seq:
+        :type num_perturb_seq: int
+        :raises CellmapshierarchyevalError: If **perturbseq_df** has duplicate gene names
+        :return: generator of (node id, heat map table)
+        :rtype: tuple
+        """
+        if not perturbseq_df.index.is_unique:
+            raise CellmapshierarchyevalError('Perturb-seq data has duplicate genes')
+        if node_ids is None:
+            node_ids = list(self._hierarchy.get_nodes().keys())
+        most_variable = PerturbSeqAnalysis._get_most_variable_columns(perturbseq_df, num_perturb_seq)
+        if isinstance(perturbseq_df, PerturbSeqStore):
+            genes = set()
+            for node_id in node_ids:
+                node_values = self._hierarchy.get_node(node_id)
+                genes.update(node_values[constants.ASPECT_VALUES]['CD_MemberList'].split(' '))
+            perturbseq_df = perturbseq_df.get_data(genes=sorted(genes), columns=most_variable)
+        values = perturbseq_df[most_variable].values
+        for node_id in node_ids:
+            node_values = self._hierarchy.get_node(node_id)
+            assembly_genes = node_values[constants.ASPECT_VALUES]['CD_MemberList'].split(' ')
+            gene_rows = perturbseq_df.index.get_indexer(assembly_genes)
+            gene_rows = gene_rows[gene_rows >= 0]
+            data = stats.zscore(values[gene_rows], axis=1)
+            yield node_id, pd.DataFrame(data, index=perturbseq_df.index[gene_rows],
+                                        columns=most_variable)
+
+    def write_heatmaps(self, perturbseq_df, outfile, node_ids=None, num_perturb_seq=25):
+        """
+        Writes heat maps from :py:meth:`get_heatmaps` to a single
+        compressed :py:func:`numpy.savez_compressed` file. For each
+        node ``<id>`` z-scores are stored under ``node_<id>`` and genes
+        under ``node_<id>_genes``. Columns, the same for all nodes, are
+        stored under ``columns``
+
+        :param perturbseq_df:
+        :type perturbseq_df: :py:class:`pandas.DataFrame`
+        :param outfile: Path to write to, ``.npz`` is appended if missing
+        :type outfile: str
+        :param node_ids: Ids of nodes to create heat maps for. If ``None``
+                         every node in hierarchy is used
+        :type node_ids: list
+        :param num_perturb_seq:
+        :type num_perturb_seq: int
+        :return: ids of nodes written
+        :rtype: list
+        """
+        arrays = {}
+        written = []
+        columns = None
+        for node_id, data in self.get_heatmaps(perturbseq_df, node_ids=node_ids,
+                                               num_perturb_seq=num_perturb_seq):
+            arrays['node_' + str(node_id)] = data.values
+            arrays['node_' + str(node_id) + '_genes'] = data.index.values.astype(str)
+            columns = data.columns
+            written.append(node_id)
+        if columns is None:
+            columns = PerturbSeqAnalysis._get_most_variable_columns(perturbseq_df, num_perturb_seq)
+        arrays['columns'] = columns.values.astype(str)
+        np.savez_compressed(outfile, **arrays)
+        return written
+
+    @staticmethod
+    def _get_most_variable_columns(perturbseq_df, num_perturb_seq):
+        """
+        Gets **num_perturb_seq** columns of **perturbseq_df** with highest variance
+
+        :param perturbseq_df:
+        :type perturbseq_df: :py:class:`pandas.DataFrame` or
+                             :py:class:`~cellmaps_hierarchyeval.perturbstore.PerturbSeqStore`
+        :return:
+        :rtype: :py:class:`pandas.Index`
+        """
+        if isinstance(perturbseq_df, PerturbSeqStore):
+            return perturbseq_df.get_top_variance_columns(num_perturb_seq)
+        return perturbseq_df.var().sort_values(ascending=False).head(num_perturb_seq).index
+
+    BLOCK_SIZE = 1024
+    """
+    Number of rows of similarity matrix processed at a time by
+    :py:meth:`get_root_functional_data_similarity`
+    """
+
+    def _get_root_genes_and_communities(self):
+        """
+        Gets genes of root node and ids of nodes directly
+        connected to root
+
+        :raises CellmapshierarchyevalError: If there is no root node
+        :return: (root genes, community node ids)
+        :rtype: tuple
         """
         root_node = None
         genes = []
-        # get pairs only in root node
         for nodeid, node in self._hierarchy.get_nodes().items():
             if node[constants.ASPECT_VALUES]['HCX::isRoot']:
                 root_node = nodeid
@@ -79,11 +297,52 @@ class PerturbSeqAnalysis(object):
         if root_node is None:
             raise CellmapshierarchyevalError('No root node detected!')
 
-        # Get nodes that are directly connected to root node
         communities_connected_to_root = []
         for edgeid, edge in self._hierarchy.get_edges().items():
             if edge[constants.EDGE_SOURCE] == root_node:
                 communities_connected_to_root.append(edge[constants.EDGE_TARGET])
+        return genes, communities_connected_to_root
+
+    def get_root_community_membership(self):
+        """
+        Same information as :py:meth:`get_root_gene_pair_similarities`
+        stored as a sparse gene by community matrix instead of a dense
+        gene by gene table. Can be passed in place of the dense table to
+        :py:meth:`get_root_overlapping_pair_similarities` and
+        :py:meth:`get_root_functional_data_similarity`
+
+        :raises CellmapshierarchyevalError: If there is no root node
+        :return:
+        :rtype: :py:class:`RootCommunityMembership`
+        """
+        genes, communities = self._get_root_genes_and_communities()
+        genes = pd.Index(genes).drop_duplicates()
+        rows = []
+        cols = []
+        for col, community in enumerate(communities):
+            community_node = self._hierarchy.get_node(community)
+            community_genes = community_node[constants.ASPECT_VALUES]['CD_MemberList'].split(' ')
+            indices = genes.get_indexer(community_genes)
+            indices = np.unique(indices[indices >= 0])
+            rows.append(indices)
+            cols.append(np.full(len(indices), col))
+        if len(rows) > 0:
+            rows = np.concatenate(rows)
+            cols = np.concatenate(cols)
+        membership = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                       shape=(len(genes), len(communities)))
+        return RootCommunityMembership(genes, membership)
+
+    def get_root_gene_pair_similarities(self):
+        """
+        Calculates similarity scores between gene pairs in the root node of a hierarchy. Genes in the same community
+        linked to the root node are marked with a similarity of 0, indicating they are directly related,
+        while all other pairs are set to 1, suggesting no direct relation.
+
+        :return: A DataFrame with genes as both rows and columns, populated with similarity scores.
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        genes, communities_connected_to_root = self._get_root_genes_and_communities()
 
         # Assign similarity scores
         root_pairs = pd.DataFrame(1, index=genes, columns=genes)
@@ -94,7 +353,7 @@ class PerturbSeqAnalysis(object):
         return root_pairs
 
     @staticmethod
-    def get_root_overlapping_pair_similarities(root_pairs, perturbseq_df):
+    def get_root_overlapping_pair_similarities(root_pairs, perturbseq_df, similarity_provider=None):
         """
         Get similarity scores from **perturbseq_df** that match genes attached to the root
         node of the hierarchy
@@ -102,45 +361,142 @@ class PerturbSeqAnalysis(object):
         :param root_pairs: A DataFrame representing similarity scores between all genes in the root node,
                             where genes within the same community connected to the root have a score of 0,
                             indicating direct relation, and all other pairs have a score of 1,
-                            indicating no direct relation.
-        :type root_pairs: :py:class:`pandas.DataFrame`
-        :param perturbseq_df:
-        :type perturbseq_df: :py:class:`pandas.DataFrame`
+                            indicating no direct relation. Can also be output of
+                            :py:meth:`get_root_community_membership`
+        :type root_pairs: :py:class:`pandas.DataFrame` or :py:class:`RootCommunityMembership`
+        :param perturbseq_df: If a :py:class:`~cellmaps_hierarchyeval.perturbstore.PerturbSeqStore`
+                              only rows of root genes are read
+        :type perturbseq_df: :py:class:`pandas.DataFrame` or
+                             :py:class:`~cellmaps_hierarchyeval.perturbstore.PerturbSeqStore`
+        :param similarity_provider: If set, used to compute scaled cosine similarity in blocks and
+                                    optionally cache it on disk, otherwise
+                                    :py:func:`cellmaps_utils.music_utils.cosine_similarity_scaled` is used
+        :type similarity_provider: :py:class:`~cellmaps_hierarchyeval.similarity.CosineSimilarityProvider`
         :return: A tuple containing:
              - A DataFrame of scaled cosine similarity scores for overlapping genes in communities direct to root
-                and Perturb-seq data.
-             - A DataFrame of root-associated similarity scores, filtered to only include overlapping genes.
+                and Perturb-seq data. Genes are sorted so the same input always gives the same matrix.
+             - A DataFrame of root-associated similarity scores, filtered to only include overlapping genes,
+               or a :py:class:`RootCommunityMembership` of the overlapping genes if **root_pairs**
+               is one
         :rtype: tuple
         """
-        overlap_genes = list(set(root_pairs.index.values).intersection(set(perturbseq_df.index.values)))
+        if isinstance(root_pairs, RootCommunityMembership):
+            root_genes = root_pairs.get_genes()
+        else:
+            root_genes = root_pairs.index
+        if isinstance(perturbseq_df, PerturbSeqStore):
+            perturbseq_df = perturbseq_df.get_data(genes=root_genes)
+        overlap_genes = sorted(set(root_genes.values).intersection(set(perturbseq_df.index.values)))
         overlap_functional_data = perturbseq_df.loc[overlap_genes]
-        functional_data_similarity = music_utils.cosine_similarity_scaled(overlap_functional_data)
-        overlap_root_pairs = root_pairs.loc[overlap_genes, overlap_genes]
+        if similarity_provider is None:
+            functional_data_similarity = music_utils.cosine_similarity_scaled(overlap_functional_data)
+        else:
+            functional_data_similarity = similarity_provider.get_similarity(overlap_functional_data)
+        if isinstance(root_pairs, RootCommunityMembership):
+            overlap_root_pairs = root_pairs.subset(overlap_genes)
+        else:
+            overlap_root_pairs = root_pairs.loc[overlap_genes, overlap_genes]
 
         return functional_data_similarity, overlap_root_pairs
 
     @staticmethod
-    def get_root_functional_data_similarity(functional_data_similarity, overlap_root_pairs):
+    def _get_unrelated_pair_masks(functional_data_similarity, overlap_root_pairs):
         """
-        Extracts and returns a list of functional similarity scores for gene pairs that are not in the same community,
+        Generator over blocks of :py:const:`BLOCK_SIZE` rows of
+        **functional_data_similarity** yielding which entries are
+        upper triangle, non-NaN pairs of genes not in the same community
+
+        :param functional_data_similarity:
+        :type functional_data_similarity: :py:class:`pandas.DataFrame`
+        :param overlap_root_pairs:
+        :type overlap_root_pairs: :py:class:`pandas.DataFrame` or :py:class:`RootCommunityMembership`
+        :return: (first row, row after last row, boolean mask) for each block
+        :rtype: tuple
+        """
+        values = functional_data_similarity.values
+        if isinstance(overlap_root_pairs, RootCommunityMembership):
+            membership = overlap_root_pairs.subset(functional_data_similarity.index)
+
+            def get_unrelated(row_start, row_end):
+                return ~membership.get_related_block(row_start, row_end)
+        else:
+            if not (overlap_root_pairs.index.equals(functional_data_similarity.index) and
+                    overlap_root_pairs.columns.equals(functional_data_similarity.columns)):
+                overlap_root_pairs = overlap_root_pairs.reindex(index=functional_data_similarity.index,
+                                                                columns=functional_data_similarity.columns)
+            root_values = overlap_root_pairs.values
+
+            def get_unrelated(row_start, row_end):
+                return root_values[row_start:row_end] > 0
+
+        columns = np.arange(values.shape[1])
+        for row_start in range(0, values.shape[0], PerturbSeqAnalysis.BLOCK_SIZE):
+            row_end = min(row_start + PerturbSeqAnalysis.BLOCK_SIZE, values.shape[0])
+            keep = get_unrelated(row_start, row_end)
+            # upper triangle only, diagonal excluded
+            keep &= columns[np.newaxis, :] > np.arange(row_start, row_end)[:, np.newaxis]
+            keep &= ~np.isnan(values[row_start:row_end])
+            yield row_start, row_end, keep
+
+    @staticmethod
+    def get_root_functional_data_similarity(functional_data_similarity, overlap_root_pairs,
+                                            sample_size=None, seed=None):
+        """
+        Extracts and returns functional similarity scores for gene pairs that are not in the same community,
             based on a filtered upper triangle extraction of the similarity matrix (ensures that only unique,
             non-redundant gene pair comparisons are considered).
 
+        The matrix is read in blocks of :py:const:`BLOCK_SIZE` rows, once to count the
+        scores and once to copy them into a preallocated array, so no gene by gene
+        copy or mask of the matrix is made.
+
         :param functional_data_similarity: A DataFrame of scaled cosine similarity scores for overlapping genes in
                                             communities direct to root and Perturb-seq data.
         :type functional_data_similarity: :py:class:`pandas.DataFrame`
         :param overlap_root_pairs: A DataFrame of root-associated similarity scores, filtered to only include
                                     overlapping genes. A score of 0 indicates a direct relation (same community)
-                                    and scores greater than 0 indicate no direct relation
-        :type overlap_root_pairs: :py:class:`pandas.DataFrame`
-        :return: A list of non-NaN similarity scores for gene pairs that are not directly related.
-        :rtype: list
+                                    and scores greater than 0 indicate no direct relation. Can also be a
+                                    :py:class:`RootCommunityMembership`
+        :type overlap_root_pairs: :py:class:`pandas.DataFrame` or :py:class:`RootCommunityMembership`
+        :param sample_size: If set and smaller than number of scores, only this many scores,
+                            chosen uniformly at random without replacement, are returned
+                            as an approximate null distribution
+        :type sample_size: int
+        :param seed: Seed for random number generator used when **sample_size** is set,
+                     so same scores are chosen on every call
+        :type seed: int
+        :raises CellmapshierarchyevalError: If **sample_size** is negative
+        :return: Non-NaN similarity scores for gene pairs that are not directly related, in row major
+                 upper triangle order
+        :rtype: :py:class:`numpy.ndarray`
         """
-        root_mask = overlap_root_pairs > 0
-        root_functional_data_similarity = [x for x in
-                                           music_utils.upper_tri_values(functional_data_similarity[root_mask]) if
-                                           not math.isnan(x)]
-        return root_functional_data_similarity
+        if sample_size is not None and sample_size < 0:
+            raise CellmapshierarchyevalError('sample_size must be 0 or larger: ' + str(sample_size))
+        values = functional_data_similarity.values
+        total = 0
+        for row_start, row_end, keep in PerturbSeqAnalysis._get_unrelated_pair_masks(functional_data_similarity,
+                                                                                     overlap_root_pairs):
+            total += int(np.count_nonzero(keep))
+
+        positions = None
+        if sample_size is not None and sample_size < total:
+            rng = np.random.default_rng(seed)
+            positions = np.sort(rng.choice(total, size=sample_size, replace=False))
+            result = np.empty(sample_size, dtype=values.dtype)
+        else:
+            result = np.empty(total, dtype=values.dtype)
+
+        offset = 0
+        for row_start, row_end, keep in PerturbSeqAnalysis._get_unrelated_pair_masks(functional_data_similarity,
+                                                                                     overlap_root_pairs):
+            block_values = values[row_start:row_end][keep]
+            if positions is None:
+                result[offset:offset + len(block_values)] = block_values
+            else:
+                lo, hi = np.searchsorted(positions, [offset, offset + len(block_values)])
+                result[lo:hi] = block_values[positions[lo:hi] - offset]
+            offset += len(block_values)
+        return result
 
     def get_cluster_similarity(self, functional_data_similarity, hier_system_node_id):
         """
@@ -188,3 +544,485 @@ class PerturbSeqAnalysis(object):
                                       alternative='greater')
 
         return statistic, p_value
+
+    def get_cluster_similarities(self, functional_data_similarity, node_ids=None):
+        """
+        Same as :py:meth:`get_cluster_similarity` for every node in
+        **node_ids**, but genes are looked up in the index of
+        **functional_data_similarity** once per node with a hash
+        lookup instead of a scan of the index per gene
+
+        :param functional_data_similarity: A DataFrame of scaled cosine similarity scores for overlapping genes in
+                                            communities direct to root and Perturb-seq data.
+        :type functional_data_similarity: :py:class:`pandas.DataFrame`
+        :param node_ids: Ids of nodes to get similarities for. If ``None``
+                         every node in hierarchy is used
+        :type node_ids: list
+        :return: node id => upper triangle similarity scores of cluster
+        :rtype: dict
+        """
+        if node_ids is None:
+            node_ids = list(self._hierarchy.get_nodes().keys())
+        index = functional_data_similarity.index
+        values = functional_data_similarity.values
+        cluster_similarities = {}
+        for node_id in node_ids:
+            node_values = self._hierarchy.get_node(node_id)
+            cluster_genes = node_values[constants.ASPECT_VALUES]['CD_MemberList'].split(' ')
+            gene_indices = index.get_indexer(cluster_genes)
+            gene_indices = gene_indices[gene_indices >= 0]
+            rows, cols = np.triu_indices(len(gene_indices), k=1)
+            cluster_similarities[node_id] = values[gene_indices[rows], gene_indices[cols]]
+        return cluster_similarities
+
+    @staticmethod
+    def compare_clusters_root_similarities(cluster_similarities, root_functional_data_similarity,
+                                           alternative='greater'):
+        """
+        Same rank-sum test as :py:meth:`compare_cluster_root_similarities`,
+        with identical results including ties, for many clusters at once.
+
+        Instead of ranking each cluster together with the root values,
+        root values are sorted once. The rank of each cluster value in
+        the combined data is then the number of smaller root values
+        plus half the number of equal root values, found by binary
+        search, plus its average rank within the cluster. Summed over a
+        cluster the within cluster ranks always add up to
+        ``n * (n + 1) / 2``, so only the binary searches depend on the data.
+
+        Clusters with no similarity scores or with ``NaN`` scores get
+        ``NaN`` statistic and p-value, as does every cluster if root
+        values contain ``NaN``
+
+        :param cluster_similarities: node id => similarity scores within
+                                     cluster, such as output of
+                                     :py:meth:`get_cluster_similarities`
+        :type cluster_similarities: dict
+        :param root_functional_data_similarity: Similarity scores for gene pairs not directly related
+                                                in the root.
+        :type root_functional_data_similarity: list
+        :param alternative: One of ``greater``, ``less`` or ``two-sided``
+        :type alternative: str
+        :raises CellmapshierarchyevalError: If **alternative** is invalid
+        :return: table indexed by node id with columns in
+                 :py:const:`RANK_SUM_COLUMNS`
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        if alternative not in ['greater', 'less', 'two-sided']:
+            raise CellmapshierarchyevalError('Invalid alternative: ' + str(alternative))
+        node_ids = list(cluster_similarities.keys())
+        root_values = np.sort(np.asarray(root_functional_data_similarity, dtype=np.float64))
+        n2 = len(root_values)
+        sizes = np.array([len(cluster_similarities[n]) for n in node_ids], dtype=np.int64)
+        statistic = np.full(len(node_ids), np.nan)
+        if len(node_ids) == 0 or np.sum(sizes) == 0 or np.isnan(root_values).any():
+            return PerturbSeqAnalysis._get_rank_sum_table(node_ids, sizes, statistic,
+                                                          statistic.copy())
+        all_values = np.concatenate([np.asarray(cluster_similarities[n], dtype=np.float64)
+                                     for n in node_ids])
+        left = np.searchsorted(root_values, all_values, side='left')
+        right = np.searchsorted(root_values, all_values, side='right')
+        # twice the rank contribution from root values to stay in integers
+        root_rank_twice = (left + right).astype(np.float64)
+        root_rank_twice[np.isnan(all_values)] = np.nan
+
+        non_empty = sizes > 0
+        offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))[non_empty]
+        n1 = sizes[non_empty].astype(np.float64)
+        rank_sums = np.add.reduceat(root_rank_twice, offsets) / 2.0 + n1 * (n1 + 1) / 2.0
+        expected = n1 * (n1 + n2 + 1) / 2.0
+        statistic[non_empty] = (rank_sums - expected) / np.sqrt(n1 * n2 * (n1 + n2 + 1) / 12.0)
+        if alternative == 'greater':
+            p_value = stats.norm.sf(statistic)
+        elif alternative == 'less':
+            p_value = stats.norm.cdf(statistic)
+        else:
+            p_value = 2 * stats.norm.sf(np.abs(statistic))
+        return PerturbSeqAnalysis._get_rank_sum_table(node_ids, sizes, statistic, p_value)
+
+    @staticmethod
+    def _get_rank_sum_table(node_ids, sizes, statistic, p_value):
+        """
+        Builds table returned by :py:meth:`compare_clusters_root_similarities`
+
+        :return:
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        table = pd.DataFrame({'num_pairs': sizes, 'statistic': statistic,
+                              'p_value': p_value},
+                             index=pd.Index(node_ids, name='node_id'),
+                             columns=PerturbSeqAnalysis.RANK_SUM_COLUMNS)
+        return table
+
+    def evaluate_hierarchy_systems(self, functional_data_similarity, root_functional_data_similarity,
+                                   node_ids=None):
+        """
+        Compares similarity scores of every system in hierarchy, or only
+        those in **node_ids**, against root gene pairs in a single
+        pass via :py:meth:`get_cluster_similarities` and
+        :py:meth:`compare_clusters_root_similarities`
+
+        :param functional_data_similarity: A DataFrame of scaled cosine similarity scores for overlapping genes in
+                                            communities direct to root and Perturb-seq data.
+        :type functional_data_similarity: :py:class:`pandas.DataFrame`
+        :param root_functional_data_similarity: A list of non-NaN similarity scores for gene pairs not directly related
+                                                in the root.
+        :type root_functional_data_similarity: list
+        :param node_ids: Ids of nodes to evaluate. If ``None`` every node
+                         in hierarchy is evaluated
+        :type node_ids: list
+        :return: table indexed by node id with columns in
+                 :py:const:`RANK_SUM_COLUMNS`
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        cluster_similarities = self.get_cluster_similarities(functional_data_similarity,
+                                                             node_ids=node_ids)
+        return PerturbSeqAnalysis.compare_clusters_root_similarities(cluster_similarities,
+                                                                     root_functional_data_similarity)
+
+    def evaluate_hierarchy_systems_parallel(self, functional_data_similarity, root_functional_data_similarity,
+                                            node_ids=None, num_workers=None):
+        """
+        Same as :py:meth:`evaluate_hierarchy_systems` with systems split
+        across **num_workers** processes.
+
+        Similarity matrix and sorted root scores are copied once into
+        :py:mod:`multiprocessing.shared_memory` that every worker maps
+        without copying. A similarity matrix memory mapped from a
+        ``.npy`` cache file is instead mapped from that file by each
+        worker. Workers are sent only the integer row indices
+        of each system's genes and return their part of the table,
+        which is merged in order of **node_ids**
+
+        :param functional_data_similarity: A DataFrame of scaled cosine similarity scores for overlapping genes in
+                                            communities direct to root and Perturb-seq data.
+        :type functional_data_similarity: :py:class:`pandas.DataFrame`
+        :param root_functional_data_similarity: Similarity scores for gene pairs not directly related
+                                                in the root.
+        :type root_functional_data_similarity: list
+        :param node_ids: Ids of nodes to evaluate. If ``None`` every node
+                         in hierarchy is evaluated
+        :type node_ids: list
+        :param num_workers: Number of processes, if ``None`` number of CPUs is used
+        :type num_workers: int
+        :raises CellmapshierarchyevalError: If **num_workers** is less than 1
+        :return: table indexed by node id with columns in
+                 :py:const:`RANK_SUM_COLUMNS`
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        if num_workers < 1:
+            raise CellmapshierarchyevalError('num_workers must be 1 or larger: ' + str(num_workers))
+        if node_ids is None:
+            node_ids = list(self._hierarchy.get_nodes().keys())
+        if len(node_ids) == 0:
+            return PerturbSeqAnalysis._get_rank_sum_table([], np.array([], dtype=np.int64),
+                                                          np.array([]), np.array([]))
+
+        index = functional_data_similarity.index
+        systems = []
+        for node_id in node_ids:
+            node_values = self._hierarchy.get_node(node_id)
+            cluster_genes = node_values[constants.ASPECT_VALUES]['CD_MemberList'].split(' ')
+            gene_indices = index.get_indexer(cluster_genes)
+            systems.append((node_id, gene_indices[gene_indices >= 0]))
+
+        # largest systems first, dealt round robin, to even out work per task
+        num_tasks = min(len(systems), num_workers * 4)
+        tasks = [[] for _ in range(num_tasks)]
+        for i, system in enumerate(sorted(systems, key=lambda x: len(x[1]), reverse=True)):
+            tasks[i % num_tasks].append(system)
+
+        tables = _map_with_shared_arrays(_evaluate_systems, tasks,
+                                         [functional_data_similarity.values,
+                                          np.sort(np.asarray(root_functional_data_similarity,
+                                                             dtype=np.float64))],
+                                         num_workers)
+        table = pd.concat(tables)
+        return table.loc[node_ids]
+
+    def permutation_test_hierarchy_systems(self, functional_data_similarity, node_ids=None,
+                                           num_permutations=1000, seed=0, num_workers=1):
+        """
+        Tests whether genes of each system are more similar to each other
+        than random gene sets of the same size.
+
+        Statistic is mean similarity of gene pairs within system. For every
+        system size, **num_permutations** random sets of that many genes
+        are drawn without replacement from genes in
+        **functional_data_similarity**, in batches of
+        :py:const:`PERMUTATIONS_PER_TASK` per task, and scored the same way
+        by integer indexing into the matrix. All systems of a size share
+        these draws. Empirical p-value is
+        ``(1 + number of random sets scoring at least as high) / (1 + num_permutations)``.
+
+        Random draws for a size and task come from a
+        :py:class:`numpy.random.SeedSequence` of **seed**, the size and the
+        task number, so results are the same for any **num_workers** and
+        any subset of **node_ids**
+
+        :param functional_data_similarity: A DataFrame of scaled cosine similarity scores for overlapping genes in
+                                            communities direct to root and Perturb-seq data.
+        :type functional_data_similarity: :py:class:`pandas.DataFrame`
+        :param node_ids: Ids of nodes to test. If ``None`` every node
+                         in hierarchy is tested
+        :type node_ids: list
+        :param num_permutations: Number of random gene sets per system size
+        :type num_permutations: int
+        :param seed: Seed for random gene sets
+        :type seed: int
+        :param num_workers: Number of processes, if greater than 1 similarity
+                            matrix is shared with them via :py:mod:`multiprocessing.shared_memory`
+        :type num_workers: int
+        :raises CellmapshierarchyevalError: If **num_permutations** or **num_workers** is less than 1
+        :return: table indexed by node id with columns in
+                 :py:const:`PERMUTATION_COLUMNS`. Systems with fewer than
+                 2 genes in **functional_data_similarity** get ``NaN``
+                 mean similarity and p-value
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        if num_permutations is None or num_permutations < 1:
+            raise CellmapshierarchyevalError('num_permutations must be 1 or larger: ' + str(num_permutations))
+        if num_workers is None or num_workers < 1:
+            raise CellmapshierarchyevalError('num_workers must be 1 or larger: ' + str(num_workers))
+        if node_ids is None:
+            node_ids = list(self._hierarchy.get_nodes().keys())
+
+        index = functional_data_similarity.index
+        values = functional_data_similarity.values
+        num_genes = np.zeros(len(node_ids), dtype=np.int64)
+        observed = np.full(len(node_ids), np.nan)
+        positions_by_size = {}
+        for position, node_id in enumerate(node_ids):
+            node_values = self._hierarchy.get_node(node_id)
+            cluster_genes = node_values[constants.ASPECT_VALUES]['CD_MemberList'].split(' ')
+            gene_indices = index.get_indexer(cluster_genes)
+            gene_indices = np.unique(gene_indices[gene_indices >= 0])
+            num_genes[position] = len(gene_indices)
+            if len(gene_indices) < 2:
+                continue
+            rows, cols = np.triu_indices(len(gene_indices), k=1)
+            observed[position] = np.mean(values[gene_indices[rows], gene_indices[cols]], dtype=np.float64)
+            positions_by_size.setdefault(len(gene_indices), []).append(position)
+
+        # checked once here rather than in every task
+        has_nan = bool(np.isnan(values).any())
+        tasks = []
+        for size in sorted(positions_by_size.keys()):
+            for task_index, start in enumerate(range(0, num_permutations,
+                                                     PerturbSeqAnalysis.PERMUTATIONS_PER_TASK)):
+                tasks.append((size, task_index,
+                              min(PerturbSeqAnalysis.PERMUTATIONS_PER_TASK, num_permutations - start),
+                              seed, has_nan))
+        if num_workers > 1 and len(tasks) > 1:
+            null_means = _map_with_shared_arrays(_get_shared_null_means, tasks, [values], num_workers)
+        else:
+            null_means = [_get_null_means(values, task) for task in tasks]
+
+        # random sets within rounding error of observed count as ties,
+        # same relative tolerance as scipy.stats.permutation_test, using
+        # precision of the matrix random sets are summed in
+        eps = np.finfo(values.dtype if np.issubdtype(values.dtype, np.floating) else np.float64).eps
+        threshold = observed - np.abs(observed) * eps * 100
+        exceeded = np.zeros(len(node_ids), dtype=np.int64)
+        for task, means in zip(tasks, null_means):
+            positions = positions_by_size[task[0]]
+            exceeded[positions] += np.sum(means[np.newaxis, :] >= threshold[positions][:, np.newaxis], axis=1)
+        p_value = np.where(np.isnan(observed), np.nan, (1.0 + exceeded) / (1.0 + num_permutations))
+        return pd.DataFrame({'num_genes': num_genes, 'mean_similarity': observed,
+                             'p_value': p_value},
+                            index=pd.Index(node_ids, name='node_id'),
+                            columns=PerturbSeqAnalysis.PERMUTATION_COLUMNS)
+
+
+_shared_arrays = []
+"""
+(shared memory block or ``None`` if memory mapped from file, array)
+attached by :py:func:`_attach_shared_arrays` in each worker of
+:py:meth:`PerturbSeqAnalysis.evaluate_hierarchy_systems_parallel`
+"""
+
+
+def _get_npy_path(array):
+    """
+    Gets ``.npy`` file **array** is a read only memory map of, such
+    as a cached similarity matrix from
+    :py:class:`~cellmaps_hierarchyeval.similarity.CosineSimilarityProvider`,
+    possibly wrapped in views by :py:class:`pandas.DataFrame`
+
+    :param array:
+    :type array: :py:class:`numpy.ndarray`
+    :return: path or ``None`` if **array** is not the whole of such a map
+    :rtype: str
+    """
+    # outermost memory map is the one covering the whole file
+    mapped = None
+    base = array
+    while isinstance(base, np.ndarray):
+        if isinstance(base, np.memmap):
+            mapped = base
+        base = base.base
+    if mapped is None or mapped.mode != 'r' or mapped.filename is None:
+        return None
+    if not str(mapped.filename).endswith('.npy'):
+        return None
+    if (mapped.shape != array.shape or mapped.dtype != array.dtype or
+            mapped.strides != array.strides or
+            mapped.__array_interface__['data'][0] != array.__array_interface__['data'][0]):
+        return None
+    # same layout workers get from np.load
+    loaded = np.load(mapped.filename, mmap_mode='r')
+    if (loaded.shape != mapped.shape or loaded.dtype != mapped.dtype or
+            loaded.strides != mapped.strides or loaded.offset != mapped.offset):
+        return None
+    return str(mapped.filename)
+
+
+def _map_with_shared_arrays(func, tasks, arrays, num_workers):
+    """
+    Copies **arrays** into shared memory once, then runs **func** on each
+    of **tasks** in up to **num_workers** processes that read arrays via
+    :py:func:`_attach_shared_arrays`. Arrays memory mapped read only from
+    a ``.npy`` file are not copied, workers map the file instead.
+    Shared memory is freed when done
+
+    :param func: Module level function taking a task
+    :type func: callable
+    :param tasks: Tasks to run
+    :type tasks: list
+    :param arrays: Arrays to share
+    :type arrays: list
+    :param num_workers: Number of processes
+    :type num_workers: int
+    :return: Results in order of **tasks**
+    :rtype: list
+    """
+    shared = []
+    try:
+        specs = []
+        for array in arrays:
+            path = _get_npy_path(array)
+            if path is not None:
+                specs.append((None, array.shape, array.dtype.str, path))
+                continue
+            array = np.asarray(array)
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared.append(shm)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            specs.append((shm.name, array.shape, array.dtype.str, None))
+
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(tasks)),
+                                 initializer=_attach_shared_arrays,
+                                 initargs=(specs,)) as executor:
+            return list(executor.map(func, tasks))
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+
+def _attach_shared_arrays(specs):
+    """
+    Attaches to shared memory blocks, or memory maps ``.npy`` files,
+    holding similarity matrix and sorted root scores. Blocks are
+    closed by :py:func:`_detach_shared_arrays` when worker exits
+
+    :param specs: (shared memory name, shape, dtype, ``.npy`` path) of each
+                  array. Only one of name and path is set
+    :type specs: list
+    """
+    del _shared_arrays[:]
+    for name, shape, dtype, path in specs:
+        if path is not None:
+            _shared_arrays.append((None, np.load(path, mmap_mode='r')))
+            continue
+        shm = shared_memory.SharedMemory(name=name)
+        _shared_arrays.append((shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)))
+    # unlike atexit, also run when a forked worker exits
+    util.Finalize(None, _detach_shared_arrays, exitpriority=0)
+
+
+def _detach_shared_arrays():
+    """
+    Closes shared memory blocks attached by :py:func:`_attach_shared_arrays`
+    """
+    shared = [shm for shm, _ in _shared_arrays]
+    # arrays must be released before their buffers are closed
+    del _shared_arrays[:]
+    for shm in shared:
+        if shm is not None:
+            shm.close()
+
+
+def _evaluate_systems(systems):
+    """
+    Runs rank-sum test for **systems** against arrays attached by
+    :py:func:`_attach_shared_arrays`
+
+    :param systems: (node id, row indices of genes) for each system
+    :type systems: list
+    :return: table in format of :py:meth:`PerturbSeqAnalysis.compare_clusters_root_similarities`
+    :rtype: :py:class:`pandas.DataFrame`
+    """
+    values = _shared_arrays[0][1]
+    root_values = _shared_arrays[1][1]
+    cluster_similarities = {}
+    for node_id, gene_indices in systems:
+        rows, cols = np.triu_indices(len(gene_indices), k=1)
+        cluster_similarities[node_id] = values[gene_indices[rows], gene_indices[cols]]
+    return PerturbSeqAnalysis.compare_clusters_root_similarities(cluster_similarities, root_values)
+
+
+def _get_null_means(values, task):
+    """
+    Draws random gene sets and gets mean similarity of gene pairs
+    within each set
+
+    :param values: genes by genes similarity matrix
+    :type values: :py:class:`numpy.ndarray`
+    :param task: (genes per set, task number, number of sets, seed,
+                 ``True`` if **values** has ``NaN``)
+    :type task: tuple
+    :return: mean similarity of each random set
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    num_genes, task_index, num_permutations, seed, has_nan = task
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(num_genes, task_index)))
+    total_genes = values.shape[0]
+    num_pairs = num_genes * (num_genes - 1) // 2
+    # for large sets, summing the submatrix of each set as a matrix
+    # product with set membership indicators beats gathering its pairs
+    use_product = num_pairs * 64 > total_genes * total_genes and not has_nan
+    if use_product:
+        diagonal = np.diagonal(values).astype(np.float64)
+        batch_size = max(1, PerturbSeqAnalysis.PERMUTATION_BATCH_ELEMENTS // total_genes)
+    else:
+        rows, cols = np.triu_indices(num_genes, k=1)
+        batch_size = max(1, PerturbSeqAnalysis.PERMUTATION_BATCH_ELEMENTS // max(total_genes, num_pairs))
+    means = np.empty(num_permutations)
+    for start in range(0, num_permutations, batch_size):
+        end = min(start + batch_size, num_permutations)
+        # positions of the num_genes smallest of uniform random keys
+        # are a uniform random set drawn without replacement
+        genes = np.argpartition(rng.random((end - start, total_genes)), num_genes - 1,
+                                axis=1)[:, :num_genes]
+        if use_product:
+            # same type as matrix so it is not converted for every batch,
+            # per set totals are then accumulated in float64
+            members = np.zeros((end - start, total_genes), dtype=values.dtype)
+            np.put_along_axis(members, genes, 1, axis=1)
+            totals = np.einsum('ij,ij->i', members @ values, members, dtype=np.float64)
+            # similarity is symmetric so pairs above diagonal are half of off diagonal total
+            means[start:end] = (totals - members @ diagonal) / 2.0 / num_pairs
+        else:
+            means[start:end] = values[genes[:, rows], genes[:, cols]].mean(axis=1, dtype=np.float64)
+    return means
+
+
+def _get_shared_null_means(task):
+    """
+    Same as :py:func:`_get_null_means` using similarity matrix
+    attached by :py:func:`_attach_shared_arrays`
+    """
+    return _get_null_means(_shared_arrays[0][1], task)
@@ -0,0 +1,250 @@
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
+
+logger = logging.getLogger(__name__)
+
+
+class PerturbSeqStore(object):
+    """
+    Perturb-seq table stored on disk so only requested gene rows and
+    columns are read into memory.
+
+    A store is a directory holding a genes by columns ``.npy`` matrix,
+    which is memory mapped, and the gene and column names as text files,
+    one per line. Use :py:meth:`from_csv` or :py:meth:`from_dataframe` to
+    create one. Can be passed in place of a Perturb-seq DataFrame to
+    :py:meth:`~cellmaps_hierarchyeval.perturb.PerturbSeqAnalysis.get_root_overlapping_pair_similarities`
+    and :py:meth:`~cellmaps_hierarchyeval.perturb.PerturbSeqAnalysis.get_heatmaps`
+    """
+
+    VALUES_FILE = 'values.npy'
+    GENES_FILE = 'genes.txt'
+    COLUMNS_FILE = 'columns.txt'
+
+    def __init__(self, path, chunk_rows=10000):
+        """
+        Constructor
+
+        :param path: Directory of store
+        :type path: str
+        :param chunk_rows: Number of rows read at a time when
+                           computing column variances or reading data
+        :type chunk_rows: int
+        :raises CellmapshierarchyevalError: If **path** is not a store
+        """
+        for name in [PerturbSeqStore.VALUES_FILE, PerturbSeqStore.GENES_FILE,
+                     PerturbSeqStore.COLUMNS_FILE]:
+            if not os.path.isfile(os.path.join(path, name)):
+                raise CellmapshierarchyevalError(str(path) + ' is not a Perturb-seq store, missing ' + name)
+        self._path = path
+        self._chunk_rows = chunk_rows
+        self._values = np.load(os.path.join(path, PerturbSeqStore.VALUES_FILE), mmap_mode='r')
+        self._genes = pd.Index(PerturbSeqStore._read_names(os.path.join(path, PerturbSeqStore.GENES_FILE)))
+        self._columns = pd.Index(PerturbSeqStore._read_names(os.path.join(path, PerturbSeqStore.COLUMNS_FILE)))
+        if self._values.shape != (len(self._genes), len(self._columns)):
+            raise CellmapshierarchyevalError('Shape of ' + PerturbSeqStore.VALUES_FILE + ' ' +
+                                             str(self._values.shape) + ' does not match ' +
+                                             str(len(self._genes)) + ' genes and ' +
+                                             str(len(self._columns)) + ' columns')
+        if not self._genes.is_unique:
+            raise CellmapshierarchyevalError('Perturb-seq store has duplicate genes')
+        self._variances = None
+
+    @staticmethod
+    def _read_names(path):
+        """
+        Reads one name per line from **path**
+
+        :return:
+        :rtype: list
+        """
+        with open(path, 'r') as f:
+            return [line.rstrip('\n') for line in f]
+
+    @staticmethod
+    def _write_names(path, names):
+        """
+        Writes **names** to **path** one per line
+        """
+        with open(path, 'w') as f:
+            for name in names:
+                f.write(str(name) + '\n')
+
+    @staticmethod
+    def from_dataframe(df, path, dtype=np.float32):
+        """
+        Creates store in **path** from **df**
+
+        :param df: Perturb-seq table with genes as rows
+        :type df: :py:class:`pandas.DataFrame`
+        :param path: Directory to write store to, created if needed
+        :type path: str
+        :param dtype: Type values are stored as
+        :type dtype: :py:class:`numpy.dtype`
+        :return:
+        :rtype: :py:class:`PerturbSeqStore`
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, PerturbSeqStore.VALUES_FILE), df.values.astype(dtype))
+        PerturbSeqStore._write_names(os.path.join(path, PerturbSeqStore.GENES_FILE), df.index.values)
+        PerturbSeqStore._write_names(os.path.join(path, PerturbSeqStore.COLUMNS_FILE), df.columns.values)
+        return PerturbSeqStore(path)
+
+    @staticmethod
+    def from_csv(csv_path, path, sep=',', dtype=np.float32, chunksize=10000):
+        """
+        Creates store in **path** from delimited file **csv_path**, with
+        genes as rows and gene names in first column, reading
+        **chunksize** rows at a time so the table is never fully
+        in memory
+
+        :param csv_path: Perturb-seq table
+        :type csv_path: str
+        :param path: Directory to write store to, created if needed
+        :type path: str
+        :param sep: Delimiter
+        :type sep: str
+        :param dtype: Type values are stored as
+        :type dtype: :py:class:`numpy.dtype`
+        :param chunksize: Number of rows read at a time
+        :type chunksize: int
+        :return:
+        :rtype: :py:class:`PerturbSeqStore`
+        """
+        columns = pd.read_csv(csv_path, sep=sep, index_col=0, nrows=0).columns
+        num_rows = 0
+        for chunk in pd.read_csv(csv_path, sep=sep, usecols=[0], chunksize=chunksize):
+            num_rows += len(chunk)
+
+        os.makedirs(path, exist_ok=True)
+        values = np.lib.format.open_memmap(os.path.join(path, PerturbSeqStore.VALUES_FILE), mode='w+',
+                                           dtype=dtype, shape=(num_rows, len(columns)))
+        genes = []
+        offset = 0
+        for chunk in pd.read_csv(csv_path, sep=sep, index_col=0, chunksize=chunksize):
+            values[offset:offset + len(chunk)] = chunk.values
+            genes.extend(chunk.index.values)
+            offset += len(chunk)
+        values.flush()
+        del values
+        PerturbSeqStore._write_names(os.path.join(path, PerturbSeqStore.GENES_FILE), genes)
+        PerturbSeqStore._write_names(os.path.join(path, PerturbSeqStore.COLUMNS_FILE), columns.values)
+        logger.debug('Wrote ' + str(num_rows) + ' by ' + str(len(columns)) +
+                     ' Perturb-seq store to ' + str(path))
+        return PerturbSeqStore(path)
+
+    @property
+    def index(self):
+        """
+        Genes in store, named like :py:attr:`pandas.DataFrame.index`
+        so store can be used where only gene names are needed
+
+        :return:
+        :rtype: :py:class:`pandas.Index`
+        """
+        return self._genes
+
+    @property
+    def columns(self):
+        """
+        Columns in store
+
+        :return:
+        :rtype: :py:class:`pandas.Index`
+        """
+        return self._columns
+
+    @property
+    def shape(self):
+        """
+        (number of genes, number of columns)
+
+        :return:
+        :rtype: tuple
+        """
+        return self._values.shape
+
+    def get_column_variances(self):
+        """
+        Gets sample variance of each column, skipping ``NaN`` values,
+        same as :py:meth:`pandas.DataFrame.var`. Computed in one pass over
+        blocks of rows, merging per block mean and sum of squared
+        deviations, and kept for later calls
+
+        :return:
+        :rtype: :py:class:`pandas.Series`
+        """
+        if self._variances is not None:
+            return self._variances
+        num_columns = len(self._columns)
+        count = np.zeros(num_columns)
+        mean = np.zeros(num_columns)
+        sum_squares = np.zeros(num_columns)
+        for row_start in range(0, len(self._genes), self._chunk_rows):
+            block = np.asarray(self._values[row_start:row_start + self._chunk_rows], dtype=np.float64)
+            present = ~np.isnan(block)
+            block_count = present.sum(axis=0).astype(np.float64)
+            block_mean = np.where(present, block, 0.0).sum(axis=0) / np.maximum(block_count, 1)
+            block_sum_squares = np.where(present, (block - block_mean) ** 2, 0.0).sum(axis=0)
+            total = count + block_count
+            delta = block_mean - mean
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.where(total > 0, mean + delta * block_count / total, 0.0)
+                sum_squares = np.where(total > 0, sum_squares + block_sum_squares +
+                                       delta ** 2 * count * block_count / total, 0.0)
+            count = total
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variances = np.where(count > 1, sum_squares / (count - 1), np.nan)
+        self._variances = pd.Series(variances, index=self._columns)
+        return self._variances
+
+    def get_top_variance_columns(self, num_columns):
+        """
+        Gets **num_columns** columns with highest variance, in same
+        order as :py:meth:`~cellmaps_hierarchyeval.perturb.PerturbSeqAnalysis.get_heatmap_for_given_hierarchy_system`
+
+        :param num_columns:
+        :type num_columns: int
+        :return:
+        :rtype: :py:class:`pandas.Index`
+        """
+        return self.get_column_variances().sort_values(ascending=False).head(num_columns).index
+
+    def get_data(self, genes=None, columns=None):
+        """
+        Reads rows of **genes** and **columns** into memory. Genes not
+        in store are skipped
+
+        :param genes: Genes to read, if ``None`` all genes are read
+        :type genes: list
+        :param columns: Columns to read, if ``None`` all columns are read
+        :type columns: list
+        :raises CellmapshierarchyevalError: If a column is not in store
+        :return: Table with rows in order of **genes**
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        if genes is None:
+            rows = np.arange(len(self._genes))
+        else:
+            rows = self._genes.get_indexer(pd.Index(genes).drop_duplicates())
+            rows = rows[rows >= 0]
+        if columns is None:
+            cols = np.arange(len(self._columns))
+        else:
+            cols = self._columns.get_indexer(columns)
+            if (cols < 0).any():
+                raise CellmapshierarchyevalError('Columns not in Perturb-seq store: ' +
+                                                 str(list(np.asarray(columns)[cols < 0])[:10]))
+        # read rows in file order so memory map is read sequentially,
+        # gathering only requested columns of a block of rows at a time
+        order = np.argsort(rows, kind='stable')
+        values = np.empty((len(rows), len(cols)), dtype=self._values.dtype)
+        for start in range(0, len(order), self._chunk_rows):
+            block = order[start:start + self._chunk_rows]
+            values[block] = self._values[np.ix_(rows[block], cols)]
+        return pd.DataFrame(values, index=self._genes[rows], columns=self._columns[cols])
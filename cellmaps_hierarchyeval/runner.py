@@ -1,10 +1,14 @@
 #! /usr/bin/env python
 import os
+import re
 import logging
 import shutil
 import time
 import json
 import numpy as np
+import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import date
 from tqdm import tqdm
 
@@ -19,6 +23,9 @@ from cellmaps_utils import logutils
 from cellmaps_utils.provenance import ProvenanceUtil
 import cellmaps_hierarchyeval
 from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
+from cellmaps_hierarchyeval.perturb import PerturbSeqAnalysis
+from cellmaps_hierarchyeval.perturbstore import PerturbSeqStore
+from cellmaps_hierarchyeval.similarity import LowRankCosineSimilarityProvider
 
 
 logger = logging.getLogger(__name__)
@@ -458,6 +465,34 @@ class CX2NetworkHelper(BaseNetworkHelper):
         """
         return hierarchy.get_nodes()
 
+    @staticmethod
+    def get_node_attribute_value(hierarchy, node_id, attribute_name):
+        """
+        Retrieve value of a node attribute.
+
+        :param hierarchy: The hierarchy containing the node.
+        :type hierarchy: CX2Network
+        :param node_id: Id of node
+        :type node_id: int
+        :param attribute_name: Name of attribute
+        :type attribute_name: str
+        :return: Value of attribute or ``None`` if not set
+        """
+        return hierarchy.get_node(node_id).get('v', {}).get(attribute_name)
+
+    @staticmethod
+    def get_edges(hierarchy):
+        """
+        Retrieve the edges from the hierarchy as (parent, child)
+        node id tuples
+
+        :param hierarchy: The hierarchy from which to retrieve edges.
+        :type hierarchy: CX2Network
+        :return: (source node id, target node id) tuples
+        :rtype: list
+        """
+        return [(edge['s'], edge['t']) for edge in hierarchy.get_edges().values()]
+
     @staticmethod
     def write_as_nodelist(hierarchy, dest_path):
         """
@@ -583,6 +618,37 @@ class NiceCXNetworkHelper(BaseNetworkHelper):
         """
         return hierarchy.nodes
 
+    @staticmethod
+    def get_node_attribute_value(hierarchy, node_id, attribute_name):
+        """
+        Retrieve value of a node attribute.
+
+        :param hierarchy: The hierarchy containing the node.
+        :type hierarchy: ndex2.nice_cx_network.NiceCXNetwork
+        :param node_id: Id of node
+        :type node_id: int
+        :param attribute_name: Name of attribute
+        :type attribute_name: str
+        :return: Value of attribute or ``None`` if not set
+        """
+        attr = hierarchy.get_node_attribute(node_id, attribute_name)
+        if attr is None:
+            return None
+        return attr['v']
+
+    @staticmethod
+    def get_edges(hierarchy):
+        """
+        Retrieve the edges from the hierarchy as (parent, child)
+        node id tuples
+
+        :param hierarchy: The hierarchy from which to retrieve edges.
+        :type hierarchy: ndex2.nice_cx_network.NiceCXNetwork
+        :return: (source node id, target node id) tuples
+        :rtype: list
+        """
+        return [(edge['s'], edge['t']) for edge in hierarchy.edges.values()]
+
     @staticmethod
     def write_as_nodelist(hierarchy, dest_path):
         """
@@ -608,18 +674,248 @@ class NiceCXNetworkHelper(BaseNetworkHelper):
                 f.write('\n')
 
 
+class NodeSelectionPolicy(object):
+    """
+    Picks which nodes of a hierarchy are sent to
+    :py:class:`~cellmaps_hierarchyeval.analysis.GenesetAgent` objects
+    by :py:class:`GeneSetAgentAnnotator`. This base implementation
+    selects every node
+    """
+
+    def select(self, hierarchy=None, hierarchy_helper=None, candidates=None):
+        """
+        Selects nodes to annotate
+
+        :param hierarchy:
+        :param hierarchy_helper:
+        :type hierarchy_helper: :py:class:`CX2NetworkHelper` or :py:class:`NiceCXNetworkHelper`
+        :param candidates: (node id, gene names) tuples
+        :type candidates: list
+        :return: (node id, gene names) tuples that should be annotated
+        :rtype: list
+        """
+        return candidates
+
+
+class UnenrichedNodeSelectionPolicy(NodeSelectionPolicy):
+    """
+    Selects nodes without an accepted enrichment term, ie nodes
+    whose ``<TERM NAME>_terms`` attribute is unset or empty for
+    every term name
+    """
+
+    def __init__(self, term_names=None):
+        """
+        Constructor
+
+        :param term_names: Names of enrichment terms to check. If ``None``
+                           ``CORUM``, ``GO_CC`` and ``HPA`` are used
+        :type term_names: list
+        """
+        if term_names is None:
+            term_names = ['CORUM', 'GO_CC', 'HPA']
+        self._term_names = term_names
+
+    def select(self, hierarchy=None, hierarchy_helper=None, candidates=None):
+        """
+        Selects nodes without an accepted enrichment term
+
+        :param hierarchy:
+        :param hierarchy_helper:
+        :param candidates: (node id, gene names) tuples
+        :type candidates: list
+        :return: (node id, gene names) tuples that should be annotated
+        :rtype: list
+        """
+        selected = []
+        for node_id, gene_names in candidates:
+            enriched = False
+            for term_name in self._term_names:
+                val = hierarchy_helper.get_node_attribute_value(hierarchy, node_id,
+                                                                term_name + '_terms')
+                if val is not None and val != '':
+                    enriched = True
+                    break
+            if not enriched:
+                selected.append((node_id, gene_names))
+        return selected
+
+
+class MinimumSizeNodeSelectionPolicy(NodeSelectionPolicy):
+    """
+    Selects nodes with at least a given number of genes
+    """
+
+    def __init__(self, min_size=None):
+        """
+        Constructor
+
+        :param min_size: Minimum number of genes
+        :type min_size: int
+        """
+        self._min_size = min_size
+
+    def select(self, hierarchy=None, hierarchy_helper=None, candidates=None):
+        """
+        Selects nodes with at least **min_size** genes
+
+        :param hierarchy:
+        :param hierarchy_helper:
+        :param candidates: (node id, gene names) tuples
+        :type candidates: list
+        :return: (node id, gene names) tuples that should be annotated
+        :rtype: list
+        """
+        return [c for c in candidates if len(c[1]) >= self._min_size]
+
+
+class TopSizeNodeSelectionPolicy(NodeSelectionPolicy):
+    """
+    Selects the nodes with the most genes
+    """
+
+    def __init__(self, top_n=None):
+        """
+        Constructor
+
+        :param top_n: Number of nodes to select
+        :type top_n: int
+        """
+        self._top_n = top_n
+
+    def select(self, hierarchy=None, hierarchy_helper=None, candidates=None):
+        """
+        Selects **top_n** nodes with the most genes
+
+        :param hierarchy:
+        :param hierarchy_helper:
+        :param candidates: (node id, gene names) tuples
+        :type candidates: list
+        :return: (node id, gene names) tuples that should be annotated
+        :rtype: list
+        """
+        return sorted(candidates, key=lambda c: -len(c[1]))[:self._top_n]
+
+
 class GeneSetAgentAnnotator(object):
     """
     Annotates hierarchy with results from one or more
     :py:class:`~cellmaps_hierarchyeval.analysis.GeneSetAgent` objects
     """
 
-    def __init__(self):
+    HIERARCHY_ORDER = 'hierarchy'
+    """
+    Send gene sets to agents in the order nodes appear in hierarchy
+    """
+
+    SIZE_ORDER = 'size'
+    """
+    Send largest gene sets, which have the longest prompts and
+    take the longest, first so they do not end up in the tail
+    """
+
+    DEPTH_ORDER = 'depth'
+    """
+    Send gene sets of systems closest to the root first, largest first
+    within the same depth
+    """
+
+    ORDERS = [SIZE_ORDER, DEPTH_ORDER, HIERARCHY_ORDER]
+
+    def __init__(self, order=SIZE_ORDER, max_requests=None, time_budget=None,
+                 selection_policies=None, warm_up=False):
         """
         Constructor
-        """
+
+        :param order: Order gene sets are sent to each agent, one of
+                      :py:const:`ORDERS`
+        :type order: str
+        :param max_requests: If set, at most this many gene sets, across
+                             all agents, are sent for annotation. Remaining
+                             nodes are left unannotated
+        :type max_requests: int
+        :param time_budget: If set, no new gene sets are sent for annotation
+                            once this many seconds have passed. Requests
+                            already in flight are allowed to finish and
+                            remaining nodes are left unannotated
+        :type time_budget: int or float
+        :param selection_policies: If set, only nodes picked by every
+                                   policy, applied in order, are sent to
+                                   agents. Other nodes get empty attributes
+        :type selection_policies: list
+        :param warm_up: If ``True`` call
+                        :py:meth:`~cellmaps_hierarchyeval.analysis.GenesetAgent.warm_up`
+                        on every agent with work, at the same time, before
+                        any gene set is sent. Warm up does not count
+                        against **time_budget**
+        :type warm_up: bool
+        :raises CellmapshierarchyevalError: If **order** is not one of
+                                            :py:const:`ORDERS`
+        """
+        if order not in GeneSetAgentAnnotator.ORDERS:
+            raise CellmapshierarchyevalError('Invalid order: ' + str(order) +
+                                             ' must be one of ' +
+                                             str(GeneSetAgentAnnotator.ORDERS))
         self._hierarchy_helper = None
         self._min_comp_size = 4
+        self._checkpoint_file = None
+        self._resume = False
+        self._order = order
+        self._max_requests = max_requests
+        self._time_budget = time_budget
+        self._selection_policies = selection_policies
+        self._warm_up = warm_up
+
+    def set_checkpoint_file(self, checkpoint_file=None, resume=False):
+        """
+        Sets file where result of each (agent, node) pair is appended,
+        as a line of JSON, as soon as it arrives
+
+        :param checkpoint_file: Path to checkpoint file or ``None`` to
+                                disable checkpointing
+        :type checkpoint_file: str
+        :param resume: If ``True`` results already in **checkpoint_file**
+                       are applied to the hierarchy and those
+                       (agent, node) pairs are not sent to the agent again
+        :type resume: bool
+        """
+        self._checkpoint_file = checkpoint_file
+        self._resume = resume
+
+    def _load_checkpoint(self):
+        """
+        Loads results from checkpoint file set via
+        :py:meth:`set_checkpoint_file`. Lines that cannot be
+        parsed, such as a partial line written as a job was
+        killed, are skipped
+
+        :return: {(attribute name prefix, node id): result dict}
+        :rtype: dict
+        """
+        results = {}
+        if self._checkpoint_file is None or not os.path.isfile(self._checkpoint_file):
+            return results
+        with open(self._checkpoint_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    results[(entry['attribute_name_prefix'], entry['node_id'])] = entry
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning('Skipping invalid line in checkpoint file ' +
+                                   str(self._checkpoint_file) + ': ' + str(e))
+        logger.info('Loaded ' + str(len(results)) + ' results from checkpoint file ' +
+                    str(self._checkpoint_file))
+        return results
+
+    @staticmethod
+    def _set_result_attributes(hierarchy, node_id, prefix, proc_name,
+                               confidence, output):
+        """
+        Sets process, confidence and raw output attributes on node
+        """
+        hierarchy.set_node_attribute(node_id, f'{prefix}_process', proc_name)
+        hierarchy.set_node_attribute(node_id, f'{prefix}_confidence', confidence)
+        hierarchy.set_node_attribute(node_id, f'{prefix}_raw', output)
 
     def set_hierarchy_helper(self, hierarchy_helper):
         """
@@ -643,33 +939,302 @@ class GeneSetAgentAnnotator(object):
         """
         Annotates hierarchy with
         :py:class:`~cellmaps_hierarchyeval.analysis.GeneSetAgent`
-        by adding new node attributes
+        by adding new node attributes. Up to
+        :py:meth:`~cellmaps_hierarchyeval.analysis.GenesetAgent.get_max_concurrency`
+        gene sets are sent to **geneset_agent** at once
+
         :param geneset_agent:
         :param hierarchy:
         :return:
         """
-        for node_id, node in tqdm(self._hierarchy_helper.get_nodes(hierarchy).items(), desc='Assemblies'):
+        self.annotate_hierarchy_with_agents(geneset_agents=[geneset_agent],
+                                            hierarchy=hierarchy)
+
+    def _get_node_depths(self, hierarchy=None):
+        """
+        Gets depth of each node in hierarchy where nodes without a
+        parent are at depth ``0``. Edges are expected to go from
+        parent to child
+
+        :param hierarchy:
+        :return: {node id: depth}, nodes not reachable from a root
+                 are omitted
+        :rtype: dict
+        """
+        children = {}
+        has_parent = set()
+        for parent, child in self._hierarchy_helper.get_edges(hierarchy):
+            children.setdefault(parent, []).append(child)
+            has_parent.add(child)
+        depths = {}
+        queue = deque()
+        for node_id in self._hierarchy_helper.get_nodes(hierarchy).keys():
+            if node_id not in has_parent:
+                depths[node_id] = 0
+                queue.append(node_id)
+        while len(queue) > 0:
+            node_id = queue.popleft()
+            for child in children.get(node_id, []):
+                if child not in depths:
+                    depths[child] = depths[node_id] + 1
+                    queue.append(child)
+        return depths
+
+    def _order_work(self, work, node_depths=None):
+        """
+        Orders **work** as set by **order** passed into constructor
+
+        :param work: (node id, gene names) tuples
+        :type work: :py:class:`collections.deque`
+        :param node_depths: output of :py:meth:`_get_node_depths`, only
+                            needed for :py:const:`DEPTH_ORDER`
+        :type node_depths: dict
+        :return: (node id, gene names) tuples in order they should be sent
+        :rtype: :py:class:`collections.deque`
+        """
+        if self._order == GeneSetAgentAnnotator.SIZE_ORDER:
+            return deque(sorted(work, key=lambda w: -len(w[1])))
+        if self._order == GeneSetAgentAnnotator.DEPTH_ORDER:
+            max_depth = len(node_depths)
+            return deque(sorted(work, key=lambda w: (node_depths.get(w[0], max_depth),
+                                                     -len(w[1]))))
+        return work
+
+    def _get_selected_node_ids(self, hierarchy=None):
+        """
+        Applies **selection_policies** passed into constructor to nodes
+        with at least minimum comparison size genes
+
+        :param hierarchy:
+        :return: ids of selected nodes or ``None`` if no policies are set
+        :rtype: set
+        """
+        if self._selection_policies is None or len(self._selection_policies) == 0:
+            return None
+        candidates = []
+        for node_id, node in self._hierarchy_helper.get_nodes(hierarchy).items():
+            gene_names = self._hierarchy_helper.get_node_genes(hierarchy, node)
+            if gene_names is None or len(gene_names) < self._min_comp_size:
+                continue
+            candidates.append((node_id, gene_names))
+        num_candidates = len(candidates)
+        for policy in self._selection_policies:
+            candidates = policy.select(hierarchy=hierarchy,
+                                       hierarchy_helper=self._hierarchy_helper,
+                                       candidates=candidates)
+        logger.info('Selection policies picked ' + str(len(candidates)) +
+                    ' of ' + str(num_candidates) + ' nodes for LLM annotation')
+        return set(node_id for node_id, _ in candidates)
+
+    def _get_work_for_agent(self, geneset_agent=None, hierarchy=None,
+                            checkpoint=None, selected_node_ids=None):
+        """
+        Gets nodes of **hierarchy** that need to be annotated by
+        **geneset_agent**. Nodes without genes are given empty
+        attributes right away, as are nodes with a result in
+        **checkpoint** and nodes not in **selected_node_ids**
+
+        :param geneset_agent:
+        :param hierarchy:
+        :param checkpoint: results from :py:meth:`_load_checkpoint`
+        :type checkpoint: dict
+        :param selected_node_ids: output of :py:meth:`_get_selected_node_ids`
+        :type selected_node_ids: set
+        :return: (node id, gene names) tuples in hierarchy order
+        :rtype: :py:class:`collections.deque`
+        """
+        prefix = geneset_agent.get_attribute_name_prefix()
+        work = deque()
+        for node_id, node in self._hierarchy_helper.get_nodes(hierarchy).items():
             gene_names = self._hierarchy_helper.get_node_genes(hierarchy, node)
             if gene_names is None or len(gene_names) == 0:
                 logger.debug('No genes to analyze')
-                hierarchy.set_node_attribute(node_id, f'{geneset_agent.get_attribute_name_prefix()}_process', '')
-                hierarchy.set_node_attribute(node_id, f'{geneset_agent.get_attribute_name_prefix()}_confidence', '')
-                hierarchy.set_node_attribute(node_id, f'{geneset_agent.get_attribute_name_prefix()}_raw', '')
+                GeneSetAgentAnnotator._set_result_attributes(hierarchy, node_id, prefix,
+                                                             '', '', '')
+                continue
+            if checkpoint is not None and (prefix, node_id) in checkpoint:
+                entry = checkpoint[(prefix, node_id)]
+                GeneSetAgentAnnotator._set_result_attributes(hierarchy, node_id, prefix,
+                                                             entry['process'],
+                                                             entry['confidence'],
+                                                             entry['raw'])
                 continue
             if len(gene_names) < self._min_comp_size:
                 logger.debug('Skipping node: ' + str(node_id) +
-                             ' has only ' + len(gene_names) +
+                             ' has only ' + str(len(gene_names)) +
                              '  which is below threshold of ' +
                              str(self._min_comp_size))
                 continue
-            proc_name, \
-                confidence, \
-                output = geneset_agent.annotate_gene_set(gene_names=gene_names)
-            print('Proc name: ' + str(proc_name))
-            print('confidence: ' + str(confidence))
-            hierarchy.set_node_attribute(node_id, f'{geneset_agent.get_attribute_name_prefix()}_process', proc_name)
-            hierarchy.set_node_attribute(node_id, f'{geneset_agent.get_attribute_name_prefix()}_confidence', confidence)
-            hierarchy.set_node_attribute(node_id, f'{geneset_agent.get_attribute_name_prefix()}_raw', output)
+            if selected_node_ids is not None and node_id not in selected_node_ids:
+                GeneSetAgentAnnotator._set_result_attributes(hierarchy, node_id, prefix,
+                                                             '', '', '')
+                continue
+            work.append((node_id, gene_names))
+        return work
+
+    @staticmethod
+    def _warm_up_agents(geneset_agents):
+        """
+        Calls :py:meth:`~cellmaps_hierarchyeval.analysis.GenesetAgent.warm_up`
+        on all **geneset_agents** at the same time and waits for them
+        to finish. Errors are logged, since a failed warm up only
+        means the first gene set pays the model load time
+
+        :param geneset_agents:
+        :type geneset_agents: list
+        """
+        if len(geneset_agents) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=len(geneset_agents)) as executor:
+            futures = {executor.submit(agent.warm_up): agent for agent in geneset_agents}
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.warning('Warm up failed for ' +
+                                   str(futures[future].get_attribute_name_prefix()) +
+                                   ': ' + str(e))
+
+    def annotate_hierarchy_with_agents(self, geneset_agents=None,
+                                       hierarchy=None, close_agents=False):
+        """
+        Annotates hierarchy with all **geneset_agents** at the same
+        time by scheduling every (agent, node) pair on one shared
+        thread pool. Each agent never has more than its
+        :py:meth:`~cellmaps_hierarchyeval.analysis.GenesetAgent.get_max_concurrency`
+        gene sets in flight, so a slow agent does not hold up the others.
+        Consecutive gene sets the agent reports as
+        :py:meth:`~cellmaps_hierarchyeval.analysis.GenesetAgent.is_batchable`
+        are passed together, up to
+        :py:meth:`~cellmaps_hierarchyeval.analysis.GenesetAgent.get_batch_size`
+        at a time, to
+        :py:meth:`~cellmaps_hierarchyeval.analysis.GenesetAgent.annotate_gene_sets`.
+
+        Only nodes picked by **selection_policies** passed into
+        constructor are sent. Gene sets are sent in the order set by
+        **order** passed into constructor. If **max_requests** or
+        **time_budget** passed into constructor runs out, no more gene
+        sets are sent and the remaining nodes get empty attributes
+
+        :param geneset_agents: agents to annotate hierarchy with
+        :type geneset_agents: list
+        :param hierarchy:
+        :param close_agents: If ``True`` call
+                             :py:meth:`~cellmaps_hierarchyeval.analysis.GenesetAgent.close`
+                             on each agent as soon as all of its gene sets
+                             are annotated
+        :type close_agents: bool
+        """
+        checkpoint = None
+        if self._resume is True:
+            checkpoint = self._load_checkpoint()
+        node_depths = None
+        if self._order == GeneSetAgentAnnotator.DEPTH_ORDER:
+            node_depths = self._get_node_depths(hierarchy=hierarchy)
+        selected_node_ids = self._get_selected_node_ids(hierarchy=hierarchy)
+        pending = []
+        limits = []
+        for agent in geneset_agents:
+            work = self._get_work_for_agent(geneset_agent=agent,
+                                            hierarchy=hierarchy,
+                                            checkpoint=checkpoint,
+                                            selected_node_ids=selected_node_ids)
+            pending.append(self._order_work(work, node_depths=node_depths))
+            limits.append(max(1, agent.get_max_concurrency()))
+        in_flight = [0] * len(geneset_agents)
+        total = sum(len(work) for work in pending)
+        if self._warm_up is True:
+            self._warm_up_agents([agent for agent, work in zip(geneset_agents, pending)
+                                  if len(work) > 0])
+        start_time = time.time()
+        num_requests = [0]
+
+        def budget_exhausted():
+            if self._max_requests is not None and num_requests[0] >= self._max_requests:
+                return True
+            if self._time_budget is not None and time.time() - start_time >= self._time_budget:
+                return True
+            return False
+
+        checkpoint_fh = None
+        if self._checkpoint_file is not None:
+            checkpoint_fh = open(self._checkpoint_file, 'a')
+        futures = {}
+        with ThreadPoolExecutor(max_workers=max(1, sum(limits))) as executor:
+
+            def submit_work(agent_index):
+                agent = geneset_agents[agent_index]
+                work = pending[agent_index]
+                while len(work) > 0 and in_flight[agent_index] < limits[agent_index]:
+                    if budget_exhausted():
+                        break
+                    batch = [work.popleft()]
+                    num_requests[0] += 1
+                    if agent.is_batchable(gene_names=batch[0][1]):
+                        # pack following small gene sets into same prompt
+                        while len(batch) < agent.get_batch_size() and len(work) > 0 and\
+                                agent.is_batchable(gene_names=work[0][1]) and not budget_exhausted():
+                            batch.append(work.popleft())
+                            num_requests[0] += 1
+                    if len(batch) == 1:
+                        future = executor.submit(agent.annotate_gene_set,
+                                                 gene_names=batch[0][1])
+                    else:
+                        future = executor.submit(agent.annotate_gene_sets,
+                                                 gene_sets=[gene_names for _, gene_names in batch])
+                    futures[future] = (agent_index, [node_id for node_id, _ in batch])
+                    in_flight[agent_index] += 1
+                if close_agents and in_flight[agent_index] == 0 and\
+                        (len(work) == 0 or budget_exhausted()):
+                    agent.close()
+
+            try:
+                for agent_index in range(len(geneset_agents)):
+                    submit_work(agent_index)
+                with tqdm(total=total, desc='Assemblies') as progress:
+                    while len(futures) > 0:
+                        done, _ = wait(list(futures.keys()), return_when=FIRST_COMPLETED)
+                        # attributes are only set from this thread
+                        for future in done:
+                            agent_index, node_ids = futures.pop(future)
+                            in_flight[agent_index] -= 1
+                            results = future.result()
+                            if len(node_ids) == 1:
+                                results = [results]
+                            prefix = geneset_agents[agent_index].get_attribute_name_prefix()
+                            for node_id, (proc_name, confidence, output) in zip(node_ids, results):
+                                logger.debug('Node ' + str(node_id) + ' proc name: ' + str(proc_name) +
+                                             ' confidence: ' + str(confidence))
+                                GeneSetAgentAnnotator._set_result_attributes(hierarchy, node_id, prefix,
+                                                                             proc_name, confidence,
+                                                                             output)
+                                if checkpoint_fh is not None:
+                                    checkpoint_fh.write(json.dumps({'attribute_name_prefix': prefix,
+                                                                    'node_id': node_id,
+                                                                    'process': proc_name,
+                                                                    'confidence': confidence,
+                                                                    'raw': output}) + '\n')
+                                progress.update(1)
+                            if checkpoint_fh is not None:
+                                checkpoint_fh.flush()
+                            submit_work(agent_index)
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+            finally:
+                if checkpoint_fh is not None:
+                    checkpoint_fh.close()
+
+        for agent_index, work in enumerate(pending):
+            if len(work) == 0:
+                continue
+            prefix = geneset_agents[agent_index].get_attribute_name_prefix()
+            logger.warning('Annotation budget exhausted, leaving ' + str(len(work)) +
+                           ' nodes unannotated by ' + str(prefix))
+            for node_id, _ in work:
+                GeneSetAgentAnnotator._set_result_attributes(hierarchy, node_id, prefix,
+                                                             '', '', '')
 
 
 class CellmapshierarchyevalRunner(object):
@@ -679,6 +1244,15 @@ class CellmapshierarchyevalRunner(object):
     MAX_FDR = 0.05
     MIN_JACCARD_INDEX = 0.1
     MIN_COMP_SIZE = 4
+    COLD_START_LOAD_DURATION = 1.0
+    """
+    Calls where Ollama reported a ``load_duration`` of at least this
+    many seconds are counted as cold starts
+    """
+    PERTURBSEQ_ATTR_PREFIX = 'PerturbSeq_'
+    """
+    Prefix of node attributes set by Perturb-seq evaluation
+    """
     CORUM = '633291aa-6e1d-11ef-a7fd-005056ae23aa'
     GO_CC = '6722d74d-6e20-11ef-a7fd-005056ae23aa'
     HPA = '68c2f2c0-6e20-11ef-a7fd-005056ae23aa'
@@ -703,7 +1277,11 @@ class CellmapshierarchyevalRunner(object):
                  provenance_utils=ProvenanceUtil(),
                  geneset_annotator=GeneSetAgentAnnotator(),
                  provenance=None,
-                 log_fairops=False):
+                 log_fairops=False,
+                 resume=False,
+                 perturbseq=None,
+                 perturbseq_workers=None,
+                 perturbseq_rank=None):
         """
         Constructor
 
@@ -755,6 +1333,24 @@ class CellmapshierarchyevalRunner(object):
                                     'project-name': 'Example'
                                 }
         :type provenance: dict
+        :param resume: If ``True`` and **outdir** exists, reuse it and skip
+                       (agent, node) pairs already in LLM checkpoint file
+                       of a previous run. See :py:meth:`get_llm_checkpoint_dest_file`
+        :type resume: bool
+        :param perturbseq: Path to Perturb-seq table, comma delimited or tab
+                           delimited if it ends with ``.tsv`` or ``.txt``, with
+                           genes as rows, or directory of a
+                           :py:class:`~cellmaps_hierarchyeval.perturbstore.PerturbSeqStore`
+                           in which case only rows of root genes are read. If set, every system is evaluated
+                           against root gene pairs, see :py:meth:`_evaluate_perturbseq`
+        :type perturbseq: str
+        :param perturbseq_workers: If greater than 1, number of processes
+                                   used for Perturb-seq evaluation
+        :type perturbseq_workers: int
+        :param perturbseq_rank: If set, Perturb-seq similarity is approximated
+                                from profiles projected to this many dimensions, see
+                                :py:class:`~cellmaps_hierarchyeval.similarity.LowRankCosineSimilarityProvider`
+        :type perturbseq_rank: int
         """
         logger.debug('In constructor')
         if outdir is None:
@@ -787,6 +1383,10 @@ class CellmapshierarchyevalRunner(object):
         self._hierarchy_real_ids = []
         self._provenance = provenance
         self._log_fairops = log_fairops
+        self._resume = resume
+        self._perturbseq = perturbseq
+        self._perturbseq_workers = perturbseq_workers
+        self._perturbseq_rank = perturbseq_rank
 
         self._metrics = {}
 
@@ -805,7 +1405,8 @@ class CellmapshierarchyevalRunner(object):
                                      'project_name': self._project_name,
                                      'organization_name': self._organization_name,
                                      'skip_logging': self._skip_logging,
-                                     'provenance': str(self._provenance)
+                                     'provenance': str(self._provenance),
+                                     'perturbseq': self._perturbseq
                                      }
             
         if self._log_fairops:
@@ -1032,6 +1633,70 @@ class CellmapshierarchyevalRunner(object):
             hierarchy.set_node_attribute(node_id, '{}_jaccard_indexes'.format(terms.term_name), "")
             hierarchy.set_node_attribute(node_id, '{}_overlap_genes'.format(terms.term_name), "")
 
+    def _evaluate_perturbseq(self, hierarchy):
+        """
+        Compares Perturb-seq similarity of gene pairs within each system
+        of **hierarchy** against pairs in different communities under
+        root with a one sided rank-sum test, via
+        :py:meth:`~cellmaps_hierarchyeval.perturb.PerturbSeqAnalysis.evaluate_hierarchy_systems`,
+        and sets these node attributes, prefixed with
+        :py:const:`PERTURBSEQ_ATTR_PREFIX`:
+
+        * ``num_pairs`` - number of gene pairs in system with Perturb-seq data
+        * ``statistic`` - rank-sum statistic, not set if ``num_pairs`` is 0
+        * ``p_value`` - p-value of statistic, not set if ``num_pairs`` is 0
+
+        :param hierarchy: The hierarchy already loaded by :py:meth:`run`
+        :type hierarchy: :py:class:`~ndex2.cx2.CX2Network`
+        :raises CellmapshierarchyevalError: If hierarchy is not in CX2 format
+        """
+        if self._perturbseq is None:
+            logger.debug('Skipping Perturb-seq evaluation because no file was set')
+            return
+        if not isinstance(self._hierarchy_helper, CX2NetworkHelper):
+            raise CellmapshierarchyevalError('Perturb-seq evaluation requires '
+                                             'hierarchy in CX2 format')
+        logger.info('Evaluating hierarchy with Perturb-seq data: ' + str(self._perturbseq))
+        if os.path.isdir(self._perturbseq):
+            perturbseq_df = PerturbSeqStore(self._perturbseq)
+        else:
+            sep = ','
+            if self._perturbseq.endswith('.tsv') or self._perturbseq.endswith('.txt'):
+                sep = '\t'
+            perturbseq_df = pd.read_csv(self._perturbseq, sep=sep, index_col=0)
+
+        similarity_provider = None
+        if self._perturbseq_rank is not None:
+            similarity_provider = LowRankCosineSimilarityProvider(rank=self._perturbseq_rank, seed=0)
+
+        analysis = PerturbSeqAnalysis(hierarchy)
+        root_pairs = analysis.get_root_community_membership()
+        similarity, overlap_root_pairs = analysis.get_root_overlapping_pair_similarities(
+            root_pairs, perturbseq_df, similarity_provider=similarity_provider)
+        if similarity_provider is not None:
+            logger.info('Perturb-seq similarity approximated with rank ' +
+                        str(self._perturbseq_rank) + ', error on sampled gene pairs: ' +
+                        str(similarity_provider.get_error_report()))
+        root_similarity = analysis.get_root_functional_data_similarity(similarity, overlap_root_pairs)
+        if self._perturbseq_workers is not None and self._perturbseq_workers > 1:
+            table = analysis.evaluate_hierarchy_systems_parallel(similarity, root_similarity,
+                                                                 num_workers=self._perturbseq_workers)
+        else:
+            table = analysis.evaluate_hierarchy_systems(similarity, root_similarity)
+
+        prefix = CellmapshierarchyevalRunner.PERTURBSEQ_ATTR_PREFIX
+        for node_id, row in table.iterrows():
+            hierarchy.set_node_attribute(node_id, prefix + 'num_pairs', int(row['num_pairs']))
+            # NaN is not valid JSON so those attributes are left unset
+            if not np.isnan(row['statistic']):
+                hierarchy.set_node_attribute(node_id, prefix + 'statistic',
+                                             float(row['statistic']))
+            if not np.isnan(row['p_value']):
+                hierarchy.set_node_attribute(node_id, prefix + 'p_value',
+                                             float(row['p_value']))
+        logger.info('Evaluated ' + str(len(table)) + ' systems with ' +
+                    str(len(root_similarity)) + ' root gene pairs')
+
     def _get_hierarchy_genes(self, hierarchy):
         """
         Extracts and returns all genes from the provided hierarchy.
@@ -1263,7 +1928,8 @@ class CellmapshierarchyevalRunner(object):
 
     def _annotate_hierarchy_with_geneset_annotators(self, hierarchy=None):
         """
-        Annotates hierarchy with each GeneSetAgent set in constructor.
+        Annotates hierarchy with all GeneSetAgents set in constructor
+        running side by side.
         """
         if self._geneset_annotator is None:
             logger.debug('Skipping because geneset_annotator is None')
@@ -1272,10 +1938,316 @@ class CellmapshierarchyevalRunner(object):
             logger.debug('Skipping because there are no geneset agents')
             return
         self._geneset_annotator.set_hierarchy_helper(self._hierarchy_helper)
+        checkpoint_file = None
+        if os.path.isdir(self._outdir):
+            checkpoint_file = self.get_llm_checkpoint_dest_file()
+        else:
+            logger.debug(self._outdir + ' does not exist, skipping checkpoint file')
+        self._geneset_annotator.set_checkpoint_file(checkpoint_file=checkpoint_file,
+                                                    resume=self._resume)
         logger.debug('Processing ' + str(len(self._geneset_agents)) + ' geneset agents')
-        for a in tqdm(self._geneset_agents, desc='GeneSet Agents'):
-            self._geneset_annotator.annotate_hierarchy(hierarchy=hierarchy,
-                                                       geneset_agent=a)
+        try:
+            # each agent is closed, releasing resources such as a
+            # loaded model, as soon as its gene sets are done
+            self._geneset_annotator.annotate_hierarchy_with_agents(geneset_agents=self._geneset_agents,
+                                                                   hierarchy=hierarchy,
+                                                                   close_agents=True)
+        finally:
+            for a in self._geneset_agents:
+                a.close()
+
+    def get_llm_checkpoint_dest_file(self):
+        """
+        Gets path to file where result of each (agent, node) pair
+        is appended as soon as it arrives
+
+        Example path: ``/tmp/foo/llm_annotation_checkpoint.jsonl``
+
+        :return:
+        :rtype: str
+        """
+        return os.path.join(self._outdir, 'llm_annotation_checkpoint.jsonl')
+
+    def get_llm_call_metrics_dest_file(self):
+        """
+        Gets path to file where metrics of each LLM call are written,
+        one line of JSON per call
+
+        Example path: ``/tmp/foo/llm_call_metrics.jsonl``
+
+        :return:
+        :rtype: str
+        """
+        return os.path.join(self._outdir, 'llm_call_metrics.jsonl')
+
+    def get_llm_statistics_dest_file(self):
+        """
+        Gets path to file where LLM request statistics are written
+
+        Example path: ``/tmp/foo/llm_statistics.json``
+
+        :return:
+        :rtype: str
+        """
+        return os.path.join(self._outdir, 'llm_statistics.json')
+
+    def _get_llm_statistics(self):
+        """
+        Gathers summary of calls made by each geneset agent, see
+        :py:meth:`_get_llm_call_summary`, request counts and latencies
+        of each REST endpoint used by geneset agents along with time to first token of
+        each agent that streamed responses and how the number of
+        requests in flight changed over time for each concurrency
+        limiter and how many requests each request coalescer shared.
+        Endpoint pools, limiters and coalescers shared by several agents
+        are only reported once
+
+        :return: statistics with keys ``endpoints``, ``agents``, ``concurrency``,
+                 ``calls``, ``warm_up`` and ``coalescing`` or ``None`` if
+                 there is nothing to report
+        :rtype: dict
+        """
+        if self._geneset_agents is None:
+            return None
+        warm_up = []
+        for a in self._geneset_agents:
+            for entry in a.get_warm_up_metrics():
+                entry = dict(entry)
+                entry['attribute_name_prefix'] = a.get_attribute_name_prefix()
+                if entry['load_duration'] is not None:
+                    # ollama reports durations in nanoseconds
+                    entry['load_duration'] = entry['load_duration'] / 1e9
+                logger.info('LLM agent ' + str(a.get_attribute_name_prefix()) +
+                            ' warm up on ' + str(entry['url']) +
+                            ' load duration: ' + str(entry['load_duration']))
+                warm_up.append(entry)
+        calls = []
+        for a in self._geneset_agents:
+            call_summary = CellmapshierarchyevalRunner._get_llm_call_summary(a.get_call_metrics())
+            if call_summary is None:
+                continue
+            call_summary['attribute_name_prefix'] = a.get_attribute_name_prefix()
+            call_summary['model'] = a.get_model()
+            logger.info('LLM agent ' + str(a.get_attribute_name_prefix()) +
+                        ' calls: ' + str(call_summary['count']) +
+                        ' failures: ' + str(call_summary['failures']) +
+                        ' parse failures: ' + str(call_summary['parse_failures']) +
+                        ' cold starts: ' + str(call_summary['cold_starts']) +
+                        ' hedges/wins: ' + str(call_summary['hedges']) +
+                        '/' + str(call_summary['hedge_wins']) +
+                        ' p50/p95/p99 wall time: ' + str(call_summary['wall_time']['p50']) +
+                        '/' + str(call_summary['wall_time']['p95']) +
+                        '/' + str(call_summary['wall_time']['p99']) +
+                        ' tokens/sec: ' + str(call_summary['tokens_per_second']))
+            calls.append(call_summary)
+        agents = []
+        for a in self._geneset_agents:
+            ttfts = sorted(a.get_time_to_first_tokens())
+            if len(ttfts) == 0:
+                continue
+            ttft_stats = {'count': len(ttfts),
+                          'mean': sum(ttfts) / len(ttfts),
+                          'median': ttfts[len(ttfts) // 2],
+                          'max': ttfts[-1]}
+            logger.info('LLM agent ' + str(a.get_attribute_name_prefix()) +
+                        ' median time to first token: ' + str(ttft_stats['median']))
+            agents.append({'attribute_name_prefix': a.get_attribute_name_prefix(),
+                           'time_to_first_token': ttft_stats})
+        pools = []
+        for a in self._geneset_agents:
+            pool = a.get_endpoint_pool()
+            if pool is None or any(pool is p for p in pools):
+                continue
+            pools.append(pool)
+        limiters = []
+        for a in self._geneset_agents:
+            limiter = a.get_concurrency_limiter()
+            if limiter is None or any(limiter is lim for lim in limiters):
+                continue
+            limiters.append(limiter)
+        coalescers = []
+        for a in self._geneset_agents:
+            coalescer = a.get_request_coalescer()
+            if coalescer is None or any(coalescer is c for c in coalescers):
+                continue
+            coalescers.append(coalescer)
+        if len(pools) == 0 and len(agents) == 0 and len(limiters) == 0 and\
+                len(calls) == 0 and len(warm_up) == 0 and len(coalescers) == 0:
+            return None
+        endpoints = []
+        for pool in pools:
+            for endpoint_stats in pool.get_statistics():
+                logger.info('LLM endpoint ' + str(endpoint_stats['url']) +
+                            ' requests: ' + str(endpoint_stats['requests']) +
+                            ' failures: ' + str(endpoint_stats['failures']) +
+                            ' median latency: ' + str(endpoint_stats['median_latency']))
+                endpoints.append(endpoint_stats)
+        concurrency = [lim.get_history() for lim in limiters]
+        coalescing = []
+        for coalescer in coalescers:
+            coalescer_stats = coalescer.get_statistics()
+            logger.info('LLM requests: ' + str(coalescer_stats['requests']) +
+                        ' sent: ' + str(coalescer_stats['sent']) +
+                        ' coalesced: ' + str(coalescer_stats['coalesced']) +
+                        ' cached: ' + str(coalescer_stats['cached']))
+            coalescing.append(coalescer_stats)
+        return {'endpoints': endpoints, 'agents': agents,
+                'concurrency': concurrency, 'calls': calls,
+                'warm_up': warm_up, 'coalescing': coalescing}
+
+    @staticmethod
+    def _get_llm_call_summary(call_metrics):
+        """
+        Summarizes metrics from
+        :py:meth:`~cellmaps_hierarchyeval.analysis.GenesetAgent.get_call_metrics`
+
+        :param call_metrics:
+        :type call_metrics: list
+        :return: count, failures, total retries, responses that could not
+                 be parsed, calls that reused result of an identical request,
+                 hedged requests sent and won, wall time percentiles
+                 (seconds), token totals, load time (seconds), number of
+                 cold starts, wall time percentiles of calls that were not
+                 cold starts and generated tokens per second, which only
+                 counts generation time, or ``None`` if **call_metrics** is empty
+        :rtype: dict
+        """
+        if call_metrics is None or len(call_metrics) == 0:
+            return None
+        wall_times = np.array([c['wall_time'] for c in call_metrics])
+        cold_start_ns = CellmapshierarchyevalRunner.COLD_START_LOAD_DURATION * 1e9
+        warm_wall_times = np.array([c['wall_time'] for c in call_metrics
+                                    if c.get('load_duration') is None or
+                                    c['load_duration'] < cold_start_ns])
+        warm_wall_time = None
+        if len(warm_wall_times) > 0:
+            warm_wall_time = {'mean': float(np.mean(warm_wall_times)),
+                              'p50': float(np.percentile(warm_wall_times, 50)),
+                              'p95': float(np.percentile(warm_wall_times, 95)),
+                              'p99': float(np.percentile(warm_wall_times, 99)),
+                              'max': float(np.max(warm_wall_times))}
+        eval_count = 0
+        eval_duration = 0
+        prompt_eval_count = 0
+        load_duration = 0
+        for c in call_metrics:
+            if c.get('eval_count') is not None and c.get('eval_duration'):
+                eval_count += c['eval_count']
+                eval_duration += c['eval_duration']
+            if c.get('prompt_eval_count') is not None:
+                prompt_eval_count += c['prompt_eval_count']
+            if c.get('load_duration') is not None:
+                load_duration += c['load_duration']
+        tokens_per_second = None
+        if eval_duration > 0:
+            # ollama reports durations in nanoseconds
+            tokens_per_second = eval_count / (eval_duration / 1e9)
+        return {'count': len(call_metrics),
+                'failures': sum(1 for c in call_metrics if c['success'] is not True),
+                'retries': sum(c.get('retries', 0) for c in call_metrics),
+                'parse_failures': sum(c.get('parse_failures', 0) for c in call_metrics),
+                'coalesced': sum(1 for c in call_metrics if c.get('coalesced') is True),
+                'hedges': sum(c.get('hedges', 0) for c in call_metrics),
+                'hedge_wins': sum(c.get('hedge_wins', 0) for c in call_metrics),
+                'wall_time': {'mean': float(np.mean(wall_times)),
+                              'p50': float(np.percentile(wall_times, 50)),
+                              'p95': float(np.percentile(wall_times, 95)),
+                              'p99': float(np.percentile(wall_times, 99)),
+                              'max': float(np.max(wall_times))},
+                'prompt_tokens': prompt_eval_count,
+                'generated_tokens': eval_count,
+                'load_duration': load_duration / 1e9,
+                'cold_starts': len(call_metrics) - len(warm_wall_times),
+                'warm_wall_time': warm_wall_time,
+                'tokens_per_second': tokens_per_second}
+
+    def _log_llm_statistics_to_mlflow(self, stats):
+        """
+        Logs per agent call summary from **stats** as mlflow
+        metrics if **log_fairops** was set in constructor
+
+        :param stats: output of :py:meth:`_get_llm_statistics`
+        :type stats: dict
+        """
+        if not self._log_fairops:
+            return
+        for call_summary in stats['calls']:
+            # mlflow metric names cannot contain characters like ':'
+            name = re.sub(r'[^0-9A-Za-z_\-./ ]', '_',
+                          str(call_summary['attribute_name_prefix'])).strip('_')
+            for pct in ['p50', 'p95', 'p99']:
+                mlflow.log_metric(f"llm_{name}_wall_time_{pct}",
+                                  call_summary['wall_time'][pct])
+            mlflow.log_metric(f"llm_{name}_calls", call_summary['count'])
+            mlflow.log_metric(f"llm_{name}_failures", call_summary['failures'])
+            mlflow.log_metric(f"llm_{name}_parse_failures", call_summary['parse_failures'])
+            mlflow.log_metric(f"llm_{name}_load_duration", call_summary['load_duration'])
+            mlflow.log_metric(f"llm_{name}_cold_starts", call_summary['cold_starts'])
+            mlflow.log_metric(f"llm_{name}_hedges", call_summary['hedges'])
+            mlflow.log_metric(f"llm_{name}_hedge_wins", call_summary['hedge_wins'])
+            if call_summary['tokens_per_second'] is not None:
+                mlflow.log_metric(f"llm_{name}_tokens_per_second",
+                                  call_summary['tokens_per_second'])
+
+    def _write_and_register_llm_call_metrics(self):
+        """
+        Writes metrics of every call made by geneset agents to
+        :py:meth:`get_llm_call_metrics_dest_file`, one line of JSON
+        per call, and registers the file
+
+        :return: Dataset ID or ``None`` if no calls were recorded
+        :rtype: str
+        """
+        if self._geneset_agents is None:
+            return None
+        call_metrics = []
+        for a in self._geneset_agents:
+            call_metrics.extend(a.get_call_metrics())
+        if len(call_metrics) == 0:
+            return None
+        dest_path = self.get_llm_call_metrics_dest_file()
+        with open(dest_path, 'w') as f:
+            for entry in call_metrics:
+                f.write(json.dumps(entry) + '\n')
+
+        data_dict = {'name': os.path.basename(dest_path) + ' LLM call metrics file',
+                     'description': 'Latency and token counts of each LLM call',
+                     'data-format': 'jsonl',
+                     'author': cellmaps_hierarchyeval.__name__,
+                     'version': cellmaps_hierarchyeval.__version__,
+                     'date-published': date.today().strftime('%m-%d-%Y')}
+        return self._provenance_utils.register_dataset(self._outdir,
+                                                       source_file=dest_path,
+                                                       data_dict=data_dict)
+
+    def _write_and_register_llm_statistics(self):
+        """
+        Writes statistics from :py:meth:`_get_llm_statistics` to
+        :py:meth:`get_llm_statistics_dest_file` and registers the file.
+        Call summary is also logged to mlflow if **log_fairops**
+        was set in constructor
+
+        :return: Dataset ID or ``None`` if there were no statistics
+        :rtype: str
+        """
+        stats = self._get_llm_statistics()
+        if stats is None:
+            return None
+        dest_path = self.get_llm_statistics_dest_file()
+        with open(dest_path, 'w') as f:
+            json.dump(stats, f, indent=2)
+        self._log_llm_statistics_to_mlflow(stats)
+
+        data_dict = {'name': os.path.basename(dest_path) + ' LLM statistics file',
+                     'description': 'LLM request statistics file',
+                     'data-format': 'json',
+                     'author': cellmaps_hierarchyeval.__name__,
+                     'version': cellmaps_hierarchyeval.__version__,
+                     'date-published': date.today().strftime('%m-%d-%Y')}
+        dataset_id = self._provenance_utils.register_dataset(self._outdir,
+                                                             source_file=dest_path,
+                                                             data_dict=data_dict)
+        return dataset_id
 
     def generate_readme(self):
         description = getattr(cellmaps_hierarchyeval, '__description__', 'No description provided.')
@@ -1299,7 +2271,9 @@ class CellmapshierarchyevalRunner(object):
             logger.debug('In run method')
 
             if os.path.isdir(self._outdir):
-                raise CellmapshierarchyevalError(self._outdir + ' already exists')
+                if self._resume is not True:
+                    raise CellmapshierarchyevalError(self._outdir + ' already exists')
+                logger.info('Resuming previous run in ' + self._outdir)
 
             if not os.path.isdir(self._outdir):
                 os.makedirs(self._outdir, mode=0o755)
@@ -1330,8 +2304,18 @@ class CellmapshierarchyevalRunner(object):
                 logger.info('Skipping term enrichment because '
                             'skip_term_enrichment flag is True')
 
+            self._evaluate_perturbseq(hierarchy)
+
             self._annotate_hierarchy_with_geneset_annotators(hierarchy=hierarchy)
 
+            dataset_id = self._write_and_register_llm_statistics()
+            if dataset_id is not None:
+                generated_dataset_ids.append(dataset_id)
+
+            dataset_id = self._write_and_register_llm_call_metrics()
+            if dataset_id is not None:
+                generated_dataset_ids.append(dataset_id)
+
             self._update_annotate_hierarchy(hierarchy, self._outdir)
 
             # write out annotated hierarchy
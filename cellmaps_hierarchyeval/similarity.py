@@ -0,0 +1,396 @@
+import os
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
+
+logger = logging.getLogger(__name__)
+
+
+class CosineSimilarityProvider(object):
+    """
+    Computes cosine similarity between rows of a DataFrame scaled into
+    [0, 1], same as :py:func:`cellmaps_utils.music_utils.cosine_similarity_scaled`,
+    but a block of rows at a time so only the result matrix is held at
+    full size.
+
+    If **cache_dir** is set, result is written to a ``.npy`` file in that
+    directory, named by a hash of the input values, gene order and
+    output type, and returned memory mapped. Later calls, from this or
+    another process, with the same input reuse that file.
+    """
+
+    CACHE_PREFIX = 'cosine_similarity_'
+
+    def __init__(self, cache_dir=None, dtype=np.float64, block_size=1024):
+        """
+        Constructor
+
+        :param cache_dir: Directory to write similarity matrices to. If ``None``
+                          matrices are kept in memory and not cached
+        :type cache_dir: str
+        :param dtype: Type of similarity values, :py:class:`numpy.float32` halves
+                      size of the matrix
+        :type dtype: :py:class:`numpy.dtype`
+        :param block_size: Number of rows computed at a time
+        :type block_size: int
+        :raises CellmapshierarchyevalError: If **dtype** is not a float type or
+                                            **block_size** is less than 1
+        """
+        self._cache_dir = cache_dir
+        self._dtype = np.dtype(dtype)
+        if self._dtype.kind != 'f':
+            raise CellmapshierarchyevalError('dtype must be a float type: ' + str(dtype))
+        if block_size is None or block_size < 1:
+            raise CellmapshierarchyevalError('block_size must be 1 or larger: ' + str(block_size))
+        self._block_size = block_size
+
+    def get_cache_key(self, df):
+        """
+        Gets hash of values and row names of **df** and type of the
+        similarity matrix
+
+        :param df: Data with one row per gene
+        :type df: :py:class:`pandas.DataFrame`
+        :return: hex digest
+        :rtype: str
+        """
+        digest = hashlib.sha256()
+        digest.update(str(self._dtype).encode('utf-8'))
+        digest.update(self._get_cache_parameters().encode('utf-8'))
+        digest.update(str(df.shape).encode('utf-8'))
+        digest.update('\n'.join([str(x) for x in df.index.values]).encode('utf-8'))
+        digest.update(np.ascontiguousarray(df.values, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def get_cache_path(self, df):
+        """
+        Gets path of file similarity matrix of **df** is cached in
+
+        :param df: Data with one row per gene
+        :type df: :py:class:`pandas.DataFrame`
+        :return: path or ``None`` if no cache directory was set
+        :rtype: str
+        """
+        if self._cache_dir is None:
+            return None
+        return os.path.join(self._cache_dir, CosineSimilarityProvider.CACHE_PREFIX +
+                            self.get_cache_key(df) + '.npy')
+
+    def _get_cache_parameters(self):
+        """
+        Gets parameters, other than type, that change the similarity
+        matrix and so must be part of the cache key
+
+        :return:
+        :rtype: str
+        """
+        return ''
+
+    @staticmethod
+    def _normalize_rows(values):
+        """
+        Scales rows of **values** to unit length, leaving rows of
+        zeros as is
+
+        :param values: genes by features
+        :type values: :py:class:`numpy.ndarray`
+        :return:
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        norms = np.linalg.norm(values, axis=1)
+        norms[norms == 0] = 1.0
+        return values / norms[:, np.newaxis]
+
+    def _get_embedding(self, values):
+        """
+        Gets matrix whose row dot products are the cosine similarities
+        of rows of **values**
+
+        :param values: genes by features
+        :type values: :py:class:`numpy.ndarray`
+        :return:
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        return CosineSimilarityProvider._normalize_rows(values)
+
+    def _fill_similarity(self, values, out):
+        """
+        Writes scaled cosine similarity of rows of **values** into **out**
+
+        :param values: genes by features
+        :type values: :py:class:`numpy.ndarray`
+        :param out: genes by genes array to write to
+        :type out: :py:class:`numpy.ndarray`
+        :return: (minimum, scale) where similarity was scaled as
+                 ``(cosine similarity - minimum) / scale``
+        :rtype: tuple
+        """
+        embedding = self._get_embedding(values)
+
+        # scaling uses min and max of whole matrix so a second
+        # pass over the blocks is needed once they are known
+        minimum = np.inf
+        maximum = -np.inf
+        for row_start in range(0, values.shape[0], self._block_size):
+            row_end = min(row_start + self._block_size, values.shape[0])
+            block = embedding[row_start:row_end] @ embedding.T
+            minimum = min(minimum, block.min())
+            maximum = max(maximum, block.max())
+            out[row_start:row_end] = block
+
+        scale = maximum - minimum
+        if scale == 0:
+            scale = 1.0
+        for row_start in range(0, values.shape[0], self._block_size):
+            row_end = min(row_start + self._block_size, values.shape[0])
+            out[row_start:row_end] -= minimum
+            out[row_start:row_end] /= scale
+        return minimum, scale
+
+    def get_similarity(self, df):
+        """
+        Gets scaled cosine similarity between each pair of rows in **df**
+
+        :param df: Data with one row per gene
+        :type df: :py:class:`pandas.DataFrame`
+        :raises CellmapshierarchyevalError: If **df** contains NaN values
+        :return: genes by genes similarity, backed by a read only memory
+                 map if a cache directory was set
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        genes = df.index.values
+        cache_path = self.get_cache_path(df)
+        if cache_path is not None and os.path.isfile(cache_path):
+            logger.debug('Using cached similarity matrix: ' + cache_path)
+            return pd.DataFrame(np.load(cache_path, mmap_mode='r'), index=genes, columns=genes)
+
+        values = np.asarray(df.values, dtype=np.float64)
+        if np.isnan(values).any():
+            raise CellmapshierarchyevalError('Input contains NaN values')
+
+        if cache_path is None:
+            out = np.empty((len(genes), len(genes)), dtype=self._dtype)
+            self._fill_similarity(values, out)
+            return pd.DataFrame(out, index=genes, columns=genes)
+
+        os.makedirs(self._cache_dir, exist_ok=True)
+        # write to a temporary file first so other processes never
+        # see a partially written matrix
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=self._cache_dir)
+        os.close(fd)
+        try:
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self._dtype,
+                                            shape=(len(genes), len(genes)))
+            self._fill_similarity(values, out)
+            out.flush()
+            del out
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        logger.debug('Wrote similarity matrix: ' + cache_path)
+        return pd.DataFrame(np.load(cache_path, mmap_mode='r'), index=genes, columns=genes)
+
+
+class LowRankCosineSimilarityProvider(CosineSimilarityProvider):
+    """
+    Approximates the scaled cosine similarity of
+    :py:class:`CosineSimilarityProvider` for fast exploratory runs.
+
+    Rows are scaled to unit length and projected onto their top
+    **rank** singular vectors, found by randomized SVD, so each
+    similarity is a dot product of length **rank** instead of the
+    number of features. Each call to :py:meth:`get_similarity` also
+    compares approximate and exact cosine similarity, before and after
+    scaling, on a random sample of gene pairs, see :py:meth:`get_error_report`
+    """
+
+    def __init__(self, rank=50, oversampling=10, power_iterations=2,
+                 seed=None, error_sample_size=10000, cache_dir=None,
+                 dtype=np.float32, block_size=1024):
+        """
+        Constructor
+
+        :param rank: Number of dimensions profiles are projected to
+        :type rank: int
+        :param oversampling: Extra random dimensions used while finding
+                             singular vectors, improves accuracy
+        :type oversampling: int
+        :param power_iterations: Number of power iterations, improves
+                                 accuracy when singular values decay slowly
+        :type power_iterations: int
+        :param seed: Seed for random projection and error sample
+        :type seed: int
+        :param error_sample_size: Number of gene pairs approximation
+                                  error is measured on, ``0`` to skip
+        :type error_sample_size: int
+        :param cache_dir: See :py:class:`CosineSimilarityProvider`
+        :type cache_dir: str
+        :param dtype: See :py:class:`CosineSimilarityProvider`
+        :type dtype: :py:class:`numpy.dtype`
+        :param block_size: See :py:class:`CosineSimilarityProvider`
+        :type block_size: int
+        :raises CellmapshierarchyevalError: If **rank** is less than 1
+        """
+        super().__init__(cache_dir=cache_dir, dtype=dtype, block_size=block_size)
+        if rank is None or rank < 1:
+            raise CellmapshierarchyevalError('rank must be 1 or larger: ' + str(rank))
+        self._rank = rank
+        self._oversampling = oversampling
+        self._power_iterations = power_iterations
+        self._seed = seed
+        self._error_sample_size = error_sample_size
+        self._error_report = None
+        self._sample_errors = None
+
+    def _get_cache_parameters(self):
+        """
+        Gets rank, oversampling, power iterations and seed as a string
+
+        :return:
+        :rtype: str
+        """
+        return ('rank=' + str(self._rank) + ' oversampling=' + str(self._oversampling) +
+                ' power_iterations=' + str(self._power_iterations) + ' seed=' + str(self._seed))
+
+    def _get_embedding(self, values):
+        """
+        Gets rows of **values** scaled to unit length and projected
+        onto their top singular vectors, then measures approximation
+        error, see :py:meth:`get_error_report`
+
+        :param values: genes by features
+        :type values: :py:class:`numpy.ndarray`
+        :return: genes by **rank** matrix
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        projection_seed, sample_seed = np.random.SeedSequence(self._seed).spawn(2)
+        normalized = CosineSimilarityProvider._normalize_rows(values)
+        if self._rank >= min(normalized.shape):
+            embedding = normalized
+            captured = 1.0
+        else:
+            rng = np.random.default_rng(projection_seed)
+            num_vectors = min(self._rank + self._oversampling, min(normalized.shape))
+            sketch = normalized @ rng.standard_normal((normalized.shape[1], num_vectors))
+            for _ in range(self._power_iterations):
+                sketch, _ = np.linalg.qr(sketch)
+                sketch, _ = np.linalg.qr(normalized.T @ sketch)
+                sketch = normalized @ sketch
+            basis, _ = np.linalg.qr(sketch)
+            u, singular_values, _ = np.linalg.svd(basis.T @ normalized, full_matrices=False)
+            singular_values = singular_values[:self._rank]
+            embedding = (basis @ u[:, :self._rank]) * singular_values
+            total = np.sum(normalized ** 2)
+            captured = float(np.sum(singular_values ** 2) / total) if total > 0 else 1.0
+
+        self._sample_errors = self._measure_error(normalized, embedding, sample_seed)
+        num_pairs = 0 if self._sample_errors is None else int(len(self._sample_errors))
+        self._error_report = {'num_pairs': num_pairs}
+        self._error_report.update(LowRankCosineSimilarityProvider._summarize_errors(self._sample_errors))
+        self._error_report['rank'] = embedding.shape[1]
+        self._error_report['captured_variance'] = captured
+        return embedding
+
+    def _fill_similarity(self, values, out):
+        """
+        Same as :py:meth:`CosineSimilarityProvider._fill_similarity`, then
+        adds error on sampled gene pairs after scaling to error report
+
+        :param values: genes by features
+        :type values: :py:class:`numpy.ndarray`
+        :param out: genes by genes array to write to
+        :type out: :py:class:`numpy.ndarray`
+        :return: (minimum, scale) where similarity was scaled as
+                 ``(cosine similarity - minimum) / scale``
+        :rtype: tuple
+        """
+        minimum, scale = super()._fill_similarity(values, out)
+        scaled_errors = None
+        if self._sample_errors is not None:
+            # exact similarity scaled the same way as the approximation
+            scaled_errors = self._sample_errors / scale
+        self._error_report.update(LowRankCosineSimilarityProvider._summarize_errors(scaled_errors,
+                                                                                    prefix='scaled_'))
+        self._sample_errors = None
+        logger.info('Low rank similarity error: ' + str(self._error_report))
+        return minimum, scale
+
+    def _measure_error(self, normalized, embedding, seed):
+        """
+        Compares exact and approximate cosine similarity, before
+        scaling into [0, 1], of random distinct gene pairs
+
+        :return: absolute error of each pair or ``None`` if
+                 **error_sample_size** is not set or there are
+                 fewer than 2 genes
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        num_genes = normalized.shape[0]
+        if self._error_sample_size is None or self._error_sample_size < 1 or num_genes < 2:
+            return None
+        rng = np.random.default_rng(seed)
+        rows = rng.integers(0, num_genes, self._error_sample_size)
+        # offset in [1, num_genes) so column never equals row
+        cols = (rows + rng.integers(1, num_genes, self._error_sample_size)) % num_genes
+        exact = np.einsum('ij,ij->i', normalized[rows], normalized[cols])
+        approximate = np.einsum('ij,ij->i', embedding[rows], embedding[cols])
+        return np.abs(exact - approximate)
+
+    @staticmethod
+    def _summarize_errors(errors, prefix=''):
+        """
+        Gets mean_absolute_error, max_absolute_error and rmse of
+        **errors**, each name starting with **prefix**
+
+        :param errors: absolute errors, if ``None`` values are ``None``
+        :type errors: :py:class:`numpy.ndarray`
+        :param prefix: prepended to each name
+        :type prefix: str
+        :return:
+        :rtype: dict
+        """
+        if errors is None:
+            return {prefix + 'mean_absolute_error': None,
+                    prefix + 'max_absolute_error': None,
+                    prefix + 'rmse': None}
+        return {prefix + 'mean_absolute_error': float(np.mean(errors)),
+                prefix + 'max_absolute_error': float(np.max(errors)),
+                prefix + 'rmse': float(np.sqrt(np.mean(errors ** 2)))}
+
+    def get_similarity(self, df):
+        """
+        Same as :py:meth:`CosineSimilarityProvider.get_similarity` using
+        low rank approximation
+
+        :param df: Data with one row per gene
+        :type df: :py:class:`pandas.DataFrame`
+        :raises CellmapshierarchyevalError: If **df** contains NaN values
+        :return: genes by genes approximate similarity
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        self._error_report = None
+        return super().get_similarity(df)
+
+    def get_error_report(self):
+        """
+        Gets approximation error of last similarity matrix computed,
+        ``None`` if none was computed or it was read from cache.
+
+        Has ``num_pairs`` gene pairs sampled, ``mean_absolute_error``,
+        ``max_absolute_error`` and ``rmse`` of their cosine similarity,
+        the same with ``scaled_`` prefix after exact and approximate
+        similarity are both scaled by the min-max scaling applied to the
+        approximate matrix, ``rank`` used and ``captured_variance``,
+        fraction of squared norm of unit length profiles kept by projection
+
+        :return:
+        :rtype: dict
+        """
+        return self._error_report
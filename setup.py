@@ -61,7 +61,8 @@ setup(
     packages=find_packages(include=['cellmaps_hierarchyeval']),
     package_dir={'cellmaps_hierarchyeval': 'cellmaps_hierarchyeval'},
     package_data={'cellmaps_hierarchyeval': ['default_prompt.txt', 'readme_outputs.txt']},
-    scripts=['cellmaps_hierarchyeval/cellmaps_hierarchyevalcmd.py'],
+    scripts=['cellmaps_hierarchyeval/cellmaps_hierarchyevalcmd.py',
+             'cellmaps_hierarchyeval/cellmaps_hierarchyeval_loadtestcmd.py'],
     setup_requires=setup_requirements,
     url=repo_url,
     version=version,
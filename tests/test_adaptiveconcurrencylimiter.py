@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `AdaptiveConcurrencyLimiter` ."""
+
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from cellmaps_hierarchyeval.analysis import AdaptiveConcurrencyLimiter
+from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
+
+
+class TestAdaptiveConcurrencyLimiter(unittest.TestCase):
+    """Tests for `AdaptiveConcurrencyLimiter` ."""
+
+    def test_invalid_limits(self):
+        with self.assertRaises(CellmapshierarchyevalError):
+            AdaptiveConcurrencyLimiter(min_limit=0)
+        with self.assertRaises(CellmapshierarchyevalError):
+            AdaptiveConcurrencyLimiter(min_limit=3, max_limit=2)
+
+    def test_fixed_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2, min_limit=2, max_limit=2)
+        for x in range(10):
+            limiter.release(limiter.acquire())
+        self.assertEqual(2, limiter.get_limit())
+        limiter.release(limiter.acquire(), overloaded=True)
+        self.assertEqual(2, limiter.get_limit())
+
+    def test_increase_while_latency_flat(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, max_limit=4)
+        with patch('time.time', return_value=100.0):
+            for x in range(20):
+                limiter.release(limiter.acquire())
+        self.assertEqual(4, limiter.get_limit())
+        self.assertEqual([1, 2, 3, 4], [h['limit'] for h in limiter.get_history()])
+
+    def test_no_increase_when_latency_grows(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, max_limit=4,
+                                             latency_tolerance=2.0)
+        with patch('time.time', side_effect=[100.0, 101.0, 101.0]):
+            limiter.release(limiter.acquire())
+        self.assertEqual(2, limiter.get_limit())
+        # latency of 5 seconds is more than twice lowest of 1 second
+        with patch('time.time', side_effect=[200.0, 205.0]):
+            limiter.release(limiter.acquire())
+        self.assertEqual(2, limiter._limit)
+
+    def test_decrease_on_overload_once_per_round(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=8, max_limit=8)
+        with patch('time.time', return_value=100.0):
+            tokens = [limiter.acquire() for x in range(4)]
+        with patch('time.time', return_value=101.0):
+            for token in tokens:
+                limiter.release(token, overloaded=True)
+        self.assertEqual(4, limiter.get_limit())
+        with patch('time.time', return_value=102.0):
+            token = limiter.acquire()
+            limiter.release(token, overloaded=True)
+        self.assertEqual(2, limiter.get_limit())
+        with patch('time.time', return_value=103.0):
+            for x in range(3):
+                limiter.release(limiter.acquire(), overloaded=True)
+        self.assertEqual(1, limiter.get_limit())
+
+    def test_release_without_latency(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, max_limit=4)
+        limiter.release(limiter.acquire(), record_latency=False)
+        self.assertEqual(1, limiter.get_limit())
+
+    def test_acquire_blocks_at_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1)
+        token = limiter.acquire()
+        acquired = threading.Event()
+
+        def worker():
+            limiter.release(limiter.acquire())
+            acquired.set()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        time.sleep(0.05)
+        self.assertFalse(acquired.is_set())
+        limiter.release(token)
+        thread.join(timeout=5)
+        self.assertTrue(acquired.is_set())
+
+    def test_try_acquire(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1)
+        token = limiter.try_acquire()
+        self.assertIsNotNone(token)
+        self.assertIsNone(limiter.try_acquire())
+        limiter.release(token, record_latency=False)
+        self.assertIsNotNone(limiter.try_acquire())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `cellmaps_hierarchyeval_loadtestcmd` script."""
+
+import os
+import json
+import tempfile
+import shutil
+
+import unittest
+from cellmaps_hierarchyeval import cellmaps_hierarchyeval_loadtestcmd
+
+
+class TestCellmapshierarchyevalLoadTestCmd(unittest.TestCase):
+    """Tests for `cellmaps_hierarchyeval_loadtestcmd` script."""
+
+    def test_parse_arguments(self):
+        res = cellmaps_hierarchyeval_loadtestcmd._parse_arguments('hi', [])
+        self.assertIsNone(res.ollama)
+        self.assertEqual(['mockmodel'], res.ollama_prompts)
+        self.assertEqual(3, res.num_levels)
+        self.assertEqual(0.0, res.mock_error_rate)
+
+    def test_main_with_mock_server(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            report_file = os.path.join(temp_dir, 'report.json')
+            res = cellmaps_hierarchyeval_loadtestcmd.main(['loadtest.py',
+                                                           '--num_levels', '2',
+                                                           '--branching', '2',
+                                                           '--mock_latency', '0.001',
+                                                           '--ollama_concurrency', '2',
+                                                           '--ollama_prompts', 'a', 'b',
+                                                           '--seed', '1',
+                                                           '--report', report_file])
+            self.assertEqual(0, res)
+            with open(report_file, 'r') as f:
+                report = json.load(f)
+            self.assertEqual(7, report['nodes'])
+            self.assertEqual(14, report['annotated'])
+            self.assertEqual(14, report['server']['requests'])
+            self.assertEqual(2, len(report['calls']))
+            self.assertTrue(report['server']['max_in_flight'] <= 2)
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
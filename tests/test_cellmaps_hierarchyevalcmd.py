@@ -34,6 +34,9 @@ class TestCellmapshierarchyeval(unittest.TestCase):
         self.assertEqual(res.logconf, None)
         self.assertEqual(res.outdir, 'outdir')
         self.assertEqual(res.hierarchy_dir, 'foox')
+        self.assertIsNone(res.perturbseq)
+        self.assertIsNone(res.perturbseq_workers)
+        self.assertIsNone(res.perturbseq_rank)
 
         someargs = ['-vv', '--logconf', 'hi', 'resdir',
                     cellmaps_hierarchyevalcmd.HIERARCHYDIR,
@@ -89,3 +92,66 @@ class TestCellmapshierarchyeval(unittest.TestCase):
 
         finally:
             shutil.rmtree(temp_dir)
+
+    def test_get_ollama_geneset_agents_service_stream(self):
+        res = cellmaps_hierarchyevalcmd.get_ollama_geneset_agents(ollama='http://foo/api/generate',
+                                                                  ollama_prompts=['modela'],
+                                                                  stream=True,
+                                                                  stream_extra_tokens=5)
+        self.assertEqual(1, len(res))
+        query = res[0]._get_query(gene_names=['a'])
+        self.assertTrue(query['stream'])
+        self.assertEqual(5, res[0]._stream_extra_tokens)
+
+    def test_get_concurrency_limiter(self):
+        self.assertIsNone(cellmaps_hierarchyevalcmd.get_concurrency_limiter())
+        limiter = cellmaps_hierarchyevalcmd.get_concurrency_limiter(concurrency=3)
+        self.assertEqual(3, limiter.get_limit())
+        self.assertEqual(3, limiter.get_max_limit())
+        limiter = cellmaps_hierarchyevalcmd.get_concurrency_limiter(max_concurrency=5)
+        self.assertEqual(1, limiter.get_limit())
+        self.assertEqual(5, limiter.get_max_limit())
+
+    def test_get_ollama_geneset_agents_share_limiter(self):
+        res = cellmaps_hierarchyevalcmd.get_ollama_geneset_agents(ollama='http://a/api/generate,'
+                                                                         'http://b/api/generate',
+                                                                  ollama_prompts=['modela', 'modelb'],
+                                                                  max_concurrency=4)
+        self.assertIs(res[0].get_concurrency_limiter(), res[1].get_concurrency_limiter())
+        self.assertIs(res[0].get_endpoint_pool(), res[1].get_endpoint_pool())
+        self.assertEqual(['http://a/api/generate', 'http://b/api/generate'],
+                         res[0].get_endpoint_pool().get_rest_urls())
+        self.assertEqual(4, res[0].get_max_concurrency())
+
+    def test_get_keep_alive(self):
+        self.assertIsNone(cellmaps_hierarchyevalcmd.get_keep_alive())
+        self.assertEqual(-1, cellmaps_hierarchyevalcmd.get_keep_alive('-1'))
+        self.assertEqual(600, cellmaps_hierarchyevalcmd.get_keep_alive('600'))
+        self.assertEqual('30m', cellmaps_hierarchyevalcmd.get_keep_alive('30m'))
+
+    def test_get_ollama_geneset_agents_keep_alive(self):
+        res = cellmaps_hierarchyevalcmd.get_ollama_geneset_agents(ollama='http://a/api/generate',
+                                                                  ollama_prompts=['modela'],
+                                                                  keep_alive='-1')
+        self.assertEqual(-1, res[0]._get_query(gene_names=['a'])['keep_alive'])
+
+    def test_get_ollama_geneset_agents_coalesce(self):
+        res = cellmaps_hierarchyevalcmd.get_ollama_geneset_agents(ollama='http://a/api/generate',
+                                                                  ollama_prompts=['modela', 'modela'])
+        self.assertIsNone(res[0].get_request_coalescer())
+        res = cellmaps_hierarchyevalcmd.get_ollama_geneset_agents(ollama='http://a/api/generate',
+                                                                  ollama_prompts=['modela', 'modela'],
+                                                                  coalesce=True)
+        self.assertIsNotNone(res[0].get_request_coalescer())
+        self.assertIs(res[0].get_request_coalescer(), res[1].get_request_coalescer())
+
+    def test_get_node_selection_policies(self):
+        self.assertIsNone(cellmaps_hierarchyevalcmd.get_node_selection_policies())
+        res = cellmaps_hierarchyevalcmd.get_node_selection_policies(only_unenriched=True,
+                                                                    min_genes=5,
+                                                                    top_n=10)
+        self.assertEqual(['UnenrichedNodeSelectionPolicy',
+                          'MinimumSizeNodeSelectionPolicy',
+                          'TopSizeNodeSelectionPolicy'],
+                         [type(p).__name__ for p in res])
+
@@ -4,6 +4,7 @@
 """Tests for `cellmaps_hierarchyeval` package."""
 
 import os
+import json
 import tempfile
 import shutil
 import unittest
@@ -16,6 +17,8 @@ from cellmaps_utils.provenance import ProvenanceUtil
 from requests import RequestException
 
 from cellmaps_hierarchyeval.analysis import FakeGeneSetAgent
+from cellmaps_hierarchyeval.analysis import OllamaEndpointPool
+from cellmaps_hierarchyeval.analysis import OllamaRestServiceGenesetAgent
 from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
 from cellmaps_hierarchyeval.runner import CellmapshierarchyevalRunner, NiceCXNetworkHelper, CX2NetworkHelper
 
@@ -135,7 +138,7 @@ class TestCellmapshierarchyevalrunner(unittest.TestCase):
         temp_dir = tempfile.mkdtemp()
         try:
             mockannotator = MagicMock()
-            mockannotator.annotate_hierarchy = MagicMock()
+            mockannotator.annotate_hierarchy_with_agents = MagicMock()
             mockannotator.set_hierarchy_helper = MagicMock()
             runner = CellmapshierarchyevalRunner(os.path.join(temp_dir, 'foo'),
                                                  geneset_agents=[gsai],
@@ -143,11 +146,93 @@ class TestCellmapshierarchyevalrunner(unittest.TestCase):
 
             hierarchy = CX2Network()
             runner._annotate_hierarchy_with_geneset_annotators(hierarchy=hierarchy)
-            mockannotator.annotate_hierarchy.assert_called()
+            mockannotator.annotate_hierarchy_with_agents.assert_called_once_with(geneset_agents=[gsai],
+                                                                                 hierarchy=hierarchy,
+                                                                                 close_agents=True)
             mockannotator.set_hierarchy_helper.assert_called()
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_annotate_hierarchy_sets_checkpoint_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mockannotator = MagicMock()
+            runner = CellmapshierarchyevalRunner(temp_dir, geneset_agents=[MagicMock()],
+                                                 geneset_annotator=mockannotator,
+                                                 resume=True)
+            runner._annotate_hierarchy_with_geneset_annotators(hierarchy=CX2Network())
+            mockannotator.set_checkpoint_file.assert_called_once_with(
+                checkpoint_file=os.path.join(temp_dir, 'llm_annotation_checkpoint.jsonl'),
+                resume=True)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_annotate_hierarchy_closes_agents_on_error(self):
+        agents = [MagicMock(), MagicMock()]
+        mockannotator = MagicMock()
+        mockannotator.annotate_hierarchy_with_agents = MagicMock(
+            side_effect=CellmapshierarchyevalError('error'))
+        runner = CellmapshierarchyevalRunner('foo', geneset_agents=agents,
+                                             geneset_annotator=mockannotator)
+        with self.assertRaises(CellmapshierarchyevalError):
+            runner._annotate_hierarchy_with_geneset_annotators(hierarchy=CX2Network())
+        for agent in agents:
+            agent.close.assert_called()
+
+    def test_run_with_perturbseq(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            hier_dir = os.path.join(temp_dir, 'hierarchy')
+            os.makedirs(hier_dir, mode=0o755)
+            ProvenanceUtil().register_rocrate(hier_dir, name='hierarchy1',
+                                              organization_name='hierarchy org',
+                                              project_name='hierarchy project')
+            data_dir = os.path.join(os.path.dirname(__file__), 'data')
+            shutil.copy(os.path.join(data_dir, 'hierarchy_perturb_test.cx2'),
+                        os.path.join(hier_dir, constants.HIERARCHY_NETWORK_PREFIX +
+                                     constants.CX2_SUFFIX))
+            outdir = os.path.join(temp_dir, 'outdir')
+            runner = CellmapshierarchyevalRunner(outdir, hierarchy_dir=hier_dir,
+                                                 skip_term_enrichment=True,
+                                                 input_data_dict={},
+                                                 perturbseq=os.path.join(data_dir,
+                                                                         'sample_perturb_data.csv'))
+            self.assertEqual(0, runner.run())
+
+            hierarchy = CX2NetworkHelper(runner.get_annotated_hierarchy_dest_file()).get_hierarchy()
+            node = hierarchy.get_node(72)['v']
+            self.assertEqual(45, node['PerturbSeq_num_pairs'])
+            self.assertAlmostEqual(7.49, node['PerturbSeq_statistic'], delta=0.01)
+            self.assertTrue(node['PerturbSeq_p_value'] < 1e-10)
+            for node_id, node in hierarchy.get_nodes().items():
+                self.assertIn('PerturbSeq_num_pairs', node['v'])
+
+            with open(runner.get_annotated_hierarchy_as_nodelist_dest_file(), 'r') as f:
+                header = f.readline().rstrip('\t\n').split('\t')
+            self.assertIn('PerturbSeq_statistic', header)
+            self.assertIn('PerturbSeq_p_value', header)
+
+            # approximate similarity from 19 of 20 dimensions
+            runner = CellmapshierarchyevalRunner(os.path.join(temp_dir, 'approx'), hierarchy_dir=hier_dir,
+                                                 skip_term_enrichment=True,
+                                                 input_data_dict={},
+                                                 perturbseq=os.path.join(data_dir,
+                                                                         'sample_perturb_data.csv'),
+                                                 perturbseq_rank=19)
+            self.assertEqual(0, runner.run())
+            hierarchy = CX2NetworkHelper(runner.get_annotated_hierarchy_dest_file()).get_hierarchy()
+            self.assertAlmostEqual(7.49, hierarchy.get_node(72)['v']['PerturbSeq_statistic'], delta=0.5)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_evaluate_perturbseq_requires_cx2(self):
+        self.runner._perturbseq = 'foo.csv'
+        self.runner._hierarchy_helper = NiceCXNetworkHelper('foo.cx')
+        with self.assertRaises(CellmapshierarchyevalError):
+            self.runner._evaluate_perturbseq(MagicMock())
+        self.runner._perturbseq = None
+        self.runner._evaluate_perturbseq(None)
+
     def test_four_node_hierarchy(self):
         temp_dir = tempfile.mkdtemp()
         try:
@@ -178,3 +263,154 @@ class TestCellmapshierarchyevalrunner(unittest.TestCase):
             self.assertEqual(len(attributes_with_raw), len(hierarchy.get_nodes()))
         finally:
             shutil.rmtree(temp_dir)
+
+    def test_write_and_register_llm_statistics(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            pool = OllamaEndpointPool(rest_urls=['http://a/api/generate'])
+            pool.release(pool.acquire(), latency=2.0)
+            agents = [OllamaRestServiceGenesetAgent(endpoint_pool=pool),
+                      OllamaRestServiceGenesetAgent(endpoint_pool=pool),
+                      FakeGeneSetAgent()]
+            prov = MagicMock()
+            prov.register_dataset = MagicMock(return_value='datasetid')
+            runner = CellmapshierarchyevalRunner(temp_dir, geneset_agents=agents,
+                                                 provenance_utils=prov)
+            self.assertEqual('datasetid', runner._write_and_register_llm_statistics())
+            with open(runner.get_llm_statistics_dest_file(), 'r') as f:
+                stats = json.load(f)
+            # shared pool is only reported once
+            self.assertEqual(1, len(stats['endpoints']))
+            self.assertEqual(1, stats['endpoints'][0]['requests'])
+            prov.register_dataset.assert_called_once()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_llm_statistics_time_to_first_token(self):
+        agent = OllamaRestServiceGenesetAgent(rest_url='http://a/api/generate',
+                                              attribute_name_prefix='foo::')
+        agent._time_to_first_tokens.extend([0.3, 0.1, 0.2])
+        runner = CellmapshierarchyevalRunner('foo', geneset_agents=[agent])
+        stats = runner._get_llm_statistics()
+        self.assertEqual(1, len(stats['agents']))
+        self.assertEqual('foo::', stats['agents'][0]['attribute_name_prefix'])
+        ttft = stats['agents'][0]['time_to_first_token']
+        self.assertEqual(3, ttft['count'])
+        self.assertEqual(0.2, ttft['median'])
+        self.assertEqual(0.3, ttft['max'])
+
+    def test_get_llm_call_summary(self):
+        self.assertIsNone(CellmapshierarchyevalRunner._get_llm_call_summary([]))
+        call_metrics = [{'wall_time': float(x), 'retries': x % 2, 'success': x != 3,
+                         'parse_failures': 1 if x in [5, 6] else 0,
+                         'hedges': 1 if x > 95 else 0, 'hedge_wins': 1 if x > 98 else 0,
+                         'eval_count': 10, 'eval_duration': 500000000,
+                         'prompt_eval_count': 4, 'load_duration': 1000000000}
+                        for x in range(1, 101)]
+        summary = CellmapshierarchyevalRunner._get_llm_call_summary(call_metrics)
+        self.assertEqual(100, summary['count'])
+        self.assertEqual(1, summary['failures'])
+        self.assertEqual(50, summary['retries'])
+        self.assertEqual(2, summary['parse_failures'])
+        self.assertEqual(5, summary['hedges'])
+        self.assertEqual(2, summary['hedge_wins'])
+        self.assertAlmostEqual(50.5, summary['wall_time']['p50'])
+        self.assertAlmostEqual(95.05, summary['wall_time']['p95'])
+        self.assertAlmostEqual(99.01, summary['wall_time']['p99'])
+        self.assertEqual(100.0, summary['wall_time']['max'])
+        self.assertEqual(400, summary['prompt_tokens'])
+        self.assertEqual(1000, summary['generated_tokens'])
+        self.assertAlmostEqual(100.0, summary['load_duration'])
+        self.assertEqual(100, summary['cold_starts'])
+        self.assertIsNone(summary['warm_wall_time'])
+        self.assertAlmostEqual(20.0, summary['tokens_per_second'])
+
+    def test_get_llm_call_summary_excludes_cold_starts(self):
+        call_metrics = [{'wall_time': 30.0, 'success': True, 'load_duration': 25000000000,
+                         'eval_count': 10, 'eval_duration': 1000000000},
+                        {'wall_time': 2.0, 'success': True, 'load_duration': 1000000,
+                         'eval_count': 10, 'eval_duration': 1000000000},
+                        {'wall_time': 4.0, 'success': True, 'load_duration': None}]
+        summary = CellmapshierarchyevalRunner._get_llm_call_summary(call_metrics)
+        self.assertEqual(1, summary['cold_starts'])
+        self.assertEqual(0, summary['hedges'])
+        self.assertAlmostEqual(25.001, summary['load_duration'])
+        self.assertEqual(30.0, summary['wall_time']['max'])
+        self.assertEqual(4.0, summary['warm_wall_time']['max'])
+        self.assertAlmostEqual(3.0, summary['warm_wall_time']['mean'])
+        self.assertAlmostEqual(10.0, summary['tokens_per_second'])
+
+    def test_get_llm_statistics_warm_up(self):
+        agent = MagicMock()
+        agent.get_attribute_name_prefix.return_value = 'foo::'
+        agent.get_call_metrics.return_value = []
+        agent.get_time_to_first_tokens.return_value = []
+        agent.get_endpoint_pool.return_value = None
+        agent.get_concurrency_limiter.return_value = None
+        agent.get_request_coalescer.return_value = None
+        agent.get_warm_up_metrics.return_value = [{'url': 'http://a/api/generate',
+                                                   'model': 'foo', 'wall_time': 3.0,
+                                                   'load_duration': 2500000000,
+                                                   'success': True, 'error': None}]
+        runner = CellmapshierarchyevalRunner(outdir='/foo', geneset_agents=[agent])
+        stats = runner._get_llm_statistics()
+        self.assertEqual(1, len(stats['warm_up']))
+        self.assertEqual('foo::', stats['warm_up'][0]['attribute_name_prefix'])
+        self.assertAlmostEqual(2.5, stats['warm_up'][0]['load_duration'])
+        self.assertEqual([], stats['coalescing'])
+
+    def test_write_and_register_llm_call_metrics(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://a/api/generate',
+                                                  attribute_name_prefix='foo::')
+            agent._record_call_metrics(1.5, call_info={'status_code': 200,
+                                                       'response': {'eval_count': 3,
+                                                                    'eval_duration': 1000000000}})
+            prov = MagicMock()
+            prov.register_dataset = MagicMock(return_value='datasetid')
+            runner = CellmapshierarchyevalRunner(temp_dir, geneset_agents=[agent,
+                                                                           FakeGeneSetAgent()],
+                                                 provenance_utils=prov)
+            self.assertEqual('datasetid', runner._write_and_register_llm_call_metrics())
+            with open(runner.get_llm_call_metrics_dest_file(), 'r') as f:
+                entries = [json.loads(line) for line in f]
+            self.assertEqual(1, len(entries))
+            self.assertEqual('foo::', entries[0]['attribute_name_prefix'])
+            self.assertEqual(1.5, entries[0]['wall_time'])
+            self.assertEqual(3, entries[0]['eval_count'])
+            stats = runner._get_llm_statistics()
+            self.assertEqual(1, len(stats['calls']))
+            self.assertEqual('foo::', stats['calls'][0]['attribute_name_prefix'])
+            self.assertEqual(3.0, stats['calls'][0]['tokens_per_second'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_write_and_register_llm_statistics_logs_to_mlflow(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://a/api/generate',
+                                                  attribute_name_prefix='ollama_llama3:8b::')
+            agent._record_call_metrics(2.0, call_info={'response': {'eval_count': 4,
+                                                                    'eval_duration': 2000000000}})
+            with patch('cellmaps_hierarchyeval.runner.mlflow', create=True) as mock_mlflow:
+                runner = CellmapshierarchyevalRunner(temp_dir, geneset_agents=[agent],
+                                                     provenance_utils=MagicMock(),
+                                                     log_fairops=True,
+                                                     input_data_dict={'min_comp_size': 4,
+                                                                      'max_fdr': 0.05,
+                                                                      'min_jaccard_index': 0.1,
+                                                                      'corum': 'a', 'go_cc': 'b',
+                                                                      'hpa': 'c'})
+                runner._write_and_register_llm_statistics()
+            logged = {c[0][0]: c[0][1] for c in mock_mlflow.log_metric.call_args_list}
+            self.assertEqual(2.0, logged['llm_ollama_llama3_8b_wall_time_p50'])
+            self.assertEqual(2.0, logged['llm_ollama_llama3_8b_tokens_per_second'])
+            self.assertEqual(1, logged['llm_ollama_llama3_8b_calls'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_write_and_register_llm_statistics_no_rest_agents(self):
+        runner = CellmapshierarchyevalRunner('foo', geneset_agents=[FakeGeneSetAgent()])
+        self.assertIsNone(runner._write_and_register_llm_statistics())
+
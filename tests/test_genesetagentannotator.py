@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `GeneSetAgentAnnotator` ."""
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from cellmaps_hierarchyeval.analysis import GenesetAgent
+from cellmaps_hierarchyeval.runner import GeneSetAgentAnnotator, CX2NetworkHelper
+from cellmaps_hierarchyeval.runner import UnenrichedNodeSelectionPolicy
+from cellmaps_hierarchyeval.runner import MinimumSizeNodeSelectionPolicy
+from cellmaps_hierarchyeval.runner import TopSizeNodeSelectionPolicy
+from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
+
+
+class ConcurrencyTrackingAgent(GenesetAgent):
+    """
+    Agent that records the most gene sets it was asked
+    to annotate at the same time
+    """
+    def __init__(self, max_concurrency=1, attribute_name_prefix='track::',
+                 started=None):
+        super().__init__(attribute_name_prefix=attribute_name_prefix)
+        self._max_concurrency = max_concurrency
+        self._lock = threading.Lock()
+        self._started = started
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.closed_in_flight = None
+
+    def get_max_concurrency(self):
+        return self._max_concurrency
+
+    def close(self):
+        self.closed_in_flight = self.in_flight
+
+    def annotate_gene_set(self, gene_names=None):
+        if self._started is not None:
+            self._started.set()
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.02)
+        with self._lock:
+            self.in_flight -= 1
+        return 'proc ' + str(len(gene_names)), '0.5', 'raw'
+
+
+class TestGeneSetAgentAnnotator(unittest.TestCase):
+    """Tests for `GeneSetAgentAnnotator` ."""
+
+    def setUp(self):
+        self.helper = CX2NetworkHelper(os.path.join(os.path.dirname(__file__),
+                                                    'data', 'hierarchy.cx2'))
+        self.hierarchy = self.helper.get_hierarchy()
+        self.annotator = GeneSetAgentAnnotator()
+        self.annotator.set_hierarchy_helper(self.helper)
+
+    def _get_annotated_nodes(self, prefix='track::'):
+        res = {}
+        for node_id, node in self.hierarchy.get_nodes().items():
+            if prefix + '_process' in node['v']:
+                res[node_id] = node['v']
+        return res
+
+    def test_annotate_hierarchy_sequential(self):
+        agent = ConcurrencyTrackingAgent()
+        self.annotator.annotate_hierarchy(geneset_agent=agent, hierarchy=self.hierarchy)
+        self.assertEqual(1, agent.max_in_flight)
+        annotated = self._get_annotated_nodes()
+        self.assertEqual(len(self.hierarchy.get_nodes()), len(annotated))
+        for node_id, attrs in annotated.items():
+            genes = self.helper.get_node_genes(None, self.hierarchy.get_node(node_id))
+            self.assertEqual('proc ' + str(len(genes)), attrs['track::_process'])
+            self.assertEqual('0.5', attrs['track::_confidence'])
+            self.assertEqual('raw', attrs['track::_raw'])
+
+    def test_annotate_hierarchy_concurrent(self):
+        agent = ConcurrencyTrackingAgent(max_concurrency=3)
+        self.annotator.annotate_hierarchy(geneset_agent=agent, hierarchy=self.hierarchy)
+        self.assertTrue(agent.max_in_flight > 1)
+        self.assertTrue(agent.max_in_flight <= 3)
+        self.assertEqual(len(self.hierarchy.get_nodes()), len(self._get_annotated_nodes()))
+
+    def test_annotate_hierarchy_with_agents_side_by_side(self):
+        started = threading.Event()
+        slow_agent = ConcurrencyTrackingAgent(max_concurrency=1,
+                                              attribute_name_prefix='slow::')
+        other_agent = ConcurrencyTrackingAgent(max_concurrency=2,
+                                               attribute_name_prefix='other::',
+                                               started=started)
+        original_annotate = slow_agent.annotate_gene_set
+
+        def wait_for_other(gene_names=None):
+            # would hang if agents ran one after the other
+            self.assertTrue(started.wait(timeout=5))
+            return original_annotate(gene_names=gene_names)
+
+        slow_agent.annotate_gene_set = wait_for_other
+        self.annotator.annotate_hierarchy_with_agents(geneset_agents=[slow_agent,
+                                                                      other_agent],
+                                                      hierarchy=self.hierarchy,
+                                                      close_agents=True)
+        self.assertEqual(1, slow_agent.max_in_flight)
+        self.assertTrue(other_agent.max_in_flight <= 2)
+        num_nodes = len(self.hierarchy.get_nodes())
+        self.assertEqual(num_nodes, len(self._get_annotated_nodes(prefix='slow::')))
+        self.assertEqual(num_nodes, len(self._get_annotated_nodes(prefix='other::')))
+        self.assertEqual(0, slow_agent.closed_in_flight)
+        self.assertEqual(0, other_agent.closed_in_flight)
+
+    def test_annotate_hierarchy_with_agents_does_not_close_by_default(self):
+        agent = ConcurrencyTrackingAgent()
+        self.annotator.annotate_hierarchy_with_agents(geneset_agents=[agent],
+                                                      hierarchy=self.hierarchy)
+        self.assertIsNone(agent.closed_in_flight)
+
+    def test_annotate_hierarchy_writes_checkpoint(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            checkpoint_file = os.path.join(temp_dir, 'checkpoint.jsonl')
+            self.annotator.set_checkpoint_file(checkpoint_file=checkpoint_file)
+            agent = ConcurrencyTrackingAgent()
+            self.annotator.annotate_hierarchy(geneset_agent=agent, hierarchy=self.hierarchy)
+            with open(checkpoint_file, 'r') as f:
+                entries = [json.loads(line) for line in f]
+            self.assertEqual(len(self.hierarchy.get_nodes()), len(entries))
+            for entry in entries:
+                self.assertEqual('track::', entry['attribute_name_prefix'])
+                node = self.hierarchy.get_node(entry['node_id'])
+                self.assertEqual(node['v']['track::_process'], entry['process'])
+                self.assertEqual('0.5', entry['confidence'])
+                self.assertEqual('raw', entry['raw'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_annotate_hierarchy_resume(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            checkpoint_file = os.path.join(temp_dir, 'checkpoint.jsonl')
+            node_ids = list(self.hierarchy.get_nodes().keys())
+            with open(checkpoint_file, 'w') as f:
+                f.write(json.dumps({'attribute_name_prefix': 'track::',
+                                    'node_id': node_ids[0],
+                                    'process': 'saved',
+                                    'confidence': '0.9',
+                                    'raw': 'saved raw'}) + '\n')
+                f.write(json.dumps({'attribute_name_prefix': 'other::',
+                                    'node_id': node_ids[1],
+                                    'process': 'other',
+                                    'confidence': '0.1',
+                                    'raw': 'other raw'}) + '\n')
+                # partial line from job that was killed
+                f.write('{"attribute_name_prefix": "track::", "node_')
+            self.annotator.set_checkpoint_file(checkpoint_file=checkpoint_file,
+                                               resume=True)
+            agent = ConcurrencyTrackingAgent()
+            agent.annotate_gene_set = MagicMock(return_value=('new', '0.5', 'new raw'))
+            self.annotator.annotate_hierarchy(geneset_agent=agent, hierarchy=self.hierarchy)
+            self.assertEqual(len(node_ids) - 1, agent.annotate_gene_set.call_count)
+            self.assertEqual('saved', self.hierarchy.get_node(node_ids[0])['v']['track::_process'])
+            self.assertEqual('0.9', self.hierarchy.get_node(node_ids[0])['v']['track::_confidence'])
+            self.assertEqual('new', self.hierarchy.get_node(node_ids[1])['v']['track::_process'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_invalid_order(self):
+        with self.assertRaises(CellmapshierarchyevalError):
+            GeneSetAgentAnnotator(order='foo')
+
+    def _get_call_order(self, annotator):
+        agent = ConcurrencyTrackingAgent()
+        calls = []
+        agent.annotate_gene_set = MagicMock(side_effect=lambda gene_names=None:
+                                            calls.append(len(gene_names)) or ('p', '0.5', 'raw'))
+        annotator.set_hierarchy_helper(self.helper)
+        annotator.annotate_hierarchy(geneset_agent=agent, hierarchy=self.hierarchy)
+        return calls
+
+    def test_size_order(self):
+        calls = self._get_call_order(GeneSetAgentAnnotator())
+        self.assertEqual(sorted(calls, reverse=True), calls)
+        self.assertEqual(23, calls[0])
+
+    def test_depth_order(self):
+        depths = GeneSetAgentAnnotator(order=GeneSetAgentAnnotator.DEPTH_ORDER)
+        depths.set_hierarchy_helper(self.helper)
+        node_depths = depths._get_node_depths(self.hierarchy)
+        self.assertEqual(0, node_depths[0])
+        self.assertEqual(1, node_depths[3])
+        self.assertEqual(2, node_depths[4])
+        calls = self._get_call_order(GeneSetAgentAnnotator(order=GeneSetAgentAnnotator.DEPTH_ORDER))
+        # root, then its children largest first, then leaves
+        self.assertEqual([23, 11, 8, 6, 4, 4, 4, 4], calls)
+
+    def test_max_requests(self):
+        annotator = GeneSetAgentAnnotator(max_requests=3)
+        annotator.set_hierarchy_helper(self.helper)
+        agent = ConcurrencyTrackingAgent()
+        agent.annotate_gene_set = MagicMock(return_value=('p', '0.5', 'raw'))
+        annotator.annotate_hierarchy_with_agents(geneset_agents=[agent],
+                                                 hierarchy=self.hierarchy,
+                                                 close_agents=True)
+        self.assertEqual(3, agent.annotate_gene_set.call_count)
+        processes = [n['v']['track::_process'] for n in self.hierarchy.get_nodes().values()]
+        self.assertEqual(3, processes.count('p'))
+        self.assertEqual(len(processes) - 3, processes.count(''))
+        self.assertEqual(0, agent.closed_in_flight)
+
+    def test_time_budget(self):
+        annotator = GeneSetAgentAnnotator(time_budget=0.05)
+        annotator.set_hierarchy_helper(self.helper)
+        agent = ConcurrencyTrackingAgent()
+        original_annotate = agent.annotate_gene_set
+
+        def slow_annotate(gene_names=None):
+            time.sleep(0.1)
+            return original_annotate(gene_names=gene_names)
+
+        agent.annotate_gene_set = slow_annotate
+        annotator.annotate_hierarchy(geneset_agent=agent, hierarchy=self.hierarchy)
+        processes = [n['v']['track::_process'] for n in self.hierarchy.get_nodes().values()]
+        self.assertEqual(1, len([p for p in processes if p != '']))
+
+    def test_selection_policies(self):
+        # node 1 has accepted enrichment term, node 2 has empty one
+        self.hierarchy.set_node_attribute(1, 'CORUM_terms', 'foo')
+        self.hierarchy.set_node_attribute(2, 'CORUM_terms', '')
+        annotator = GeneSetAgentAnnotator(selection_policies=[UnenrichedNodeSelectionPolicy(),
+                                                              MinimumSizeNodeSelectionPolicy(min_size=5),
+                                                              TopSizeNodeSelectionPolicy(top_n=2)])
+        calls = self._get_call_order(annotator)
+        # 23 gene root and 8 gene node 2; node 1 with 11 genes is enriched
+        self.assertEqual([23, 8], calls)
+        for node_id, node in self.hierarchy.get_nodes().items():
+            if node_id in [0, 2]:
+                self.assertEqual('p', node['v']['track::_process'])
+            else:
+                self.assertEqual('', node['v']['track::_process'])
+                self.assertEqual('', node['v']['track::_confidence'])
+                self.assertEqual('', node['v']['track::_raw'])
+
+    def test_warm_up(self):
+        annotator = GeneSetAgentAnnotator(warm_up=True)
+        annotator.set_hierarchy_helper(self.helper)
+        agent = ConcurrencyTrackingAgent()
+        events = []
+        agent.warm_up = MagicMock(side_effect=lambda: events.append('warm_up'))
+        agent.annotate_gene_set = MagicMock(side_effect=lambda gene_names=None:
+                                            events.append('annotate') or ('p', '0.5', 'raw'))
+        failing_agent = ConcurrencyTrackingAgent(attribute_name_prefix='fail::')
+        failing_agent.warm_up = MagicMock(side_effect=Exception('no model'))
+        annotator.annotate_hierarchy_with_agents(geneset_agents=[agent, failing_agent],
+                                                 hierarchy=self.hierarchy)
+        self.assertEqual('warm_up', events[0])
+        self.assertEqual(8, events.count('annotate'))
+        failing_agent.warm_up.assert_called_once()
+        for node in self.hierarchy.get_nodes().values():
+            self.assertTrue(node['v']['fail::_process'].startswith('proc'))
+
+        # no warm up by default
+        agent.warm_up.reset_mock()
+        self.annotator.annotate_hierarchy(geneset_agent=agent, hierarchy=self.hierarchy)
+        agent.warm_up.assert_not_called()
+
+    def test_annotate_hierarchy_batches_small_gene_sets(self):
+        agent = ConcurrencyTrackingAgent()
+        agent.get_batch_size = MagicMock(return_value=3)
+        agent.is_batchable = MagicMock(side_effect=lambda gene_names=None: len(gene_names) <= 4)
+        agent.annotate_gene_sets = MagicMock(side_effect=lambda gene_sets=None:
+                                             [('batch ' + str(len(gene_sets)), '0.1', 'raw')
+                                              for _ in gene_sets])
+        self.annotator.annotate_hierarchy(geneset_agent=agent, hierarchy=self.hierarchy)
+        # four leaves with 4 genes each are packed 3 + 1
+        self.assertEqual(1, agent.annotate_gene_sets.call_count)
+        processes = [n['v']['track::_process'] for n in self.hierarchy.get_nodes().values()]
+        self.assertEqual(3, processes.count('batch 3'))
+        self.assertEqual(1, processes.count('proc 4'))
+        self.assertEqual(5, len([p for p in processes if p.startswith('proc')]))
+
+
+if __name__ == '__main__':
+    unittest.main()
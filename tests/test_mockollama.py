@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `mockollama` module."""
+
+import json
+import unittest
+
+import requests
+
+from cellmaps_hierarchyeval.analysis import OllamaRestServiceGenesetAgent
+from cellmaps_hierarchyeval.analysis import OllamaEndpointPool
+from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
+from cellmaps_hierarchyeval.mockollama import MockOllamaServer
+from cellmaps_hierarchyeval.mockollama import AnnotationLoadTest
+from cellmaps_hierarchyeval.mockollama import create_synthetic_hierarchy
+from cellmaps_hierarchyeval.runner import GeneSetAgentAnnotator
+
+
+class TestMockOllamaServer(unittest.TestCase):
+    """Tests for `MockOllamaServer` ."""
+
+    def setUp(self):
+        self.server = MockOllamaServer(seed=1).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(CellmapshierarchyevalError):
+            MockOllamaServer(latency_distribution='foo')
+        with self.assertRaises(CellmapshierarchyevalError):
+            MockOllamaServer(error_rate=2)
+        with self.assertRaises(CellmapshierarchyevalError):
+            MockOllamaServer().get_base_url()
+
+    def test_version(self):
+        response = requests.get(self.server.get_base_url() + '/api/version', timeout=5)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(MockOllamaServer.VERSION, response.json()['version'])
+
+    def test_generate(self):
+        response = requests.post(self.server.get_generate_url(),
+                                 json={'model': 'foo', 'prompt': 'hi a,b', 'stream': False},
+                                 timeout=5)
+        self.assertEqual(200, response.status_code)
+        data = response.json()
+        self.assertTrue(data['done'])
+        self.assertTrue(data['response'].startswith('Process: Mock process 1\n'
+                                                    'Confidence Score: 0.'))
+        self.assertEqual(2, data['prompt_eval_count'])
+        self.assertEqual(1, self.server.get_statistics()['requests'])
+
+    def test_generate_stream(self):
+        response = requests.post(self.server.get_generate_url(),
+                                 json={'model': 'foo', 'prompt': 'hi'},
+                                 stream=True, timeout=5)
+        chunks = [json.loads(line) for line in response.iter_lines() if line]
+        self.assertTrue(len(chunks) > 2)
+        self.assertTrue(chunks[-1]['done'])
+        self.assertEqual(len(chunks) - 1, chunks[-1]['eval_count'])
+        self.assertTrue(''.join(c['response'] for c in chunks).startswith('Process: Mock'))
+
+    def test_generate_batch_and_structured(self):
+        response = requests.post(self.server.get_generate_url(),
+                                 json={'model': 'foo', 'stream': False,
+                                       'prompt': 'task\n\nSection 1: a,b\nSection 2: c\n'},
+                                 timeout=5)
+        out = response.json()['response']
+        self.assertEqual(2, len(OllamaRestServiceGenesetAgent._split_batch_output(out, 2)))
+        response = requests.post(self.server.get_generate_url(),
+                                 json={'model': 'foo', 'stream': False, 'prompt': 'hi',
+                                       'format': OllamaRestServiceGenesetAgent.STRUCTURED_OUTPUT_SCHEMA},
+                                 timeout=5)
+        process, confidence = OllamaRestServiceGenesetAgent._parse_structured_output(response.json()['response'])
+        self.assertEqual('Mock process 2', process)
+        self.assertIsNotNone(confidence)
+
+    def test_errors_and_load_time(self):
+        server = MockOllamaServer(error_rate=1.0, error_status_code=500).start()
+        try:
+            response = requests.post(server.get_generate_url(),
+                                     json={'model': 'foo', 'prompt': 'hi'}, timeout=5)
+            self.assertEqual(500, response.status_code)
+            self.assertEqual(1, server.get_statistics()['errors'])
+        finally:
+            server.stop()
+        server = MockOllamaServer(load_time=0.01).start()
+        try:
+            query = {'model': 'foo', 'stream': False}
+            first = requests.post(server.get_generate_url(), json=query, timeout=5).json()
+            second = requests.post(server.get_generate_url(), json=query, timeout=5).json()
+            self.assertEqual(10000000, first['load_duration'])
+            self.assertEqual(0, second['load_duration'])
+        finally:
+            server.stop()
+
+    def test_latency_distributions(self):
+        for dist in MockOllamaServer.LATENCY_DISTRIBUTIONS:
+            server = MockOllamaServer(latency=0.5, latency_distribution=dist, seed=2)
+            latencies = [server._get_latency() for _ in range(2000)]
+            self.assertAlmostEqual(0.5, sum(latencies) / len(latencies), delta=0.05)
+
+
+class TestAnnotationLoadTest(unittest.TestCase):
+    """Tests for `AnnotationLoadTest` ."""
+
+    def test_create_synthetic_hierarchy(self):
+        hierarchy = create_synthetic_hierarchy(num_levels=2, branching=2,
+                                               min_genes=4, max_genes=4)
+        self.assertEqual(7, len(hierarchy.get_nodes()))
+        self.assertEqual(6, len(hierarchy.get_edges()))
+        self.assertEqual(16, hierarchy.get_node(0)['v']['CD_MemberList_Size'])
+        self.assertEqual(16, len(hierarchy.get_node(0)['v']['CD_MemberList'].split(' ')))
+
+    def test_run_no_agents(self):
+        with self.assertRaises(CellmapshierarchyevalError):
+            AnnotationLoadTest().run()
+
+    def test_run_with_retries(self):
+        server = MockOllamaServer(latency=0.001, error_rate=0.2, seed=3).start()
+        try:
+            pool = OllamaEndpointPool(rest_urls=[server.get_generate_url()],
+                                      base_backoff=0.01)
+            agent = OllamaRestServiceGenesetAgent(endpoint_pool=pool, model='foo',
+                                                  prompt='hi {GENE_SET}', max_retries=10,
+                                                  stream=True)
+            hierarchy = create_synthetic_hierarchy(num_levels=2, branching=3, seed=1)
+            report = AnnotationLoadTest(geneset_agents=[agent], hierarchy=hierarchy,
+                                        geneset_annotator=GeneSetAgentAnnotator()).run()
+            self.assertEqual(13, report['nodes'])
+            self.assertEqual(13, report['annotated'])
+            stats = server.get_statistics()
+            self.assertEqual(stats['requests'], report['requests'])
+            self.assertTrue(report['requests_per_second'] > 0)
+            self.assertEqual(13, report['calls'][0]['count'])
+            self.assertEqual(stats['errors'], report['calls'][0]['retries'])
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
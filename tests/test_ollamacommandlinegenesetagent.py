@@ -7,11 +7,12 @@ import os
 import tempfile
 import shutil
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 
 
 from cellmaps_hierarchyeval.analysis import GenesetAgent
 from cellmaps_hierarchyeval.analysis import OllamaCommandLineGeneSetAgent
+from cellmaps_hierarchyeval.analysis import OllamaServeProcess
 from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
 
 
@@ -47,7 +48,156 @@ class TestOllamaCommandLineGeneSetAgent(unittest.TestCase):
                                    'Process: someproc\nConfidence Score: '
                                    '0.50\nsome output'))
 
-
-
-
+    def test_annotate_gene_set_with_workers(self):
+        response = MagicMock()
+        response.status_code = 200
+        response.json = MagicMock(return_value={'response': 'Process: someproc\n'
+                                                            'Confidence Score: 0.50\n'
+                                                            'some output\n'})
+        mock_serve = MagicMock()
+        mock_serve.get_generate_url = MagicMock(return_value='http://127.0.0.1:1/api/generate')
+        with patch('requests.post', return_value=response) as mock_post:
+            agent = OllamaCommandLineGeneSetAgent(prompt=None, num_workers=2,
+                                                  model='foo')
+            with patch.object(agent, '_get_serve_process', return_value=mock_serve):
+                res = agent.annotate_gene_set(['gene1', 'gene2'])
+            self.assertEqual(res, ('someproc', '0.50',
+                                   'Process: someproc\nConfidence Score: '
+                                   '0.50\nsome output'))
+            self.assertEqual('foo', mock_post.call_args[1]['json']['model'])
+            self.assertEqual('http://127.0.0.1:1/api/generate', mock_post.call_args[0][0])
+
+    def test_warm_up_with_workers_and_keep_alive(self):
+        response = MagicMock()
+        response.status_code = 200
+        response.json = MagicMock(return_value={'response': '', 'done': True,
+                                                'load_duration': 7000})
+        mock_serve = MagicMock()
+        mock_serve.get_generate_url = MagicMock(return_value='http://127.0.0.1:1/api/generate')
+        with patch('requests.post', return_value=response) as mock_post:
+            agent = OllamaCommandLineGeneSetAgent(prompt=None, num_workers=1,
+                                                  model='foo', keep_alive='1h')
+            with patch.object(agent, '_get_serve_process', return_value=mock_serve):
+                agent.warm_up()
+                self.assertEqual({'model': 'foo', 'stream': False, 'keep_alive': '1h'},
+                                 mock_post.call_args[1]['json'])
+                agent.annotate_gene_set(['gene1'])
+                self.assertEqual('1h', mock_post.call_args[1]['json']['keep_alive'])
+        self.assertEqual(7000, agent.get_warm_up_metrics()[0]['load_duration'])
+
+    def test_warm_up_without_workers(self):
+        with patch('requests.post') as mock_post:
+            agent = OllamaCommandLineGeneSetAgent(prompt=None, model='foo')
+            agent.warm_up()
+            mock_post.assert_not_called()
+        self.assertEqual([], agent.get_warm_up_metrics())
+
+    def test_annotate_gene_set_with_workers_records_call_metrics(self):
+        response = MagicMock()
+        response.status_code = 200
+        response.json = MagicMock(return_value={'response': 'Process: someproc\n',
+                                                'prompt_eval_count': 12,
+                                                'eval_count': 30,
+                                                'eval_duration': 3000000000,
+                                                'load_duration': 5000})
+        with patch('requests.post', return_value=response):
+            agent = OllamaCommandLineGeneSetAgent(prompt=None, num_workers=1,
+                                                  model='foo')
+            with patch.object(agent, '_get_serve_process', return_value=MagicMock()):
+                agent.annotate_gene_set(['gene1'])
+        metrics = agent.get_call_metrics()
+        self.assertEqual(1, len(metrics))
+        self.assertEqual('foo', metrics[0]['model'])
+        self.assertEqual(200, metrics[0]['status_code'])
+        self.assertTrue(metrics[0]['success'])
+        self.assertEqual(12, metrics[0]['prompt_eval_count'])
+        self.assertEqual(30, metrics[0]['eval_count'])
+        self.assertEqual(3000000000, metrics[0]['eval_duration'])
+        self.assertEqual(5000, metrics[0]['load_duration'])
+        self.assertIsNone(metrics[0]['total_duration'])
+
+    def test_annotate_gene_set_records_failed_call_metrics(self):
+        with patch.object(OllamaCommandLineGeneSetAgent, '_run_cmd',
+                          return_value=(1, '', 'boom')):
+            agent = OllamaCommandLineGeneSetAgent(prompt=None)
+            with self.assertRaises(CellmapshierarchyevalError):
+                agent.annotate_gene_set(['gene1'])
+        metrics = agent.get_call_metrics()
+        self.assertEqual(1, len(metrics))
+        self.assertFalse(metrics[0]['success'])
+        self.assertIsNone(metrics[0]['eval_count'])
+
+    def test_annotate_gene_set_with_workers_error(self):
+        response = MagicMock()
+        response.status_code = 500
+        response.text = 'boom'
+        mock_serve = MagicMock()
+        with patch('requests.post', return_value=response):
+            agent = OllamaCommandLineGeneSetAgent(prompt=None, num_workers=1)
+            with patch.object(agent, '_get_serve_process', return_value=mock_serve):
+                with self.assertRaises(CellmapshierarchyevalError) as ce:
+                    agent.annotate_gene_set(['gene1'])
+            self.assertTrue('non zero exit code' in str(ce.exception))
+
+    def test_annotate_gene_set_with_workers_invalid_json(self):
+        response = MagicMock()
+        response.status_code = 200
+        response.json = MagicMock(side_effect=ValueError('bad json'))
+        with patch('requests.post', return_value=response):
+            agent = OllamaCommandLineGeneSetAgent(prompt=None, num_workers=1)
+            with patch.object(agent, '_get_serve_process', return_value=MagicMock()):
+                self.assertEqual((1, None, 'Unable to parse response: bad json'),
+                                 agent._run_on_server('hi'))
+
+    def test_get_max_concurrency(self):
+        self.assertEqual(1, OllamaCommandLineGeneSetAgent(prompt=None).get_max_concurrency())
+        self.assertEqual(4, OllamaCommandLineGeneSetAgent(prompt=None,
+                                                          num_workers=4).get_max_concurrency())
+
+    def test_close_stops_serve_process(self):
+        agent = OllamaCommandLineGeneSetAgent(prompt=None, num_workers=1)
+        mock_serve = MagicMock()
+        agent._serve_process = mock_serve
+        agent.close()
+        mock_serve.stop.assert_called_once()
+        self.assertIsNone(agent._serve_process)
+
+
+class TestOllamaServeProcess(unittest.TestCase):
+    """Tests for `OllamaServeProcess` ."""
+
+    def test_start_and_stop(self):
+        mock_process = MagicMock()
+        mock_process.poll = MagicMock(return_value=None)
+        response = MagicMock()
+        response.status_code = 200
+        with patch('subprocess.Popen', return_value=mock_process) as mock_popen, \
+                patch('requests.get', return_value=response):
+            serve = OllamaServeProcess(ollama_binary='/bin/ollama', port=1234,
+                                       num_parallel=3)
+            serve.start()
+            self.assertEqual(['/bin/ollama', 'serve'], mock_popen.call_args[0][0])
+            env = mock_popen.call_args[1]['env']
+            self.assertEqual('127.0.0.1:1234', env['OLLAMA_HOST'])
+            self.assertEqual('3', env['OLLAMA_NUM_PARALLEL'])
+            self.assertEqual('http://127.0.0.1:1234/api/generate', serve.get_generate_url())
+            self.assertTrue(serve.is_running())
+
+            # already running so should not start another process
+            serve.start()
+            self.assertEqual(1, mock_popen.call_count)
+
+            serve.stop()
+            mock_process.terminate.assert_called_once()
+            self.assertFalse(serve.is_running())
+
+    def test_start_process_exits(self):
+        mock_process = MagicMock()
+        mock_process.poll = MagicMock(return_value=1)
+        mock_process.returncode = 1
+        with patch('subprocess.Popen', return_value=mock_process):
+            serve = OllamaServeProcess(ollama_binary='/bin/ollama', port=1234)
+            with self.assertRaises(CellmapshierarchyevalError) as ce:
+                serve.start()
+            self.assertTrue('exited with code: 1' in str(ce.exception))
 
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `OllamaEndpointPool` ."""
+
+import unittest
+from unittest.mock import patch, MagicMock
+
+import requests
+
+from cellmaps_hierarchyeval.analysis import OllamaEndpointPool
+from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
+
+
+class TestOllamaEndpointPool(unittest.TestCase):
+    """Tests for `OllamaEndpointPool` ."""
+
+    def test_get_probe_url(self):
+        self.assertEqual('http://foo:11434/api/version',
+                         OllamaEndpointPool._get_probe_url('http://foo:11434/api/generate'))
+        self.assertEqual('http://foo/api/version',
+                         OllamaEndpointPool._get_probe_url('http://foo/'))
+
+    def test_acquire_no_endpoints(self):
+        pool = OllamaEndpointPool()
+        with self.assertRaises(CellmapshierarchyevalError) as ce:
+            pool.acquire()
+        self.assertEqual('No ollama endpoints configured', str(ce.exception))
+
+    def test_acquire_least_outstanding(self):
+        pool = OllamaEndpointPool(rest_urls=['http://a', 'http://b'])
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertNotEqual(first, second)
+        pool.release(first, latency=1.0)
+        self.assertEqual(first, pool.acquire())
+
+    def test_acquire_exclude(self):
+        pool = OllamaEndpointPool(rest_urls=['http://a', 'http://b'])
+        self.assertEqual('http://b', pool.acquire(exclude=['http://a']))
+        self.assertEqual('http://b', pool.acquire(exclude=['http://a']))
+
+    def test_failed_endpoint_taken_out_of_rotation(self):
+        pool = OllamaEndpointPool(rest_urls=['http://a', 'http://b'], base_backoff=100)
+        url = pool.acquire()
+        pool.release(url, success=False)
+        other = 'http://b' if url == 'http://a' else 'http://a'
+        for x in range(3):
+            self.assertEqual(other, pool.acquire())
+        stats = {s['url']: s for s in pool.get_statistics()}
+        self.assertFalse(stats[url]['healthy'])
+        self.assertEqual(1, stats[url]['failures'])
+        self.assertTrue(stats[other]['healthy'])
+
+    def test_exponential_backoff(self):
+        pool = OllamaEndpointPool(rest_urls=['http://a'], base_backoff=10, max_backoff=25)
+        endpoint = pool._endpoints['http://a']
+        with patch('time.time', return_value=1000):
+            pool._mark_failure(endpoint)
+            self.assertEqual(1010, endpoint['retry_at'])
+            pool._mark_failure(endpoint)
+            self.assertEqual(1020, endpoint['retry_at'])
+            pool._mark_failure(endpoint)
+            self.assertEqual(1025, endpoint['retry_at'])
+
+    def test_probe_puts_endpoint_back(self):
+        pool = OllamaEndpointPool(rest_urls=['http://a/api/generate'], base_backoff=0)
+        url = pool.acquire()
+        pool.release(url, success=False)
+        response = MagicMock()
+        response.status_code = 200
+        with patch('requests.get', return_value=response) as mock_get:
+            self.assertEqual(url, pool.acquire())
+            self.assertEqual('http://a/api/version', mock_get.call_args[0][0])
+
+    def test_failed_probe_raises(self):
+        pool = OllamaEndpointPool(rest_urls=['http://a'], base_backoff=0)
+        pool.release(pool.acquire(), success=False)
+        with patch('requests.get', side_effect=requests.exceptions.ConnectionError('down')):
+            with self.assertRaises(CellmapshierarchyevalError) as ce:
+                pool.acquire()
+            self.assertEqual('Health probe of http://a failed', str(ce.exception))
+        self.assertFalse(pool.get_statistics()[0]['healthy'])
+
+    def test_no_healthy_endpoint_within_wait(self):
+        pool = OllamaEndpointPool(rest_urls=['http://a'], base_backoff=100,
+                                  max_unavailable_wait=0.2)
+        pool.release(pool.acquire(), success=False)
+        with self.assertRaises(CellmapshierarchyevalError) as ce:
+            pool.acquire()
+        self.assertTrue('No healthy ollama endpoints' in str(ce.exception))
+
+    def test_minimum_backoff(self):
+        pool = OllamaEndpointPool(rest_urls=['http://a'], base_backoff=0)
+        endpoint = pool._endpoints['http://a']
+        with patch('time.time', return_value=1000):
+            pool._mark_failure(endpoint)
+        self.assertEqual(1000 + OllamaEndpointPool.MIN_BACKOFF, endpoint['retry_at'])
+
+    def test_sequential_requests_spread_across_endpoints(self):
+        pool = OllamaEndpointPool(rest_urls=['http://a', 'http://b', 'http://c'])
+        for x in range(6):
+            pool.release(pool.acquire(), latency=1.0)
+        stats = pool.get_statistics()
+        self.assertEqual([2, 2, 2], [e['requests'] for e in stats])
+
+    def test_get_statistics(self):
+        pool = OllamaEndpointPool(rest_urls='http://a')
+        for latency in [1.0, 3.0, 2.0]:
+            pool.release(pool.acquire(), latency=latency)
+        stats = pool.get_statistics()
+        self.assertEqual(1, len(stats))
+        self.assertEqual('http://a', stats[0]['url'])
+        self.assertEqual(3, stats[0]['requests'])
+        self.assertEqual(0, stats[0]['failures'])
+        self.assertEqual(2.0, stats[0]['mean_latency'])
+        self.assertEqual(2.0, stats[0]['median_latency'])
+        self.assertEqual(3.0, stats[0]['max_latency'])
+
+
+if __name__ == '__main__':
+    unittest.main()
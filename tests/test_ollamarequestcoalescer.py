@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `OllamaRequestCoalescer` class."""
+
+import threading
+import unittest
+
+from cellmaps_hierarchyeval.analysis import OllamaRequestCoalescer
+
+
+class TestOllamaRequestCoalescer(unittest.TestCase):
+    """Tests for `OllamaRequestCoalescer` ."""
+
+    def test_get_key_ignores_order(self):
+        self.assertEqual(OllamaRequestCoalescer.get_key({'a': 1, 'b': {'c': 2, 'd': 3}}),
+                         OllamaRequestCoalescer.get_key({'b': {'d': 3, 'c': 2}, 'a': 1}))
+        self.assertNotEqual(OllamaRequestCoalescer.get_key({'a': 1}),
+                            OllamaRequestCoalescer.get_key({'a': 2}))
+
+    def test_concurrent_identical_requests_share_one_call(self):
+        coalescer = OllamaRequestCoalescer()
+        release = threading.Event()
+        calls = []
+
+        def send(call_info):
+            calls.append(1)
+            call_info['status_code'] = 200
+            call_info['response'] = {'eval_count': 5}
+            release.wait(timeout=5)
+            return 'out', None
+
+        results = []
+        infos = [{} for _ in range(3)]
+
+        def worker(info):
+            results.append(coalescer.run({'model': 'm', 'prompt': 'p'}, send, call_info=info))
+
+        threads = [threading.Thread(target=worker, args=(info,)) for info in infos]
+        for t in threads:
+            t.start()
+        while coalescer.get_statistics()['requests'] < 3:
+            pass
+        release.set()
+        for t in threads:
+            t.join(timeout=5)
+        self.assertEqual(1, len(calls))
+        self.assertEqual([('out', None)] * 3, results)
+        self.assertEqual({'requests': 3, 'sent': 1, 'coalesced': 2, 'cached': 0},
+                         coalescer.get_statistics())
+        # token counts only kept by request that was sent
+        self.assertEqual(1, len([i for i in infos if 'response' in i]))
+        self.assertEqual(2, len([i for i in infos if i.get('coalesced') is True]))
+        self.assertTrue(all(i['status_code'] == 200 for i in infos))
+
+    def test_repeated_request_uses_kept_result(self):
+        coalescer = OllamaRequestCoalescer(max_entries=1)
+        self.assertEqual(('a', None), coalescer.run({'q': 1}, lambda info: ('a', None)))
+        info = {}
+        self.assertEqual(('a', None), coalescer.run({'q': 1}, lambda info: ('b', None),
+                                                    call_info=info))
+        self.assertTrue(info['coalesced'])
+        # oldest result dropped once max_entries is reached
+        coalescer.run({'q': 2}, lambda info: ('c', None))
+        self.assertEqual(('d', None), coalescer.run({'q': 1}, lambda info: ('d', None)))
+        self.assertEqual({'requests': 4, 'sent': 3, 'coalesced': 0, 'cached': 1},
+                         coalescer.get_statistics())
+
+    def test_failed_request_not_kept(self):
+        coalescer = OllamaRequestCoalescer()
+        self.assertEqual((None, 'err'), coalescer.run({'q': 1}, lambda info: (None, 'err')))
+        self.assertEqual(('ok', None), coalescer.run({'q': 1}, lambda info: ('ok', None)))
+
+        def send(call_info):
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            coalescer.run({'q': 2}, send)
+        self.assertEqual(('ok', None), coalescer.run({'q': 2}, lambda info: ('ok', None)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `OllamaRestServiceGenesetAgent` ."""
+
+import json
+import unittest
+
+import requests
+from unittest.mock import patch, MagicMock
+
+from cellmaps_hierarchyeval.analysis import OllamaRestServiceGenesetAgent
+from cellmaps_hierarchyeval.analysis import OllamaEndpointPool
+from cellmaps_hierarchyeval.analysis import AdaptiveConcurrencyLimiter
+from cellmaps_hierarchyeval.analysis import OllamaRequestCoalescer
+from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
+from cellmaps_hierarchyeval.mockollama import MockOllamaServer
+
+
+def get_streamed_response(tokens, status_code=200):
+    """
+    Creates mock streamed response that returns one
+    JSON chunk per token
+    """
+    lines = [json.dumps({'response': t, 'done': False}).encode('utf-8') for t in tokens]
+    lines.append(json.dumps({'response': '', 'done': True}).encode('utf-8'))
+    response = MagicMock()
+    response.status_code = status_code
+    response.iter_lines = MagicMock(return_value=iter(lines))
+    return response
+
+
+class TestOllamaRestServiceGenesetAgent(unittest.TestCase):
+    """Tests for `OllamaRestServiceGenesetAgent` ."""
+
+    def test_get_query_default(self):
+        agent = OllamaRestServiceGenesetAgent(prompt='hi {GENE_SET}', model='foo')
+        query = agent._get_query(gene_names=['a', 'b'])
+        self.assertEqual('foo', query['model'])
+        self.assertEqual('hi a,b', query['prompt'])
+        self.assertFalse(query['stream'])
+        self.assertEqual(1000, query['options']['num_predict'])
+
+    def test_get_query_stream(self):
+        agent = OllamaRestServiceGenesetAgent(prompt='hi {GENE_SET}', stream=True)
+        query = agent._get_query(gene_names=['a'])
+        self.assertTrue(query['stream'])
+
+    def test_get_query_structured_output(self):
+        agent = OllamaRestServiceGenesetAgent(prompt='hi {GENE_SET}', structured_output=True,
+                                              seed=5)
+        query = agent._get_query(gene_names=['a'], seed_offset=2)
+        self.assertEqual(OllamaRestServiceGenesetAgent.STRUCTURED_OUTPUT_SCHEMA, query['format'])
+        self.assertTrue(query['prompt'].startswith('hi a\n\nRespond only with a JSON object'))
+        self.assertEqual(7, query['options']['seed'])
+        self.assertFalse('format' in OllamaRestServiceGenesetAgent()._get_query(gene_names=['a']))
+
+    def test_get_query_keep_alive(self):
+        agent = OllamaRestServiceGenesetAgent(prompt='hi {GENE_SET}', keep_alive='30m')
+        self.assertEqual('30m', agent._get_query(gene_names=['a'])['keep_alive'])
+        self.assertFalse('keep_alive' in OllamaRestServiceGenesetAgent()._get_query(gene_names=['a']))
+
+    def test_warm_up(self):
+        ok_response = MagicMock()
+        ok_response.status_code = 200
+        ok_response.json = MagicMock(return_value={'done': True, 'load_duration': 5000})
+        bad_response = MagicMock()
+        bad_response.status_code = 500
+        pool = OllamaEndpointPool(rest_urls=['http://a/api/generate',
+                                             'http://b/api/generate'])
+
+        def post(url, json=None, auth=None, timeout=None):
+            self.assertEqual({'model': 'foo', 'stream': False, 'keep_alive': -1}, json)
+            return ok_response if url == 'http://a/api/generate' else bad_response
+
+        with patch('requests.post', side_effect=post) as mock_post:
+            agent = OllamaRestServiceGenesetAgent(endpoint_pool=pool, model='foo',
+                                                  keep_alive=-1)
+            agent.warm_up()
+            self.assertEqual(2, mock_post.call_count)
+        metrics = sorted(agent.get_warm_up_metrics(), key=lambda m: m['url'])
+        self.assertTrue(metrics[0]['success'])
+        self.assertEqual(5000, metrics[0]['load_duration'])
+        self.assertFalse(metrics[1]['success'])
+        self.assertEqual('status code: 500', metrics[1]['error'])
+        # warm up is not counted as a call
+        self.assertEqual([], agent.get_call_metrics())
+
+    def test_parse_structured_output(self):
+        parse = OllamaRestServiceGenesetAgent._parse_structured_output
+        self.assertEqual(('foo', '0.8'), parse('{"process": " foo ", "confidence": 0.8, "analysis": "x"}'))
+        self.assertEqual((None, None), parse(None))
+        self.assertEqual((None, None), parse('Process: foo'))
+        self.assertEqual((None, None), parse('[1, 2]'))
+        self.assertEqual((None, None), parse('{"process": "", "confidence": 0.8}'))
+        self.assertEqual((None, None), parse('{"process": "foo", "confidence": "high"}'))
+        self.assertEqual((None, None), parse('{"process": "foo", "confidence": 1.5}'))
+        self.assertEqual((None, None), parse('{"process": "foo", "confidence": true}'))
+
+    def test_annotate_gene_set_structured_output_retries_invalid(self):
+        bad_response = MagicMock()
+        bad_response.status_code = 200
+        bad_response.json = MagicMock(return_value={'response': '{"process": "foo"}'})
+        good_response = MagicMock()
+        good_response.status_code = 200
+        good_response.json = MagicMock(return_value={'response': '{"process": "foo", '
+                                                                 '"confidence": 0.5, '
+                                                                 '"analysis": "a"}'})
+        with patch('requests.post', side_effect=[bad_response, good_response]) as mock_post:
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://foo/api/generate',
+                                                  structured_output=True, seed=1)
+            res = agent.annotate_gene_set(['gene1'])
+        self.assertEqual(('foo', '0.5'), res[:2])
+        self.assertEqual([1, 2], [c[1]['json']['options']['seed'] for c in mock_post.call_args_list])
+        self.assertEqual([1, 0], [m['parse_failures'] for m in agent.get_call_metrics()])
+
+    def test_annotate_gene_set_structured_output_retry_budget(self):
+        bad_response = MagicMock()
+        bad_response.status_code = 200
+        bad_response.json = MagicMock(return_value={'response': 'not json'})
+        with patch('requests.post', return_value=bad_response) as mock_post:
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://foo/api/generate',
+                                                  structured_output=True,
+                                                  max_parse_retries=1)
+            res = agent.annotate_gene_set(['gene1'])
+        self.assertEqual((None, None, 'not json'), res)
+        self.assertEqual(2, mock_post.call_count)
+        self.assertEqual(2, sum(m['parse_failures'] for m in agent.get_call_metrics()))
+
+    def test_structured_output_disables_batching(self):
+        agent = OllamaRestServiceGenesetAgent(batch_size=3, structured_output=True)
+        self.assertFalse(agent.is_batchable(gene_names=['a']))
+
+    def test_get_batch_prompt(self):
+        agent = OllamaRestServiceGenesetAgent(prompt='Name {GENE_SET}', batch_size=2)
+        prompt = agent._get_batch_prompt(gene_sets=[['a', 'b'], ['c']])
+        self.assertTrue(prompt.startswith('The task below is repeated for 2 gene sets'))
+        self.assertTrue('Name <genes of the section>\n\n' in prompt)
+        self.assertTrue(prompt.endswith('Section 1: a,b\nSection 2: c\n'))
+
+    def test_is_batchable(self):
+        agent = OllamaRestServiceGenesetAgent()
+        self.assertEqual(1, agent.get_batch_size())
+        self.assertFalse(agent.is_batchable(gene_names=['a']))
+        agent = OllamaRestServiceGenesetAgent(batch_size=4, batch_max_genes=2)
+        self.assertEqual(4, agent.get_batch_size())
+        self.assertTrue(agent.is_batchable(gene_names=['a', 'b']))
+        self.assertFalse(agent.is_batchable(gene_names=['a', 'b', 'c']))
+
+    def test_split_batch_output(self):
+        out = ('Section 1\nProcess: foo\nConfidence Score: 0.8\n'
+               '**Section 2**\nProcess: bar\n'
+               '## Section 9\nProcess: ignored\n')
+        sections = OllamaRestServiceGenesetAgent._split_batch_output(out, 2)
+        self.assertEqual({1: 'Process: foo\nConfidence Score: 0.8',
+                          2: 'Process: bar'}, sections)
+        self.assertEqual({}, OllamaRestServiceGenesetAgent._split_batch_output(None, 2))
+
+    def test_annotate_gene_sets_falls_back_for_unparsed_section(self):
+        batch_response = MagicMock()
+        batch_response.status_code = 200
+        batch_response.json = MagicMock(return_value={'response': 'Section 1\n'
+                                                                  'Process: foo\n'
+                                                                  'Confidence Score: 0.8\n'
+                                                                  'Section 2\n'
+                                                                  'no idea\n'})
+        single_response = MagicMock()
+        single_response.status_code = 200
+        single_response.json = MagicMock(return_value={'response': 'Process: bar\n'
+                                                                   'Confidence Score: 0.3\n'})
+        with patch('requests.post', side_effect=[batch_response, single_response]) as mock_post:
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://foo/api/generate',
+                                                  prompt='Name {GENE_SET}',
+                                                  batch_size=2, max_tokens=100)
+            res = agent.annotate_gene_sets(gene_sets=[['a'], ['b']])
+        self.assertEqual(('foo', '0.8', 'Process: foo\nConfidence Score: 0.8'), res[0])
+        self.assertEqual(('bar', '0.3'), res[1][:2])
+        batch_query = mock_post.call_args_list[0][1]['json']
+        self.assertTrue('Section 2: b' in batch_query['prompt'])
+        self.assertEqual(200, batch_query['options']['num_predict'])
+        self.assertEqual('Name b', mock_post.call_args_list[1][1]['json']['prompt'])
+        self.assertEqual(2, len(agent.get_call_metrics()))
+
+    def test_annotate_gene_sets_falls_back_when_batch_fails(self):
+        bad_response = MagicMock()
+        bad_response.status_code = 400
+        good_response = MagicMock()
+        good_response.status_code = 200
+        good_response.json = MagicMock(return_value={'response': 'Process: bar\n'
+                                                                 'Confidence Score: 0.3\n'})
+        with patch('requests.post', side_effect=[bad_response, good_response,
+                                                 good_response]) as mock_post:
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://foo/api/generate',
+                                                  batch_size=2)
+            res = agent.annotate_gene_sets(gene_sets=[['a'], ['b']])
+        self.assertEqual(['bar', 'bar'], [r[0] for r in res])
+        self.assertEqual(3, mock_post.call_count)
+
+    def test_annotate_gene_set_success(self):
+        response = MagicMock()
+        response.status_code = 200
+        response.json = MagicMock(return_value={'response': 'Process: foo\n'
+                                                            'Confidence Score: 0.80\n'
+                                                            'blah'})
+        with patch('requests.post', return_value=response) as mock_post:
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://foo/api/generate')
+            res = agent.annotate_gene_set(['gene1', 'gene2'])
+            self.assertEqual(('foo', '0.80', 'Process: foo\nConfidence Score: 0.80\nblah'),
+                             res)
+            self.assertFalse(mock_post.call_args[1]['stream'])
+
+    def test_annotate_gene_set_records_call_metrics(self):
+        bad_response = MagicMock()
+        bad_response.status_code = 503
+        good_response = MagicMock()
+        good_response.status_code = 200
+        good_response.json = MagicMock(return_value={'response': 'Process: foo\n',
+                                                     'prompt_eval_count': 10,
+                                                     'eval_count': 20,
+                                                     'eval_duration': 2000000000,
+                                                     'load_duration': 100})
+        pool = OllamaEndpointPool(rest_urls=['http://a/api/generate',
+                                             'http://b/api/generate'])
+        with patch('requests.post', side_effect=[bad_response, good_response]):
+            agent = OllamaRestServiceGenesetAgent(endpoint_pool=pool, model='foo')
+            agent.annotate_gene_set(['gene1'])
+        metrics = agent.get_call_metrics()
+        self.assertEqual(1, len(metrics))
+        self.assertEqual('foo', metrics[0]['model'])
+        self.assertEqual(1, metrics[0]['retries'])
+        self.assertEqual(200, metrics[0]['status_code'])
+        self.assertTrue(metrics[0]['success'])
+        self.assertEqual(10, metrics[0]['prompt_eval_count'])
+        self.assertEqual(20, metrics[0]['eval_count'])
+        self.assertEqual(2000000000, metrics[0]['eval_duration'])
+        self.assertEqual(100, metrics[0]['load_duration'])
+
+    def test_annotate_gene_set_stream_records_final_chunk_metrics(self):
+        response = get_streamed_response(['Process: foo\n'])
+        lines = list(response.iter_lines())
+        lines[-1] = json.dumps({'response': '', 'done': True,
+                                'eval_count': 5,
+                                'eval_duration': 1000}).encode('utf-8')
+        response.iter_lines = MagicMock(return_value=iter(lines))
+        with patch('requests.post', return_value=response):
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://foo/api/generate',
+                                                  stream=True)
+            agent.annotate_gene_set(['gene1'])
+        metrics = agent.get_call_metrics()
+        self.assertEqual(5, metrics[0]['eval_count'])
+        self.assertEqual(1000, metrics[0]['eval_duration'])
+
+    def test_annotate_gene_set_non_retryable_error(self):
+        response = MagicMock()
+        response.status_code = 404
+        with patch('requests.post', return_value=response):
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://foo/api/generate')
+            with self.assertRaises(CellmapshierarchyevalError) as ce:
+                agent.annotate_gene_set(['gene1'])
+            self.assertTrue('status code: 404' in str(ce.exception))
+        metrics = agent.get_call_metrics()
+        self.assertFalse(metrics[0]['success'])
+        self.assertEqual(404, metrics[0]['status_code'])
+
+    def test_annotate_gene_set_retries_on_other_endpoint(self):
+        bad_response = MagicMock()
+        bad_response.status_code = 503
+        good_response = MagicMock()
+        good_response.status_code = 200
+        good_response.json = MagicMock(return_value={'response': 'Process: foo\n'
+                                                                 'Confidence Score: 0.80\n'})
+        pool = OllamaEndpointPool(rest_urls=['http://a/api/generate',
+                                             'http://b/api/generate'],
+                                  base_backoff=100)
+        with patch('requests.post', side_effect=[bad_response, good_response]) as mock_post:
+            agent = OllamaRestServiceGenesetAgent(endpoint_pool=pool)
+            res = agent.annotate_gene_set(['gene1'])
+            self.assertEqual('foo', res[0])
+            self.assertEqual(2, mock_post.call_count)
+            self.assertNotEqual(mock_post.call_args_list[0][0][0],
+                                mock_post.call_args_list[1][0][0])
+        stats = {s['url']: s for s in pool.get_statistics()}
+        self.assertEqual(1, sum(s['failures'] for s in stats.values()))
+
+    def test_annotate_gene_set_max_retries_exceeded(self):
+        bad_response = MagicMock()
+        bad_response.status_code = 502
+        probe_response = MagicMock()
+        probe_response.status_code = 200
+        with patch('requests.post', return_value=bad_response) as mock_post, \
+                patch('requests.get', return_value=probe_response):
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://foo/api/generate',
+                                                  max_retries=3, retry_wait=0)
+            with self.assertRaises(CellmapshierarchyevalError) as ce:
+                agent.annotate_gene_set(['gene1'])
+            self.assertTrue('Max retries exceeded' in str(ce.exception))
+            self.assertEqual(3, mock_post.call_count)
+
+    def test_annotate_gene_set_failed_probes_count_as_retries(self):
+        bad_response = MagicMock()
+        bad_response.status_code = 502
+        with patch('requests.post', return_value=bad_response) as mock_post, \
+                patch('requests.get', return_value=bad_response) as mock_get:
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://foo/api/generate',
+                                                  max_retries=3, retry_wait=0)
+            with self.assertRaises(CellmapshierarchyevalError) as ce:
+                agent.annotate_gene_set(['gene1'])
+            self.assertTrue('Health probe of http://foo/api/generate failed' in str(ce.exception))
+            self.assertEqual(1, mock_post.call_count)
+            self.assertEqual(2, mock_get.call_count)
+
+    def test_annotate_gene_set_reports_to_concurrency_limiter(self):
+        bad_response = MagicMock()
+        bad_response.status_code = 503
+        good_response = MagicMock()
+        good_response.status_code = 200
+        good_response.json = MagicMock(return_value={'response': 'Process: foo\n'})
+        limiter = MagicMock()
+        limiter.acquire = MagicMock(side_effect=[1.0, 2.0])
+        pool = OllamaEndpointPool(rest_urls=['http://a/api/generate',
+                                             'http://b/api/generate'])
+        with patch('requests.post', side_effect=[bad_response, good_response]):
+            agent = OllamaRestServiceGenesetAgent(endpoint_pool=pool,
+                                                  concurrency_limiter=limiter)
+            agent.annotate_gene_set(['gene1'])
+        self.assertEqual(2, limiter.release.call_count)
+        self.assertTrue(limiter.release.call_args_list[0][1]['overloaded'])
+        self.assertFalse(limiter.release.call_args_list[1][1]['overloaded'])
+
+    def test_annotate_gene_set_timeout_is_overload(self):
+        good_response = MagicMock()
+        good_response.status_code = 200
+        good_response.json = MagicMock(return_value={'response': 'Process: foo\n'})
+        limiter = MagicMock()
+        pool = OllamaEndpointPool(rest_urls=['http://a/api/generate',
+                                             'http://b/api/generate'])
+        with patch('requests.post', side_effect=[requests.exceptions.Timeout('slow'),
+                                                 good_response]):
+            agent = OllamaRestServiceGenesetAgent(endpoint_pool=pool,
+                                                  concurrency_limiter=limiter)
+            self.assertEqual('foo', agent.annotate_gene_set(['gene1'])[0])
+        self.assertTrue(limiter.release.call_args_list[0][1]['overloaded'])
+
+    def test_get_max_concurrency(self):
+        agent = OllamaRestServiceGenesetAgent(rest_url='http://a/api/generate')
+        self.assertEqual(1, agent.get_max_concurrency())
+        agent = OllamaRestServiceGenesetAgent(rest_url='http://a/api/generate',
+                                              concurrency_limiter=AdaptiveConcurrencyLimiter(max_limit=6))
+        self.assertEqual(6, agent.get_max_concurrency())
+
+    def test_annotate_gene_set_stream_full(self):
+        tokens = ['Process', ': foo', '\n', 'Confidence Score: ', '0.', '85',
+                  '\n', 'some', ' more', ' text']
+        response = get_streamed_response(tokens)
+        with patch('requests.post', return_value=response) as mock_post:
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://foo/api/generate',
+                                                  stream=True)
+            res = agent.annotate_gene_set(['gene1', 'gene2'])
+            self.assertEqual(('foo', '0.85', ''.join(tokens)), res)
+            self.assertTrue(mock_post.call_args[1]['stream'])
+            self.assertEqual(1, len(agent.get_time_to_first_tokens()))
+            response.close.assert_called()
+
+    def test_annotate_gene_set_stream_error_chunk_is_retried(self):
+        error_response = MagicMock()
+        error_response.status_code = 200
+        error_response.iter_lines = MagicMock(return_value=iter([
+            json.dumps({'response': 'Process: fo', 'done': False}).encode('utf-8'),
+            json.dumps({'error': 'out of memory'}).encode('utf-8')]))
+        good_response = get_streamed_response(['Process: foo\n', 'Confidence Score: 0.1\n'])
+        pool = OllamaEndpointPool(rest_urls=['http://a/api/generate',
+                                             'http://b/api/generate'],
+                                  base_backoff=100)
+        with patch('requests.post', side_effect=[error_response, good_response]):
+            agent = OllamaRestServiceGenesetAgent(endpoint_pool=pool, stream=True)
+            res = agent.annotate_gene_set(['gene1'])
+            self.assertEqual(('foo', '0.1'), res[:2])
+            error_response.close.assert_called()
+            # failed attempt does not count toward time to first token
+            self.assertEqual(1, len(agent.get_time_to_first_tokens()))
+        stats = pool.get_statistics()
+        self.assertEqual(1, sum(e['failures'] for e in stats))
+
+    def test_annotate_gene_set_stream_early_termination(self):
+        tokens = ['Process', ': foo', '\n', 'Confidence Score: ', '0.', '85',
+                  '\n', 'some', ' more', ' text']
+        response = get_streamed_response(tokens)
+        with patch('requests.post', return_value=response):
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://foo/api/generate',
+                                                  stream=True, stream_extra_tokens=1)
+            res = agent.annotate_gene_set(['gene1', 'gene2'])
+            # score must not be parsed before its line is complete
+            self.assertEqual(('foo', '0.85', 'Process: foo\nConfidence Score: 0.85\nsome'),
+                             res)
+            response.close.assert_called()
+
+    def test_annotate_gene_set_stream_early_termination_no_extra(self):
+        tokens = ['Process: foo\n', 'Confidence Score: 0.5\n', 'analysis']
+        response = get_streamed_response(tokens)
+        with patch('requests.post', return_value=response):
+            agent = OllamaRestServiceGenesetAgent(rest_url='http://foo/api/generate',
+                                                  stream=True, stream_extra_tokens=0)
+            out, closed_early = agent._read_streamed_response(response, 0)
+            self.assertEqual('Process: foo\nConfidence Score: 0.5\n', out)
+            self.assertTrue(closed_early)
+
+    def test_get_hedge_delay(self):
+        agent = OllamaRestServiceGenesetAgent()
+        agent._latencies.extend([0.1, 0.2, 0.3, 0.4])
+        self.assertIsNone(agent._get_hedge_delay())
+        agent = OllamaRestServiceGenesetAgent(hedge_percentile=50, hedge_min_samples=5)
+        agent._latencies.extend([0.4, 0.1, 0.3, 0.2])
+        self.assertIsNone(agent._get_hedge_delay())
+        agent._latencies.append(0.5)
+        self.assertEqual(0.3, agent._get_hedge_delay())
+        agent._hedge_percentile = 100
+        self.assertEqual(0.5, agent._get_hedge_delay())
+
+    def test_annotate_gene_set_hedged(self):
+        slow_server = MockOllamaServer(latency=2.0).start()
+        fast_server = MockOllamaServer().start()
+        try:
+            for stream in [False, True]:
+                # slow server has fewest requests so is picked first
+                pool = OllamaEndpointPool(rest_urls=[slow_server.get_generate_url(),
+                                                     fast_server.get_generate_url()])
+                agent = OllamaRestServiceGenesetAgent(endpoint_pool=pool, stream=stream,
+                                                      concurrency_limiter=AdaptiveConcurrencyLimiter(initial_limit=2,
+                                                                                                     max_limit=2),
+                                                      hedge_percentile=95, hedge_min_samples=1)
+                agent._latencies.append(0.05)
+                res = agent.annotate_gene_set(['gene1'])
+                self.assertTrue(res[0].startswith('Mock process'))
+                metrics = agent.get_call_metrics()
+                self.assertEqual(1, metrics[0]['hedges'])
+                self.assertEqual(1, metrics[0]['hedge_wins'])
+                self.assertTrue(metrics[0]['wall_time'] < 1.5)
+                # cancelled request does not count as failure
+                self.assertEqual(0, sum(e['failures'] for e in pool.get_statistics()))
+                agent.close()
+        finally:
+            slow_server.stop()
+            fast_server.stop()
+
+    def test_annotate_gene_sets_batched_and_streamed(self):
+        server = MockOllamaServer(seed=1).start()
+        try:
+            agent = OllamaRestServiceGenesetAgent(rest_url=server.get_generate_url(),
+                                                  prompt='Name {GENE_SET}', batch_size=3,
+                                                  stream=True, stream_extra_tokens=0)
+            res = agent.annotate_gene_sets(gene_sets=[['a'], ['b'], ['c']])
+            self.assertEqual(3, len(res))
+            for process_name, confidence, _ in res:
+                self.assertTrue(process_name.startswith('Mock process'))
+                self.assertIsNotNone(confidence)
+            # whole batched response is read, no gene set is sent again
+            self.assertEqual(1, server.get_statistics()['requests'])
+            self.assertEqual(1, len(agent.get_call_metrics()))
+        finally:
+            server.stop()
+
+    def test_annotate_gene_set_not_hedged_without_free_slot(self):
+        server = MockOllamaServer(latency=0.2).start()
+        try:
+            agent = OllamaRestServiceGenesetAgent(rest_url=[server.get_generate_url()],
+                                                  concurrency_limiter=AdaptiveConcurrencyLimiter(initial_limit=1,
+                                                                                                 max_limit=1),
+                                                  hedge_percentile=50, hedge_min_samples=1)
+            agent._latencies.append(0.01)
+            agent.annotate_gene_set(['gene1'])
+            self.assertEqual(0, agent.get_call_metrics()[0]['hedges'])
+            self.assertEqual(1, server.get_statistics()['requests'])
+            agent.close()
+        finally:
+            server.stop()
+
+    def test_annotate_gene_set_coalesced_across_agents(self):
+        server = MockOllamaServer().start()
+        try:
+            pool = OllamaEndpointPool(rest_urls=[server.get_generate_url()])
+            coalescer = OllamaRequestCoalescer()
+            agent_a = OllamaRestServiceGenesetAgent(endpoint_pool=pool, model='foo',
+                                                    attribute_name_prefix='a::',
+                                                    request_coalescer=coalescer)
+            agent_b = OllamaRestServiceGenesetAgent(endpoint_pool=pool, model='foo',
+                                                    attribute_name_prefix='b::',
+                                                    request_coalescer=coalescer)
+            self.assertIs(coalescer, agent_a.get_request_coalescer())
+            res_a = agent_a.annotate_gene_set(['gene1'])
+            res_b = agent_b.annotate_gene_set(['gene1'])
+            self.assertEqual(res_a, res_b)
+            self.assertEqual(1, server.get_statistics()['requests'])
+            self.assertFalse(agent_a.get_call_metrics()[0]['coalesced'])
+            self.assertTrue(agent_b.get_call_metrics()[0]['coalesced'])
+            self.assertIsNone(agent_b.get_call_metrics()[0]['eval_count'])
+            agent_b.annotate_gene_set(['gene2'])
+            self.assertEqual(2, server.get_statistics()['requests'])
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
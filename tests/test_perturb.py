@@ -1,10 +1,18 @@
 import os
+import shutil
+import tempfile
 import unittest
 
+import numpy as np
 import pandas as pd
+from scipy.stats import ranksums
 from ndex2.cx2 import RawCX2NetworkFactory
 
+from cellmaps_hierarchyeval import perturb
 from cellmaps_hierarchyeval.perturb import PerturbSeqAnalysis
+from cellmaps_hierarchyeval.perturbstore import PerturbSeqStore
+from cellmaps_hierarchyeval.similarity import CosineSimilarityProvider
+from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
 
 
 class TestPerturbSeqAnalysis(unittest.TestCase):
@@ -21,6 +29,51 @@ class TestPerturbSeqAnalysis(unittest.TestCase):
         self.assertEqual(10, len(r_data))
         self.assertAlmostEqual(r_data.iloc[0, 0], -1.57, delta=0.01)
 
+    def test_get_heatmaps(self):
+        heatmaps = dict(self.analysis_obj.get_heatmaps(self.perturb_table, node_ids=[72, 0]))
+        self.assertEqual([72, 0], list(heatmaps.keys()))
+        for node_id, data in heatmaps.items():
+            expected = self.analysis_obj.get_heatmap_for_given_hierarchy_system(node_id, self.perturb_table)
+            self.assertTrue(expected.index.equals(data.index))
+            self.assertTrue(expected.columns.equals(data.columns))
+            self.assertTrue(np.allclose(expected.values, data.values, equal_nan=True))
+        with self.assertRaises(CellmapshierarchyevalError):
+            list(self.analysis_obj.get_heatmaps(pd.concat([self.perturb_table, self.perturb_table])))
+
+    def test_write_heatmaps(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            outfile = os.path.join(temp_dir, 'heatmaps.npz')
+            written = self.analysis_obj.write_heatmaps(self.perturb_table, outfile, num_perturb_seq=5)
+            self.assertEqual(len(self.analysis_obj._hierarchy.get_nodes()), len(written))
+            with np.load(outfile) as data:
+                self.assertEqual(5, len(data['columns']))
+                self.assertEqual((10, 5), data['node_72'].shape)
+                self.assertEqual('RPP30', data['node_72_genes'][0])
+                expected = self.analysis_obj.get_heatmap_for_given_hierarchy_system(72, self.perturb_table,
+                                                                                    num_perturb_seq=5)
+                self.assertTrue(np.allclose(expected.values, data['node_72']))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_perturbseq_store(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            store = PerturbSeqStore.from_dataframe(self.perturb_table, temp_dir, dtype=np.float64)
+            expected = self.analysis_obj.get_heatmap_for_given_hierarchy_system(72, self.perturb_table)
+            data = self.analysis_obj.get_heatmap_for_given_hierarchy_system(72, store)
+            self.assertTrue(expected.columns.equals(data.columns))
+            self.assertTrue(np.allclose(expected.values, data.values))
+            heatmaps = dict(self.analysis_obj.get_heatmaps(store, node_ids=[72, 0]))
+            self.assertTrue(np.allclose(expected.values, heatmaps[72].values))
+
+            root_pairs = self.analysis_obj.get_root_community_membership()
+            r_val1, r_val2 = self.analysis_obj.get_root_overlapping_pair_similarities(root_pairs, store)
+            self.assertEqual(1233, len(r_val1))
+            self.assertAlmostEqual(r_val1.loc['ESF1', 'TMA16'], 0.65, delta=0.01)
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_get_root_gene_pair_similarities(self):
         r_value = self.analysis_obj.get_root_gene_pair_similarities()
         self.assertEqual(5147, len(r_value))
@@ -39,6 +92,51 @@ class TestPerturbSeqAnalysis(unittest.TestCase):
         result = self.analysis_obj.get_root_functional_data_similarity(r_val1, r_val2)
         self.assertEqual(len(result), 426402)
 
+    def test_get_root_functional_data_similarity_sample(self):
+        root_pairs = self.analysis_obj.get_root_gene_pair_similarities()
+        r_val1, r_val2 = self.analysis_obj.get_root_overlapping_pair_similarities(root_pairs, self.perturb_table)
+        result = self.analysis_obj.get_root_functional_data_similarity(r_val1, r_val2)
+        sample = self.analysis_obj.get_root_functional_data_similarity(r_val1, r_val2, sample_size=1000, seed=1)
+        self.assertEqual(1000, len(sample))
+        self.assertTrue(np.isin(sample, result).all())
+        self.assertTrue(np.array_equal(sample, self.analysis_obj.get_root_functional_data_similarity(
+            r_val1, r_val2, sample_size=1000, seed=1)))
+        self.assertTrue(np.array_equal(result, self.analysis_obj.get_root_functional_data_similarity(
+            r_val1, r_val2, sample_size=len(result) + 1)))
+        with self.assertRaises(CellmapshierarchyevalError):
+            self.analysis_obj.get_root_functional_data_similarity(r_val1, r_val2, sample_size=-1)
+
+    def test_get_root_overlapping_pair_similarities_with_provider(self):
+        root_pairs = self.analysis_obj.get_root_community_membership()
+        r_val1, r_val2 = self.analysis_obj.get_root_overlapping_pair_similarities(root_pairs, self.perturb_table)
+        provider = CosineSimilarityProvider(dtype=np.float32, block_size=100)
+        p_val1, p_val2 = self.analysis_obj.get_root_overlapping_pair_similarities(root_pairs, self.perturb_table,
+                                                                                  similarity_provider=provider)
+        self.assertTrue(r_val1.index.equals(p_val1.index))
+        self.assertTrue(np.allclose(r_val1.values, p_val1.values, atol=1e-6))
+        result = self.analysis_obj.get_root_functional_data_similarity(p_val1, p_val2)
+        self.assertEqual(426402, len(result))
+
+    def test_get_root_community_membership(self):
+        root_pairs = self.analysis_obj.get_root_gene_pair_similarities()
+        membership = self.analysis_obj.get_root_community_membership()
+        self.assertEqual(5147, len(membership))
+        dense = membership.to_pair_similarities()
+        self.assertTrue((dense.loc[root_pairs.index, root_pairs.columns].values == root_pairs.values).all())
+        with self.assertRaises(CellmapshierarchyevalError):
+            membership.subset(['NOTAGENE'])
+
+    def test_get_root_functional_data_similarity_with_membership(self):
+        root_pairs = self.analysis_obj.get_root_gene_pair_similarities()
+        membership = self.analysis_obj.get_root_community_membership()
+        r_val1, r_val2 = self.analysis_obj.get_root_overlapping_pair_similarities(root_pairs, self.perturb_table)
+        m_val1, m_val2 = self.analysis_obj.get_root_overlapping_pair_similarities(membership, self.perturb_table)
+        self.assertEqual(1233, len(m_val2))
+        self.assertAlmostEqual(m_val1.loc['ESF1', 'TMA16'], 0.65, delta=0.01)
+        expected = self.analysis_obj.get_root_functional_data_similarity(r_val1, r_val2)
+        result = self.analysis_obj.get_root_functional_data_similarity(r_val1, m_val2)
+        self.assertTrue(np.array_equal(np.array(expected), result))
+
     def test_get_cluster_similarity(self):
         root_pairs = self.analysis_obj.get_root_gene_pair_similarities()
         r_val1, r_val2 = self.analysis_obj.get_root_overlapping_pair_similarities(root_pairs, self.perturb_table)
@@ -55,7 +153,128 @@ class TestPerturbSeqAnalysis(unittest.TestCase):
         self.assertAlmostEqual(stat, 7.49, delta=0.01)
         self.assertAlmostEqual(p_value, 3.35 * 10 ** -14, delta=0.01)
 
+    def test_evaluate_hierarchy_systems(self):
+        root_pairs = self.analysis_obj.get_root_gene_pair_similarities()
+        r_val1, r_val2 = self.analysis_obj.get_root_overlapping_pair_similarities(root_pairs, self.perturb_table)
+        sim_root = self.analysis_obj.get_root_functional_data_similarity(r_val1, r_val2)
+        table = self.analysis_obj.evaluate_hierarchy_systems(r_val1, sim_root)
+        self.assertEqual(len(self.analysis_obj._hierarchy.get_nodes()), len(table))
+        self.assertEqual(PerturbSeqAnalysis.RANK_SUM_COLUMNS, list(table.columns))
+        self.assertEqual(45, table.loc[72, 'num_pairs'])
+        self.assertAlmostEqual(table.loc[72, 'statistic'], 7.49, delta=0.01)
+        for node_id in [72, 0, 5]:
+            stat, p_value = self.analysis_obj.compare_cluster_root_similarities(
+                self.analysis_obj.get_cluster_similarity(r_val1, node_id), sim_root)
+            self.assertAlmostEqual(stat, table.loc[node_id, 'statistic'], places=10)
+            self.assertAlmostEqual(p_value, table.loc[node_id, 'p_value'], places=15)
+
+    def test_evaluate_hierarchy_systems_parallel(self):
+        root_pairs = self.analysis_obj.get_root_community_membership()
+        r_val1, r_val2 = self.analysis_obj.get_root_overlapping_pair_similarities(root_pairs, self.perturb_table)
+        sim_root = self.analysis_obj.get_root_functional_data_similarity(r_val1, r_val2)
+        expected = self.analysis_obj.evaluate_hierarchy_systems(r_val1, sim_root)
+        table = self.analysis_obj.evaluate_hierarchy_systems_parallel(r_val1, sim_root, num_workers=2)
+        self.assertTrue(expected.equals(table))
+        table = self.analysis_obj.evaluate_hierarchy_systems_parallel(r_val1, sim_root, node_ids=[72, 0],
+                                                                      num_workers=2)
+        self.assertEqual([72, 0], list(table.index))
+        self.assertEqual(45, table.loc[72, 'num_pairs'])
+        self.assertEqual(0, len(self.analysis_obj.evaluate_hierarchy_systems_parallel(r_val1, sim_root,
+                                                                                      node_ids=[])))
+        with self.assertRaises(CellmapshierarchyevalError):
+            self.analysis_obj.evaluate_hierarchy_systems_parallel(r_val1, sim_root, num_workers=0)
+
+    def test_evaluate_hierarchy_systems_parallel_cached_similarity(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            provider = CosineSimilarityProvider(cache_dir=temp_dir)
+            root_pairs = self.analysis_obj.get_root_community_membership()
+            r_val1, r_val2 = self.analysis_obj.get_root_overlapping_pair_similarities(root_pairs,
+                                                                                      self.perturb_table,
+                                                                                      similarity_provider=provider)
+            # workers map cache file instead of getting a copy
+            self.assertEqual(os.path.dirname(perturb._get_npy_path(r_val1.values)), temp_dir)
+            self.assertIsNone(perturb._get_npy_path(np.array(r_val1.values)))
+            self.assertIsNone(perturb._get_npy_path(r_val1.values[1:]))
+            sim_root = self.analysis_obj.get_root_functional_data_similarity(r_val1, r_val2)
+            expected = self.analysis_obj.evaluate_hierarchy_systems(r_val1, sim_root)
+            table = self.analysis_obj.evaluate_hierarchy_systems_parallel(r_val1, sim_root, num_workers=2)
+            self.assertTrue(expected.equals(table))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_permutation_test_hierarchy_systems(self):
+        root_pairs = self.analysis_obj.get_root_community_membership()
+        r_val1, r_val2 = self.analysis_obj.get_root_overlapping_pair_similarities(root_pairs, self.perturb_table)
+        node_ids = [72, 0, 1, 2, 4]
+        table = self.analysis_obj.permutation_test_hierarchy_systems(r_val1, node_ids=node_ids,
+                                                                     num_permutations=300, seed=1)
+        self.assertEqual(node_ids, list(table.index))
+        self.assertEqual(10, table.loc[72, 'num_genes'])
+        self.assertAlmostEqual(np.mean(self.analysis_obj.get_cluster_similarity(r_val1, 72)),
+                               table.loc[72, 'mean_similarity'], places=12)
+        self.assertAlmostEqual(1 / 301, table.loc[72, 'p_value'])
+        # root contains every gene so every random set ties with it
+        self.assertEqual(1.0, table.loc[0, 'p_value'])
+        table32 = self.analysis_obj.permutation_test_hierarchy_systems(r_val1.astype(np.float32),
+                                                                       node_ids=[0], num_permutations=300)
+        self.assertEqual(1.0, table32.loc[0, 'p_value'])
+        self.assertTrue(np.isnan(table.loc[2, 'p_value']))
+
+        # same seed gives same p-values for any subset or number of workers
+        self.assertTrue(table.equals(self.analysis_obj.permutation_test_hierarchy_systems(
+            r_val1, node_ids=node_ids, num_permutations=300, seed=1, num_workers=2)))
+        self.assertTrue(table.loc[[1, 4]].equals(self.analysis_obj.permutation_test_hierarchy_systems(
+            r_val1, node_ids=[1, 4], num_permutations=300, seed=1)))
+        with self.assertRaises(CellmapshierarchyevalError):
+            self.analysis_obj.permutation_test_hierarchy_systems(r_val1, num_permutations=0)
+        with self.assertRaises(CellmapshierarchyevalError):
+            self.analysis_obj.permutation_test_hierarchy_systems(r_val1, num_workers=0)
+
+    def test_get_null_means(self):
+        rng = np.random.default_rng(0)
+        values = rng.random((8, 8))
+        values = (values + values.T) / 2
+        rows, cols = np.triu_indices(3, k=1)
+        possible = set()
+        for i in range(8):
+            for j in range(i + 1, 8):
+                for k in range(j + 1, 8):
+                    genes = np.array([i, j, k])
+                    possible.add(round(np.mean(values[genes[rows], genes[cols]]), 10))
+        means = perturb._get_null_means(values, (3, 0, 2000, 1, False))
+        self.assertTrue(set(np.round(means, 10)).issubset(possible))
+        self.assertAlmostEqual(np.mean(values[np.triu_indices(8, k=1)]), np.mean(means), delta=0.01)
+        # large sets summed with matrix product match gathering pairs
+        means = perturb._get_null_means(values, (7, 0, 50, 1, False))
+        self.assertTrue(set(np.round(means, 10)).issubset(
+            {round(np.mean(values[np.ix_(g, g)][np.triu_indices(7, k=1)]), 10)
+             for g in [np.delete(np.arange(8), i) for i in range(8)]}))
+        # float32 matrix product matches gathering pairs, which is used
+        # when matrix has NaN, for the same random sets
+        values = values.astype(np.float32)
+        np.testing.assert_allclose(perturb._get_null_means(values, (7, 0, 50, 1, True)),
+                                   perturb._get_null_means(values, (7, 0, 50, 1, False)), rtol=1e-6)
 
+    def test_compare_clusters_root_similarities_ties_match_scipy(self):
+        rng = np.random.default_rng(0)
+        root_values = rng.integers(0, 5, 500).astype(float)
+        clusters = {i: rng.integers(0, 5, rng.integers(1, 30)).astype(float) for i in range(20)}
+        clusters[20] = np.array([])
+        clusters[21] = np.array([1.0, np.nan])
+        for alternative in ['greater', 'less', 'two-sided']:
+            table = PerturbSeqAnalysis.compare_clusters_root_similarities(clusters, root_values,
+                                                                          alternative=alternative)
+            for i in range(20):
+                stat, p_value = ranksums(clusters[i], root_values, alternative=alternative)
+                self.assertAlmostEqual(stat, table.loc[i, 'statistic'], places=10)
+                self.assertAlmostEqual(p_value, table.loc[i, 'p_value'], places=12)
+            self.assertTrue(np.isnan(table.loc[20, 'statistic']))
+            self.assertEqual(0, table.loc[20, 'num_pairs'])
+            self.assertTrue(np.isnan(table.loc[21, 'p_value']))
+        with self.assertRaises(CellmapshierarchyevalError):
+            PerturbSeqAnalysis.compare_clusters_root_similarities(clusters, root_values,
+                                                                  alternative='foo')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `perturbstore` module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from cellmaps_hierarchyeval.perturbstore import PerturbSeqStore
+from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
+
+
+class TestPerturbSeqStore(unittest.TestCase):
+    """Tests for `PerturbSeqStore` ."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.df = pd.DataFrame(rng.normal(loc=1000.0, size=(30, 6)),
+                               index=['G' + str(i) for i in range(30)],
+                               columns=['C' + str(i) for i in range(6)])
+        self.df.iloc[2, 1] = np.nan
+        self.df.iloc[:, 5] = np.nan
+        self.df.iloc[0, 5] = 1.0
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_not_a_store(self):
+        with self.assertRaises(CellmapshierarchyevalError):
+            PerturbSeqStore(self.temp_dir)
+
+    def test_from_csv(self):
+        csv_file = os.path.join(self.temp_dir, 'data.csv')
+        self.df.to_csv(csv_file)
+        store = PerturbSeqStore.from_csv(csv_file, os.path.join(self.temp_dir, 'store'),
+                                         dtype=np.float64, chunksize=7)
+        self.assertEqual((30, 6), store.shape)
+        self.assertTrue(store.index.equals(self.df.index))
+        self.assertTrue(store.columns.equals(self.df.columns))
+        self.assertTrue(np.allclose(self.df.values, store.get_data().values, equal_nan=True))
+
+    def test_get_column_variances(self):
+        store = PerturbSeqStore.from_dataframe(self.df, os.path.join(self.temp_dir, 'store'),
+                                               dtype=np.float64)
+        store._chunk_rows = 4
+        variances = store.get_column_variances()
+        expected = self.df.var()
+        self.assertTrue(np.allclose(expected.values[:5], variances.values[:5], rtol=1e-9))
+        self.assertTrue(np.isnan(variances['C5']))
+        self.assertEqual(list(expected.sort_values(ascending=False).head(3).index),
+                         list(store.get_top_variance_columns(3)))
+
+    def test_get_data(self):
+        store = PerturbSeqStore.from_dataframe(self.df, os.path.join(self.temp_dir, 'store'))
+        data = store.get_data(genes=['G9', 'NOTAGENE', 'G1', 'G9'], columns=['C3', 'C0'])
+        self.assertEqual(['G9', 'G1'], list(data.index))
+        self.assertEqual(['C3', 'C0'], list(data.columns))
+        self.assertEqual(np.float32, data.values.dtype)
+        self.assertAlmostEqual(self.df.loc['G1', 'C0'], data.loc['G1', 'C0'], places=3)
+        with self.assertRaises(CellmapshierarchyevalError):
+            store.get_data(columns=['foo'])
+
+        # rows gathered over several blocks keep order of genes
+        store._chunk_rows = 3
+        genes = ['G7', 'G2', 'G9', 'G0', 'G5', 'G1', 'G8']
+        data = store.get_data(genes=genes, columns=['C4', 'C1'])
+        self.assertTrue(np.allclose(self.df.loc[genes, ['C4', 'C1']].values, data.values, equal_nan=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
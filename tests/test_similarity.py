@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `similarity` module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from cellmaps_utils import music_utils
+
+from cellmaps_hierarchyeval.similarity import CosineSimilarityProvider
+from cellmaps_hierarchyeval.similarity import LowRankCosineSimilarityProvider
+from cellmaps_hierarchyeval.exceptions import CellmapshierarchyevalError
+
+
+class TestCosineSimilarityProvider(unittest.TestCase):
+    """Tests for `CosineSimilarityProvider` ."""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.df = pd.DataFrame(rng.normal(size=(50, 8)),
+                               index=['G' + str(i) for i in range(50)])
+        self.df.iloc[3] = 0.0
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(CellmapshierarchyevalError):
+            CosineSimilarityProvider(dtype=np.int32)
+        with self.assertRaises(CellmapshierarchyevalError):
+            CosineSimilarityProvider(block_size=0)
+        df = self.df.copy()
+        df.iloc[0, 0] = np.nan
+        with self.assertRaises(CellmapshierarchyevalError):
+            CosineSimilarityProvider().get_similarity(df)
+
+    def test_get_similarity_matches_music_utils(self):
+        expected = music_utils.cosine_similarity_scaled(self.df)
+        res = CosineSimilarityProvider(block_size=7).get_similarity(self.df)
+        self.assertTrue(res.index.equals(expected.index))
+        self.assertTrue(np.allclose(expected.values, res.values, atol=1e-12))
+        res = CosineSimilarityProvider(dtype=np.float32, block_size=7).get_similarity(self.df)
+        self.assertEqual(np.float32, res.values.dtype)
+        self.assertTrue(np.allclose(expected.values, res.values, atol=1e-6))
+
+    def test_get_similarity_cached(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            provider = CosineSimilarityProvider(cache_dir=temp_dir, dtype=np.float32, block_size=16)
+            first = provider.get_similarity(self.df)
+            self.assertEqual([os.path.basename(provider.get_cache_path(self.df))], os.listdir(temp_dir))
+            self.assertFalse(first.values.flags.writeable)
+
+            # another instance, like another process, reuses cached file
+            second = CosineSimilarityProvider(cache_dir=temp_dir, dtype=np.float32).get_similarity(self.df)
+            self.assertTrue(np.array_equal(first.values, second.values))
+            self.assertEqual(1, len(os.listdir(temp_dir)))
+
+            # gene order and type are part of the key
+            provider.get_similarity(self.df.iloc[::-1])
+            CosineSimilarityProvider(cache_dir=temp_dir).get_similarity(self.df)
+            self.assertEqual(3, len(os.listdir(temp_dir)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class TestLowRankCosineSimilarityProvider(unittest.TestCase):
+    """Tests for `LowRankCosineSimilarityProvider` ."""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        low_rank = rng.normal(size=(60, 3)) @ rng.normal(size=(3, 40))
+        self.df = pd.DataFrame(low_rank + 0.001 * rng.normal(size=(60, 40)),
+                               index=['G' + str(i) for i in range(60)])
+
+    def test_invalid_rank(self):
+        with self.assertRaises(CellmapshierarchyevalError):
+            LowRankCosineSimilarityProvider(rank=0)
+
+    def test_get_similarity(self):
+        expected = music_utils.cosine_similarity_scaled(self.df)
+        provider = LowRankCosineSimilarityProvider(rank=3, seed=1, block_size=16)
+        self.assertIsNone(provider.get_error_report())
+        res = provider.get_similarity(self.df)
+        self.assertTrue(res.index.equals(expected.index))
+        self.assertEqual(np.float32, res.values.dtype)
+        self.assertTrue(np.allclose(expected.values, res.values, atol=1e-3))
+        report = provider.get_error_report()
+        self.assertEqual(10000, report['num_pairs'])
+        self.assertEqual(3, report['rank'])
+        self.assertTrue(report['max_absolute_error'] < 1e-3)
+        self.assertTrue(report['captured_variance'] > 0.99)
+        # scaling divides errors by range of similarity
+        normalized = self.df.values / np.linalg.norm(self.df.values, axis=1)[:, np.newaxis]
+        cosine = normalized @ normalized.T
+        self.assertAlmostEqual(report['rmse'] / (cosine.max() - cosine.min()), report['scaled_rmse'],
+                               delta=report['scaled_rmse'] * 1e-3)
+
+        # same seed gives same result
+        again = LowRankCosineSimilarityProvider(rank=3, seed=1, block_size=16).get_similarity(self.df)
+        self.assertTrue(np.array_equal(res.values, again.values))
+
+        # too few dimensions gives larger error
+        provider = LowRankCosineSimilarityProvider(rank=1, seed=1, error_sample_size=0)
+        provider.get_similarity(self.df)
+        self.assertEqual(0, provider.get_error_report()['num_pairs'])
+        self.assertIsNone(provider.get_error_report()['scaled_rmse'])
+        self.assertTrue(provider.get_error_report()['captured_variance'] < 0.99)
+
+    def test_get_similarity_full_rank_is_exact(self):
+        expected = music_utils.cosine_similarity_scaled(self.df)
+        provider = LowRankCosineSimilarityProvider(rank=100, dtype=np.float64)
+        res = provider.get_similarity(self.df)
+        self.assertTrue(np.allclose(expected.values, res.values, atol=1e-12))
+        self.assertEqual(0.0, provider.get_error_report()['max_absolute_error'])
+        self.assertEqual(0.0, provider.get_error_report()['scaled_max_absolute_error'])
+
+    def test_cache_key_includes_rank(self):
+        self.assertNotEqual(LowRankCosineSimilarityProvider(rank=2).get_cache_key(self.df),
+                            LowRankCosineSimilarityProvider(rank=3).get_cache_key(self.df))
+        self.assertNotEqual(CosineSimilarityProvider(dtype=np.float32).get_cache_key(self.df),
+                            LowRankCosineSimilarityProvider().get_cache_key(self.df))
+
+
+if __name__ == '__main__':
+    unittest.main()